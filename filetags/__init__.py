@@ -38,65 +38,74 @@ def safe_import(library):
               "\".\nPlease install it, e.g., with \"sudo pip install " + library + "\".")
         sys.exit(2)
 
+import abc  # for the base class of the query nodes
 import argparse  # for handling command line arguments
+import bisect  # for date ranges of the inverted tag index
+import collections  # for the LRU order of the scan cache
 import errno  # for throwing FileNotFoundError
-import logging
+import functools  # for memoizing parsed file names
+import io  # for capturing the output of daemon requests
+import json  # for the manifest of tagtrees and the rename journal
 import os
 import platform
 import re
 import stat
 import sys
-import tempfile
+import itertools  # for calculating permutations of tagtrees
+import logging
+import marshal  # for the snapshots of the controlled vocabularies
+import math  # (integer) calculations
+import operator  # for sorting dicts
+import threading
 import time
-try:
-    import tkinter as tk          ## for --gui
-    from tkinter import ttk, font ## for --gui
-    have_tkinter = True
-except ModuleNotFoundError:
-    have_tkinter = False
-
-safe_import('operator')   # for sorting dicts
-safe_import('difflib')    # for good enough matching words
-safe_import('readline')   # for raw_input() reading from stdin
-safe_import('math')       # (integer) calculations
-safe_import('clint')      # for config file handling
-safe_import('itertools')  # for calculating permutations of tagtrees
+
+# Modules which are only needed for some features are imported when
+# they are used: readline (interactive tagging), tkinter (--gui),
+# difflib (similar tags), win32com (Windows lnk files), socket (daemon),
+# concurrent.futures (threads) and others.
+# This keeps the start-up time of filetags low.
 safe_import('colorama')   # for colorful output
-if platform.system() == 'Windows':
-    try:
-        import win32com.client
-    except ImportError:
-        print("Could not find Python module \"win32com.client\".\nPlease install it, e.g., " +
-              "with \"sudo pip install pypiwin32\".")
-        sys.exit(3)
-    safe_import('pathlib')
 
 PROG_VERSION_DATE = PROG_VERSION[13:23]
 # unused: INVOCATION_TIME = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())
 FILENAME_TAG_SEPARATOR = ' -- '
 BETWEEN_TAG_SEPARATOR = ' '
 CONTROLLED_VOCABULARY_FILENAME = ".filetags"
+TAG_INDEX_FILENAME = ".filetags_index"
+TAG_INDEX_SCHEMA_VERSION = '1'
+TAG_INDEX_RACY_MTIME_SECONDS = 2  # directories modified more recently than this are not trusted in the index
 HINT_FOR_BEING_IN_VOCABULARY_TEMPLATE = ' *'
 TAGFILTER_DIRECTORY = os.path.join(os.path.expanduser("~"), ".filetags_tagfilter")
+JOURNAL_FILENAME = os.path.join(os.path.expanduser("~"), ".filetags_journal")
+DAEMON_SOCKET_FILENAME = os.path.join(os.path.expanduser("~"), ".filetags_daemon")
+JOURNAL_CHECKPOINT_INTERVAL = 1000  # number of batch renames that are synced to the journal at once
+DEFAULT_TRAVERSAL_JOBS = 1  # threads listing directories in parallel for recursive traversals; pays off on network file systems
+SCAN_CACHE_MAX_SCANS = 32  # number of directory scans kept in memory by the scan cache
+SCAN_CACHE_MAX_FILES = 1000000  # memory cap of the scan cache: number of file records of all cached scans
+TAGTREES_MARKER_FILENAME = '.filetags_tagtrees'  # marks tagtrees directories and holds their manifest
+TAGTREES_MANIFEST_VERSION = 2
+TAGTREES_LAYOUTS = ['permutations', 'combinations']  # the first one is the default
+COMPLETION_MODES = ['prefix', 'ignorecase', 'substring']  # the first one is the default
+COMPLETER_CACHE_SIZE = 256  # number of entered texts whose completions are kept
+FILES_FROM_CHUNK_SIZE = 10000  # number of file names of --files-from that are processed at once
+FILES_FROM_READ_SIZE = 65536  # number of bytes that are read at once for --files-from
+TAGTREES_CALIBRATION_SYSCALLS = 200  # number of mkdir() and symlink() calls for measuring the file system speed for --plan
+TAGTREES_DEFAULT_SYSCALL_SECONDS = 0.00005  # assumed duration of one mkdir() or symlink() when nothing is measured
+TAGTREES_LINKS_PER_TASK = 256  # number of links one thread creates in one go; amortizes the overhead per task
+TAGTREES_PROGRESS_INTERVAL_SECONDS = 2  # minimum time between two progress reports while creating links
+TAGTREES_VIEW_MAX_AGE_SECONDS = 1  # a TagtreesView checks its scan for changes at most this often
 DEFAULT_TAGTREES_MAXDEPTH = 2  # be careful when making this more than 2: exponential growth of time/links with number of tags!
 DEFAULT_IMAGE_VIEWER_LINUX = 'geeqie'
 DEFAULT_IMAGE_VIEWER_WINDOWS = 'explorer'
 TAG_LINK_ORIGINALS_WHEN_TAGGING_LINKS = True
-IS_WINDOWS = False
-
-# Determining the window size of the terminal:
-if platform.system() == 'Windows':
-    TTY_HEIGHT, TTY_WIDTH = 80, 80  # fall-back values
-    IS_WINDOWS = True
-else:
-    # check to avoid stty error when stdin is not a terminal.
-    if sys.stdin.isatty():
-        try:
-            TTY_HEIGHT, TTY_WIDTH = [int(x) for x in os.popen('stty size', 'r').read().split()]
-        except ValueError:
-            TTY_HEIGHT, TTY_WIDTH = 80, 80  # fall-back values
-    else:
-        TTY_HEIGHT, TTY_WIDTH = 80, 80
+SIMILAR_TAGS_CUTOFF = 0.7  # minimum difflib ratio of two tags being similar
+SIMILAR_TAGS_MAX_MATCHES = 999  # maximum number of similar tags of one tag
+SIMILAR_TAGS_BATCH_MIN_PAIRS = 1000000  # number of tag pairs from which on NumPy is used for finding similar tags if installed
+SIMILAR_TAGS_BATCH_CHUNK_PAIRS = 4194304  # number of tag pairs NumPy compares at once; limits the memory used
+
+# The window size of the terminal is determined in main():
+TTY_HEIGHT, TTY_WIDTH = 80, 80  # fall-back values
+IS_WINDOWS = platform.system() == 'Windows'
 
 max_file_length = 0  # will be set after iterating over source files182
 
@@ -113,6 +122,14 @@ do_not_suggest_tags = []  # list of lower-case strings
 INCLUDE_PREFIX = '#include '
 included_files = []
 
+# snapshots of parsed controlled vocabularies, see read_controlled_vocabulary_cached():
+VOCABULARY_CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                                          os.path.join(os.path.expanduser("~"), '.cache'), 'filetags')
+VOCABULARY_CACHE_VERSION = 1
+VOCABULARY_CACHE_MIN_BYTES = 16384  # smaller vocabularies are parsed faster than their snapshot is read from disk
+VOCABULARY_CACHE_RACY_MTIME_SECONDS = 2  # vocabulary files modified more recently than this are not cached
+vocabulary_cache = {}  # (real path, real directory of the includes) → snapshot tuple
+
 DESCRIPTION = "This tool adds or removes simple tags to/from file names.\n\
 \n\
 Tags within file names are placed between the actual file name and\n\
@@ -160,6 +177,8 @@ FILE_WITH_EXTENSION_REGEX = re.compile(r'(.*)\.(.*)$')
 FILE_WITH_EXTENSION_REGEX_FILENAME_INDEX = 1
 FILE_WITH_EXTENSION_REGEX_EXTENSION_INDEX = 2
 
+PARSED_NAME_CACHE_SIZE = 65536  # number of memoized ParsedName objects, see parse_basename()
+
 YYYY_MM_DD_PATTERN = re.compile(r'^(\d{4,4})-([01]\d)-([0123]\d)[- _T]')
 
 # Tag-style time-stamp denoting a cut-out section of a larger video file,
@@ -167,8 +186,15 @@ YYYY_MM_DD_PATTERN = re.compile(r'^(\d{4,4})-([01]\d)-([0123]\d)[- _T]')
 CUT_TIMESTAMP_REGEX = re.compile(r'^\d{2}h\d{2}m\d{2}s-{1,2}\d{2}h\d{2}m\d{2}s$')
 CUT_TIMESTAMP_PSEUDO_TAG = 'cuttimes'
 
-cache_of_tags_by_folder = {}
-cache_of_files_with_metadata = {}  # dict of big list of dicts: 'filename', 'path' and other metadata
+QUERY_TOKEN_REGEX = re.compile(r'\s*(?:(\(|\))|((?:path:)?"[^"]*")|([^\s()"]+))')  # parenthesis, quoted term, term
+QUERY_DATE_REGEX = re.compile(r'^date(<=|>=|=|<|>)(\d{4}(-[01]\d(-[0123]\d)?)?)$')
+QUERY_PATHTAG_PREFIX = 'path:'
+
+scan_cache = None  # ScanCache of the TagScan objects, see get_tag_scan()
+rename_journal = None  # RenameJournal of the current run when --journal is used
+similar_tags_cache = None  # SimilarTagsCache of the current run, see get_similar_tags_cache()
+daemon_is_serving = False  # True within the process of --daemon which must not forward requests to itself
+open_tag_indexes = {}  # dict of PersistentTagIndex objects by their file name
 controlled_vocabulary_filename = ''
 list_of_link_directories = []
 chosen_tagtrees_dir = False  # holds the definitive choice for a destination folder for filtering or tagtrees
@@ -189,6 +215,38 @@ parser.add_argument("-t", "--tags",
                     required=False,
                     help="One or more tags (in quotes, separated by spaces) to add/remove")
 
+parser.add_argument("--files-from",
+                    dest="files_from",
+                    nargs=1,
+                    metavar='FILE',
+                    required=False,
+                    help="Read the files to tag from FILE (one per line) or from standard input if FILE is \"-\". " +
+                    "The list is processed in chunks so that arbitrarily long lists can be tagged with one " +
+                    "process. Requires --tags.")
+
+parser.add_argument("-0", "--null",
+                    dest="null_separated",
+                    action="store_true",
+                    help="With --files-from, the file names are separated by NUL characters instead of newlines " +
+                    "(like \"find -print0\" produces).")
+
+parser.add_argument("--journal",
+                    dest="journal",
+                    action="store_true",
+                    help="Write all renames and re-links to the journal file \"" + JOURNAL_FILENAME + "\" " +
+                    "before they are applied. When a run gets interrupted, the journal remains and can be " +
+                    "completed with --resume or undone with --rollback.")
+
+parser.add_argument("--resume",
+                    dest="resume",
+                    action="store_true",
+                    help="Complete the renames and re-links of the journal of an interrupted run.")
+
+parser.add_argument("--rollback",
+                    dest="rollback",
+                    action="store_true",
+                    help="Undo all renames and re-links of the journal of an interrupted run.")
+
 parser.add_argument("--remove", action="store_true",
                     help="Remove tags from (instead of adding to) file name(s)")
 
@@ -198,10 +256,33 @@ parser.add_argument("-i", "--interactive", action="store_true", dest="interactiv
 parser.add_argument("--gui", action="store_true", dest="gui",
                     help="In interactive mode: use a GUI dialog instead of the text based version")
 
+parser.add_argument("--completion",
+                    dest="completion",
+                    nargs=1,
+                    type=str,
+                    choices=COMPLETION_MODES,
+                    required=False,
+                    help="In interactive mode: \"prefix\" (default) completes the tags starting with the " +
+                    "entered text with TAB, \"ignorecase\" ignores upper and lower case and \"substring\" " +
+                    "offers the tags containing the text as well.")
+
 parser.add_argument("-R", "--recursive", dest="recursive", action="store_true",
                     help="Recursively go through the current directory and all of its subdirectories. " +
                     "Implemented for --tag-gardening and --tagtrees")
 
+parser.add_argument("--jobs", dest="jobs", nargs=1, type=int, metavar='N',
+                    help="Number of threads listing directories in parallel when traversing " +
+                    "directories recursively and creating the links of tagtrees " +
+                    "(default: " + str(DEFAULT_TRAVERSAL_JOBS) + "). " +
+                    "Values like 8 or 16 speed up scans and tagtrees on network file systems such as NFS where " +
+                    "each system call has a high latency. On local disks, one thread is usually fastest.")
+
+parser.add_argument("--index", dest="index", action="store_true",
+                    help="Keep a persistent index file \"" + TAG_INDEX_FILENAME + "\" next to the " +
+                    "controlled vocabulary (or in the current directory if there is none) so that " +
+                    "later runs only have to re-read directories that changed in between. " +
+                    "Speeds up --ln, --la, --lu, --tag-gardening, --filter and --tagtrees on large hierarchies")
+
 parser.add_argument("-s", "--dryrun", dest="dryrun", action="store_true",
                     help="Enable dryrun mode: just simulate what would happen, do not modify files")
 
@@ -217,6 +298,14 @@ parser.add_argument("-f", "--filter", dest="tagfilter", action="store_true",
                     "containing links to all files with matching tags and start the filebrowser. " +
                     "Target directory can be overridden by --tagtrees-dir.")
 
+parser.add_argument("--query", dest="query", nargs=1, type=str, metavar='"QUERY"',
+                    help="Like --filter but with the files matching QUERY instead of asking for tags. " +
+                    "Tags can be combined with AND, OR, NOT and parentheses; \"path:tag\" matches tags of " +
+                    "the directories and \"date>=2020-01\" (also =, <, <=, >) the ISO datestamps of file names. " +
+                    "Example: \"car AND (red OR blue) AND NOT draft AND date>=2020-01\". " +
+                    "Tags containing parentheses or looking like an operator or term are quoted: " +
+                    "'\"foo(bar)\" OR \"AND\" OR path:\"date<x\"'.")
+
 parser.add_argument("--filebrowser", dest="filebrowser", metavar='PATH_TO_FILEBROWSER',
                     help="Use this option to override the tool to view/manage files (for --filter; default: " +
                     DEFAULT_IMAGE_VIEWER_LINUX + "). Use \"none\" to omit the default one.")
@@ -264,6 +353,64 @@ parser.add_argument("--tagtrees-dir",
                     "non-existing directory which will be created. " +
                     "This also overrides the default directory for --filter.")
 
+parser.add_argument("--tagtrees-incremental",
+                    dest="tagtrees_incremental",
+                    action="store_true",
+                    help="When tagtrees are re-generated in a directory that holds tagtrees of a previous run, " +
+                    "only the links and directories that changed since then are removed and created " +
+                    "instead of deleting and re-creating the whole directory.")
+
+parser.add_argument("--tagtrees-layout",
+                    dest="tagtrees_layout",
+                    nargs=1,
+                    type=str,
+                    choices=TAGTREES_LAYOUTS,
+                    required=False,
+                    help="When tagtrees are created, \"permutations\" (default) creates a directory for every " +
+                    "ordering of the tags of an item (\"a/b\" and \"b/a\"). \"combinations\" creates only the " +
+                    "directories with tags in alphabetical order (\"a/b\") which needs far fewer links " +
+                    "for deep tagtrees. See also --tagtrees-link-orderings.")
+
+parser.add_argument("--tagtrees-link-orderings",
+                    dest="tagtrees_link_orderings",
+                    action="store_true",
+                    help="With \"--tagtrees-layout combinations\", the other orderings of tags are added as " +
+                    "symbolic links to the directory with the alphabetical order (\"b/a\" links to \"a/b\").")
+
+parser.add_argument("--plan",
+                    dest="tagtrees_plan",
+                    action="store_true",
+                    help="With --tagtrees, only print the number of directories and links per depth, the " +
+                    "number of inodes and the projected runtime of generating the tagtrees without touching " +
+                    "the tagtrees directory. With --dryrun, the runtime is a default estimate instead of " +
+                    "being measured next to the tagtrees directory.")
+
+parser.add_argument("--tagtrees-budget",
+                    dest="tagtrees_budget",
+                    nargs=1,
+                    type=int,
+                    metavar='INODES',
+                    required=False,
+                    help="When tagtrees are created, this limits the number of inodes (directories and " +
+                    "symbolic links) to create. If the tagtrees would need more, the depth is lowered until " +
+                    "they fit. See also --tagtrees-budget-abort.")
+
+parser.add_argument("--tagtrees-budget-abort",
+                    dest="tagtrees_budget_abort",
+                    action="store_true",
+                    help="Abort instead of lowering the depth when the tagtrees exceed --tagtrees-budget.")
+
+parser.add_argument("--tagtrees-mount",
+                    dest="tagtrees_mount",
+                    nargs=1,
+                    type=str,
+                    metavar='<mountpoint>',
+                    required=False,
+                    help="Instead of generating tagtrees, serve them as read-only file system at the " +
+                    "given mount point until it gets unmounted. Directory listings are computed on demand " +
+                    "and always reflect the current file names. The depth is unlimited unless " +
+                    "--tagtrees-depth is given. Requires FUSE and the Python module fusepy.")
+
 parser.add_argument("--tagtrees-depth",
                     dest="tagtrees_depth",
                     nargs=1,
@@ -298,6 +445,13 @@ parser.add_argument("--force-cv",
                     dest="force_cv", action="store_true",
                     help="Only allow tags that are part of the controlled vocabulary (.filetags)")
 
+parser.add_argument("--daemon",
+                    dest="daemon", action="store_true",
+                    help="Keep running and handle the non-interactive invocations of filetags (adding or " +
+                    "removing tags with --tags, listing tags, tag gardening) which are forwarded to the " +
+                    "Unix socket \"" + DAEMON_SOCKET_FILENAME + "\". This saves the start-up time and " +
+                    "keeps the directory scans in memory. Stop the daemon with Ctrl-C or SIGTERM.")
+
 parser.add_argument("-v", "--verbose",
                     dest="verbose", action="store_true",
                     help="Enable verbose mode")
@@ -310,7 +464,51 @@ parser.add_argument("--version",
                     dest="version", action="store_true",
                     help="Display version and exit")
 
-options = parser.parse_args()
+options = parser.parse_args([])  # the defaults until main() parses the command line
+
+
+def import_tkinter():
+    """
+    Imports tkinter for the --gui option.
+
+    @param return: True if tkinter is available
+    """
+
+    global tk, ttk, font
+    try:
+        import tkinter as tk
+        from tkinter import ttk, font
+    except ModuleNotFoundError:
+        return False
+    return True
+
+
+def import_numpy():
+    """
+    Imports NumPy for finding similar tags of many tags at once. NumPy
+    is optional; without it, SimilarTagIndex looks up each tag.
+
+    @param return: True if NumPy is available
+    """
+
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+def get_windows_shell():
+    "Returns the WScript.Shell object for handling Windows lnk files."
+
+    try:
+        import win32com.client
+    except ImportError:
+        print("Could not find Python module \"win32com.client\".\nPlease install it, e.g., " +
+              "with \"sudo pip install pypiwin32\".")
+        sys.exit(3)
+    return win32com.client.Dispatch('WScript.Shell')
 
 
 def handle_logging():
@@ -337,28 +535,81 @@ def error_exit(errorcode, text):
 
 
 class SimpleCompleter(object):
+    """
+    Completes tags for readline. The options are kept sorted so that
+    the tags starting with the entered text are found by bisection
+    instead of checking each tag. The matches are cached per text
+    because readline asks for them once per state.
+
+    mode "prefix" completes tags starting with the text, "ignorecase"
+    does the same ignoring the case and "substring" adds the tags
+    which contain the text elsewhere after those starting with it.
+    """
     # happily stolen from http://pymotw.com/2/readline/
 
-    def __init__(self, options):
-        self.options = sorted(options)
+    def __init__(self, options, mode=COMPLETION_MODES[0]):
+        assert(mode in COMPLETION_MODES)
+        self.options = sorted(set(options))
+        self.mode = mode
+        self.matches = []
+        self.cache = {}  # text → list of matches
+        if mode == 'ignorecase':
+            folded_options = sorted((option.casefold(), option) for option in self.options)
+            self.folded_keys = [folded for folded, option in folded_options]
+            self.folded_options = [option for folded, option in folded_options]
 
         # removing '-' as a delimiter character in order to be able to use '-tagname' for removing:
+        safe_import('readline')
         readline.set_completer_delims(readline.get_completer_delims().replace('-', ''))
 
         return
 
+    @staticmethod
+    def get_prefix_range(keys, prefix):
+        """
+        @param keys: sorted list of strings
+        @param prefix: string
+        @param return: start and stop index of the keys starting with prefix
+        """
+
+        start = bisect.bisect_left(keys, prefix)
+        if prefix and prefix[-1] != chr(sys.maxunicode):
+            # the smallest string after all strings starting with prefix:
+            return start, bisect.bisect_left(keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        stop = start
+        while stop < len(keys) and keys[stop].startswith(prefix):
+            stop += 1
+        return start, stop
+
+    def get_matches(self, text):
+        """
+        @param text: the entered text
+        @param return: list of the options matching text according to the mode
+        """
+
+        if text in self.cache:
+            return self.cache[text]
+
+        if self.mode == 'ignorecase':
+            start, stop = self.get_prefix_range(self.folded_keys, text.casefold())
+            matches = self.folded_options[start:stop]
+        else:
+            start, stop = self.get_prefix_range(self.options, text)
+            matches = self.options[start:stop]
+            if self.mode == 'substring' and text:
+                matches = matches + [s for s in self.options if text in s and not s.startswith(text)]
+
+        if len(self.cache) >= COMPLETER_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[text] = matches
+        return matches
+
     def complete(self, text, state):
         response = None
         if state == 0:
             # This is the first time for this text, so build a match list.
-            if text:
-                self.matches = [s
-                                for s in self.options
-                                if s and s.startswith(text)]
-                logging.debug('%s matches: %s', repr(text), self.matches)
-            else:
-                self.matches = self.options[:]
-                logging.debug('(empty input) matches: %s', self.matches)
+            self.matches = [s for s in self.get_matches(text) if s]
+            logging.debug('%s matches: %i', repr(text), len(self.matches))
 
         # Return the state'th item from the match list,
         # if we have that many.
@@ -648,6 +899,85 @@ class TagDialog:
         self.root.destroy()
 
 
+class ParsedName(object):
+    """
+    The components of a file name (without path) according to the
+    filetags naming scheme. Parsing is a pure string operation which
+    never accesses the file system.
+
+    For "2018-03-18 foo -- bar baz.txt.lnk", the attributes are:
+      basename: '2018-03-18 foo -- bar baz.txt.lnk'
+      basename_without_lnk: '2018-03-18 foo -- bar baz.txt'
+      is_lnk: True
+      tags: ('bar', 'baz'); empty tuple when there is no tag
+      name: '2018-03-18 foo'; None when there is no tag
+      extension: 'txt'; None when there is no (tagged) extension
+      name_without_extension: '2018-03-18 foo -- bar baz'; None when there is no extension
+      raw_extension: 'txt'; None when there is no extension
+
+    The tag related attributes follow FILE_WITH_TAGS_REGEX, the
+    extension related attributes follow FILE_WITH_EXTENSION_REGEX.
+    """
+
+    __slots__ = ('basename', 'basename_without_lnk', 'is_lnk', 'tags', 'name', 'extension',
+                 'name_without_extension', 'raw_extension')
+
+    def __init__(self, basename):
+        """
+        @param basename: an unicode string containing a file name without path
+        """
+
+        self.basename = basename
+        self.is_lnk = is_lnk_file(basename)
+        self.basename_without_lnk = basename[:-4] if self.is_lnk else basename
+
+        components = re.match(FILE_WITH_TAGS_REGEX, self.basename_without_lnk)
+        if components:
+            self.tags = intern_tags(components.group(FILE_WITH_TAGS_REGEX_TAGLIST_INDEX).split(BETWEEN_TAG_SEPARATOR))
+            self.name = components.group(FILE_WITH_TAGS_REGEX_FILENAME_INDEX)
+            self.extension = components.group(FILE_WITH_TAGS_REGEX_EXTENSION_INDEX)
+        else:
+            self.tags = ()
+            self.name = None
+            self.extension = None
+
+        components = re.match(FILE_WITH_EXTENSION_REGEX, self.basename_without_lnk)
+        if components:
+            self.name_without_extension = components.group(FILE_WITH_EXTENSION_REGEX_FILENAME_INDEX)
+            self.raw_extension = components.group(FILE_WITH_EXTENSION_REGEX_EXTENSION_INDEX)
+        else:
+            self.name_without_extension = None
+            self.raw_extension = None
+
+    def __repr__(self):
+        return 'ParsedName(%r)' % self.basename
+
+
+@functools.lru_cache(maxsize=PARSED_NAME_CACHE_SIZE)
+def parse_basename(basename):
+    """
+    Returns the memoized ParsedName of basename. Since ParsedName
+    objects are shared, they must not be modified.
+
+    @param basename: an unicode string containing a file name without path
+    @param return: ParsedName
+    """
+
+    return ParsedName(basename)
+
+
+def parse_filename(filename):
+    """
+    Returns the ParsedName of the basename of filename without
+    accessing the file system.
+
+    @param filename: an unicode string containing a file name with optional path
+    @param return: ParsedName
+    """
+
+    return parse_basename(os.path.basename(filename))
+
+
 def contains_tag(filename, tagname=False):
     """
     Returns true if tagname is a tag within filename. If tagname is
@@ -662,18 +992,15 @@ def contains_tag(filename, tagname=False):
     if tagname:
         assert(tagname.__class__ == str)
 
-    filename, dirname, basename, basename_without_lnk = split_up_filename(filename)
-
-    components = re.match(FILE_WITH_TAGS_REGEX, os.path.basename(basename_without_lnk))
+    parsed = parse_filename(filename)
 
     if not tagname:
-        return components is not None
-    elif not components:
+        return len(parsed.tags) > 0
+    elif not parsed.tags:
         logging.debug("file [%s] does not match FILE_WITH_TAGS_REGEX" % filename)
         return False
     else:
-        tags = components.group(FILE_WITH_TAGS_REGEX_TAGLIST_INDEX).split(BETWEEN_TAG_SEPARATOR)
-        return tagname in tags
+        return tagname in parsed.tags
 
 
 def extract_tags_from_filename(filename):
@@ -687,14 +1014,7 @@ def extract_tags_from_filename(filename):
 
     assert(filename.__class__ == str)
 
-    filename, dirname, basename, basename_without_lnk = split_up_filename(filename)
-
-    components = re.match(FILE_WITH_TAGS_REGEX, basename_without_lnk)
-
-    if not components:
-        return []
-    else:
-        return components.group(FILE_WITH_TAGS_REGEX_TAGLIST_INDEX).split(BETWEEN_TAG_SEPARATOR)
+    return list(parse_filename(filename).tags)
 
 
 def extract_tags_from_path(path):
@@ -768,29 +1088,22 @@ def adding_tag_to_filename(filename, tagname):
     assert(filename.__class__ == str)
     assert(tagname.__class__ == str)
 
-    filename, dirname, basename, basename_without_lnk = split_up_filename(filename)
+    dirname = os.path.dirname(filename)
+    parsed = parse_filename(filename)
+    lnk_extension = '.lnk' if parsed.is_lnk else ''
 
-    if contains_tag(basename_without_lnk) is False:
+    if not parsed.tags:
         logging.debug("adding_tag_to_filename(%s, %s): no tag found so far" % (filename, tagname))
 
-        components = re.match(FILE_WITH_EXTENSION_REGEX, basename_without_lnk)
-        if components:
-            old_basename = components.group(FILE_WITH_EXTENSION_REGEX_FILENAME_INDEX)
-            extension = components.group(FILE_WITH_EXTENSION_REGEX_EXTENSION_INDEX)
-            if is_lnk_file(filename):
-                return os.path.join(dirname, old_basename + FILENAME_TAG_SEPARATOR +
-                                    tagname + '.' + extension + '.lnk')
-            else:
-                return os.path.join(dirname, old_basename + FILENAME_TAG_SEPARATOR +
-                                    tagname + '.' + extension)
+        if parsed.raw_extension is not None:
+            return os.path.join(dirname, parsed.name_without_extension + FILENAME_TAG_SEPARATOR +
+                                tagname + '.' + parsed.raw_extension + lnk_extension)
         else:
             # filename has no extension
-            if is_lnk_file(filename):
-                return os.path.join(dirname, basename_without_lnk + FILENAME_TAG_SEPARATOR + tagname + '.lnk')
-            else:
-                return os.path.join(dirname, basename + FILENAME_TAG_SEPARATOR + tagname)
+            return os.path.join(dirname, parsed.basename_without_lnk + FILENAME_TAG_SEPARATOR +
+                                tagname + lnk_extension)
 
-    elif contains_tag(basename_without_lnk, tagname):
+    elif tagname in parsed.tags:
         logging.debug("adding_tag_to_filename(%s, %s): tag already found in filename" % (filename, tagname))
 
         return filename
@@ -799,19 +1112,12 @@ def adding_tag_to_filename(filename, tagname):
         logging.debug("adding_tag_to_filename(%s, %s): add as additional tag to existing list of tags" %
                       (filename, tagname))
 
-        components = re.match(FILE_WITH_EXTENSION_REGEX, basename_without_lnk)
-        new_filename = False
-        if components:
-            old_basename = components.group(FILE_WITH_EXTENSION_REGEX_FILENAME_INDEX)
-            extension = components.group(FILE_WITH_EXTENSION_REGEX_EXTENSION_INDEX)
-            new_filename = os.path.join(dirname, old_basename + BETWEEN_TAG_SEPARATOR +
-                                        tagname + '.' + extension)
-        else:
-            new_filename = os.path.join(dirname, basename_without_lnk + BETWEEN_TAG_SEPARATOR + tagname)
-        if is_lnk_file(filename):
-            return new_filename + '.lnk'
+        if parsed.raw_extension is not None:
+            return os.path.join(dirname, parsed.name_without_extension + BETWEEN_TAG_SEPARATOR +
+                                tagname + '.' + parsed.raw_extension + lnk_extension)
         else:
-            return new_filename
+            return os.path.join(dirname, parsed.basename_without_lnk + BETWEEN_TAG_SEPARATOR +
+                                tagname + lnk_extension)
 
 
 def removing_tag_from_filename(orig_filename, tagname):
@@ -826,37 +1132,24 @@ def removing_tag_from_filename(orig_filename, tagname):
     assert(orig_filename.__class__ == str)
     assert(tagname.__class__ == str)
 
-    if not contains_tag(orig_filename, tagname):
+    parsed = parse_filename(orig_filename)
+    if tagname not in parsed.tags:
         return orig_filename
 
-    filename, dirname, basename, basename_without_lnk = split_up_filename(orig_filename)
-    components = re.match(FILE_WITH_TAGS_REGEX, basename_without_lnk)
+    extension = '.' + parsed.extension if parsed.extension else ''
 
-    if not components:
-        logging.debug("file [%s] does not match FILE_WITH_TAGS_REGEX" % orig_filename)
-        return orig_filename
+    if len(parsed.tags) < 2:
+        logging.debug("given tagname is the only tag -> remove all tags and FILENAME_TAG_SEPARATOR as well")
+        new_filename = parsed.name + extension
     else:
-        tags = components.group(FILE_WITH_TAGS_REGEX_TAGLIST_INDEX).split(BETWEEN_TAG_SEPARATOR)
-        old_filename = components.group(FILE_WITH_TAGS_REGEX_FILENAME_INDEX)
-        extension = components.group(FILE_WITH_TAGS_REGEX_EXTENSION_INDEX)
-        if not extension:
-            extension = ''
-        else:
-            extension = '.' + extension
-
-        new_filename = False
-        if len(tags) < 2:
-            logging.debug("given tagname is the only tag -> remove all tags and FILENAME_TAG_SEPARATOR as well")
-            new_filename = old_filename + extension
-        else:
-            # still tags left
-            new_filename = old_filename + FILENAME_TAG_SEPARATOR + \
-                BETWEEN_TAG_SEPARATOR.join([tag for tag in tags if tag != tagname]) + extension
+        # still tags left
+        new_filename = parsed.name + FILENAME_TAG_SEPARATOR + \
+            BETWEEN_TAG_SEPARATOR.join([tag for tag in parsed.tags if tag != tagname]) + extension
 
-        if is_lnk_file(orig_filename):
-            return new_filename + '.lnk'
-        else:
-            return new_filename
+    if parsed.is_lnk:
+        return new_filename + '.lnk'
+    else:
+        return new_filename
 
 
 def filename_contains_cut_timestamp(filename):
@@ -1052,7 +1345,7 @@ def is_nonbroken_link(filename):
     if IS_WINDOWS:
         # do lnk-files instead of symlinks:
         if is_lnk_file(filename):
-            shell = win32com.client.Dispatch('WScript.Shell')
+            shell = get_windows_shell()
             shortcut = shell.CreateShortCut(filename)
             lnk_destination = shortcut.Targetpath
             # FIXXME: check if link destination is another lnk file or not
@@ -1081,7 +1374,7 @@ def get_link_source_file(filename):
 
     if IS_WINDOWS:
         assert(is_lnk_file(filename))
-        shell = win32com.client.Dispatch("WScript.Shell")
+        shell = get_windows_shell()
         shortcut = shell.CreateShortCut(filename)
         original_file = shortcut.Targetpath
         assert(len(shortcut.Targetpath)>0)  # only continue if it is a lnk file
@@ -1111,7 +1404,7 @@ def is_broken_link(filename):
 
     if IS_WINDOWS:
         if is_lnk_file(filename):
-            shell = win32com.client.Dispatch("WScript.Shell")
+            shell = get_windows_shell()
             shortcut = shell.CreateShortCut(filename)
             original_file = shortcut.Targetpath
             assert(len(shortcut.Targetpath)>0)  # only continue if it is a valid lnk file
@@ -1200,9 +1493,7 @@ def handle_file_and_optional_link(orig_filename, tags, do_remove, do_filter, dry
     """
 
     num_errors = 0
-    original_dir = os.getcwd()
     logging.debug("handle_file_and_optional_link(\"" + orig_filename + "\") …  " + '★' * 20)
-    logging.debug('handle_file_and_optional_link: original directory = ' + original_dir)
 
     if os.path.isdir(orig_filename):
         logging.warning("Skipping directory \"%s\" because this tool only renames file names." % orig_filename)
@@ -1227,22 +1518,18 @@ def handle_file_and_optional_link(orig_filename, tags, do_remove, do_filter, dry
         else:
             logging.info("Could not find basename \"%s\" but found \"%s\" instead which starts with same substring ..." %
                          (filename, alternative_filename))
-            filename, dirname, basename, basename_without_lnk = split_up_filename(alternative_filename)
-
-    if dirname and os.getcwd() != dirname:
-        logging.debug("handle_file_and_optional_link: changing to dir \"%s\"" % dirname)
-        os.chdir(dirname)
-    # else:
-    #     logging.debug("handle_file_and_optional_link: no dirname found or os.getcwd() is dirname")
+            filename, dirname, basename, basename_without_lnk = \
+                split_up_filename(os.path.join(os.path.dirname(filename), alternative_filename))
 
     # if basename is a link and has same basename, tag the source file as well:
     if TAG_LINK_ORIGINALS_WHEN_TAGGING_LINKS and is_nonbroken_link(filename):
         logging.debug('handle_file_and_optional_link: file is a non-broken link (and ' +
                       'TAG_LINK_ORIGINALS_WHEN_TAGGING_LINKS is set)')
 
+        # relative link targets are relative to the directory of the link:
         old_source_filename, old_source_dirname, \
             old_source_basename, old_source_basename_without_lnk = \
-                split_up_filename(get_link_source_file(filename))
+                split_up_filename(os.path.join(dirname, get_link_source_file(filename)))
 
         linkbasename_same_as_originalbasename = False
         if is_lnk_file(basename):
@@ -1286,23 +1573,25 @@ def handle_file_and_optional_link(orig_filename, tags, do_remove, do_filter, dry
                     logging.debug('handle_file_and_optional_link: re-linking link "' + new_filename +
                                   '" from the old sourcefilename "' +
                                   old_source_filename + '" to the new one "' + new_source_filename + '"')
+                    if rename_journal:
+                        rename_journal.log([['relink', filename, new_filename,
+                                             get_link_source_file(filename), new_source_filename]])
                     os.remove(filename)
                     create_link(new_source_filename, new_filename)
+                    if rename_journal:
+                        rename_journal.checkpoint()
                 # we've already handled the link source and created the updated link, return now without calling handle_file once more ...
-                os.chdir(dirname)  # go back to original dir after handling links of different directories
                 return num_errors, new_filename
             else:
                 logging.debug('handle_file_and_optional_link: The old sourcefilename "' +
                               old_source_filename +
                               '" did not change. So therefore I don\'t re-link.')
                 # we've already handled the link source and created the updated link, return now without calling handle_file once more ...
-                os.chdir(dirname)  # go back to original dir after handling links of different directories
                 return num_errors, old_source_filename
         else:
             logging.debug('handle_file_and_optional_link: The file "' + filename +
                           '" is a link to "' + old_source_filename +
                           '" but they two do have different basenames. Therefore I ignore the original file.')
-        os.chdir(dirname)  # go back to original dir after handling links of different directories
     else:
         logging.debug('handle_file_and_optional_link: file is not a non-broken link (' +
                       repr(is_nonbroken_link(basename)) + ') or TAG_LINK_ORIGINALS_WHEN_TAGGING_LINKS is not set')
@@ -1312,8 +1601,6 @@ def handle_file_and_optional_link(orig_filename, tags, do_remove, do_filter, dry
 
     new_filename = handle_file(filename, tags, do_remove, do_filter, dryrun)
 
-    logging.debug('handle_file_and_optional_link: switching back to original directory = ' + original_dir)
-    os.chdir(original_dir)  # reset working directory
     logging.debug("handle_file_and_optional_link(\"" + orig_filename + "\") FINISHED  " + '★' * 20)
     return num_errors, new_filename
 
@@ -1357,7 +1644,7 @@ def create_link(source, destination):
 
     if IS_WINDOWS:
         # do lnk-files instead of symlinks:
-        shell = win32com.client.Dispatch('WScript.Shell')
+        shell = get_windows_shell()
         if is_lnk_file(destination):
             # prevent multiple '.lnk' extensions from happening
             # FIXXME: I'm not sure whether or not multiple '.lnk' extensions are a valid use-case: check!
@@ -1383,6 +1670,69 @@ def create_link(source, destination):
             os.symlink(source, destination)
 
 
+def get_new_basename(basename, tags, do_remove, unique_tags_groups=None):
+    """
+    Derives the new basename of an item when tags are added or removed.
+    This does not touch the file system.
+
+    @param basename: string containing one basename
+    @param tags: list containing one or more tags; tags starting with '-' get removed
+    @param do_remove: boolean which defines if tags should be added (False) or removed (True)
+    @param unique_tags_groups: list of lists of mutually exclusive tags; default: unique_tags of the controlled vocabulary
+    @param return: the new basename
+    """
+
+    if unique_tags_groups is None:
+        unique_tags_groups = unique_tags
+    new_basename = basename
+
+    for tagname in tags:
+        if tagname.strip() == '':
+            continue
+        if do_remove:
+            if tagname == CUT_TIMESTAMP_PSEUDO_TAG:
+                new_basename = removing_cut_timestamps_from_filename(new_basename)
+                logging.debug('get_new_basename: set new_basename [' + new_basename + '] after removing cut time-stamps')
+            else:
+                new_basename = removing_tag_from_filename(new_basename, tagname)
+                logging.debug('get_new_basename: set new_basename [' + new_basename + '] when do_remove')
+        elif tagname[0] == '-':
+            if tagname[1:] == CUT_TIMESTAMP_PSEUDO_TAG:
+                new_basename = removing_cut_timestamps_from_filename(new_basename)
+                logging.debug('get_new_basename: set new_basename [' + new_basename + '] after removing cut time-stamps via minus prefix')
+            else:
+                new_basename = removing_tag_from_filename(new_basename, tagname[1:])
+                logging.debug('get_new_basename: set new_basename [' + new_basename + '] when tag starts with a minus')
+        else:
+            # FIXXME: not performance optimized for large number of unique tags in many lists:
+            tag_in_unique_tags, matching_unique_tag_list = \
+                item_contained_in_list_of_lists(tagname, unique_tags_groups)
+
+            if tagname != tag_in_unique_tags:
+                new_basename = adding_tag_to_filename(new_basename, tagname)
+                logging.debug('get_new_basename: set new_basename [' + new_basename +
+                              '] when tagname != tag_in_unique_tags')
+            else:
+                # if tag within unique_tags found, and new unique tag is given, remove old tag:
+                # e.g.: unique_tags = (u'yes', u'no') -> if 'no' should be added, remove existing tag 'yes' (and vice versa)
+                # If user enters contradicting tags, only the last one will be applied.
+                # FIXXME: this is an undocumented feature -> please add proper documentation
+
+                current_filename_tags = extract_tags_from_filename(new_basename)
+                conflicting_tags = list(set(current_filename_tags).intersection(matching_unique_tag_list))
+                logging.debug("get_new_basename: found unique tag %s which require old unique tag(s) to be removed: %s" %
+                              (tagname, repr(conflicting_tags)))
+                for conflicting_tag in conflicting_tags:
+                    new_basename = removing_tag_from_filename(new_basename, conflicting_tag)
+                    logging.debug('get_new_basename: set new_basename [' + new_basename +
+                                  '] when conflicting_tag in conflicting_tags')
+                new_basename = adding_tag_to_filename(new_basename, tagname)
+                logging.debug('get_new_basename: set new_basename [' + new_basename +
+                              '] after adding_tag_to_filename()')
+
+    return new_basename
+
+
 def handle_file(orig_filename, tags, do_remove, do_filter, dryrun):
     """
     @param orig_filename: string containing one file name with absolute path
@@ -1414,54 +1764,7 @@ def handle_file(orig_filename, tags, do_remove, do_filter, dryrun):
             create_link(filename, os.path.join(chosen_tagtrees_dir, basename))
 
     else:  # add or remove tags:
-        new_basename = basename
-        logging.debug('handle_file: set new_basename [' + new_basename +
-                      '] according to parameters (initialization)')
-
-        for tagname in tags:
-            if tagname.strip() == '':
-                continue
-            if do_remove:
-                if tagname == CUT_TIMESTAMP_PSEUDO_TAG:
-                    new_basename = removing_cut_timestamps_from_filename(new_basename)
-                    logging.debug('handle_file: set new_basename [' + new_basename + '] after removing cut time-stamps')
-                else:
-                    new_basename = removing_tag_from_filename(new_basename, tagname)
-                    logging.debug('handle_file: set new_basename [' + new_basename + '] when do_remove')
-            elif tagname[0] == '-':
-                if tagname[1:] == CUT_TIMESTAMP_PSEUDO_TAG:
-                    new_basename = removing_cut_timestamps_from_filename(new_basename)
-                    logging.debug('handle_file: set new_basename [' + new_basename + '] after removing cut time-stamps via minus prefix')
-                else:
-                    new_basename = removing_tag_from_filename(new_basename, tagname[1:])
-                    logging.debug('handle_file: set new_basename [' + new_basename + '] when tag starts with a minus')
-            else:
-                # FIXXME: not performance optimized for large number of unique tags in many lists:
-                tag_in_unique_tags, matching_unique_tag_list = \
-                    item_contained_in_list_of_lists(tagname, unique_tags)
-
-                if tagname != tag_in_unique_tags:
-                    new_basename = adding_tag_to_filename(new_basename, tagname)
-                    logging.debug('handle_file: set new_basename [' + new_basename +
-                                  '] when tagname != tag_in_unique_tags')
-                else:
-                    # if tag within unique_tags found, and new unique tag is given, remove old tag:
-                    # e.g.: unique_tags = (u'yes', u'no') -> if 'no' should be added, remove existing tag 'yes' (and vice versa)
-                    # If user enters contradicting tags, only the last one will be applied.
-                    # FIXXME: this is an undocumented feature -> please add proper documentation
-
-                    current_filename_tags = extract_tags_from_filename(new_basename)
-                    conflicting_tags = list(set(current_filename_tags).intersection(matching_unique_tag_list))
-                    logging.debug("handle_file: found unique tag %s which require old unique tag(s) to be removed: %s" %
-                                  (tagname, repr(conflicting_tags)))
-                    for conflicting_tag in conflicting_tags:
-                        new_basename = removing_tag_from_filename(new_basename, conflicting_tag)
-                        logging.debug('handle_file: set new_basename [' + new_basename +
-                                      '] when conflicting_tag in conflicting_tags')
-                    new_basename = adding_tag_to_filename(new_basename, tagname)
-                    logging.debug('handle_file: set new_basename [' + new_basename +
-                                  '] after adding_tag_to_filename()')
-
+        new_basename = get_new_basename(basename, tags, do_remove)
         new_filename = os.path.join(dirname, new_basename)
 
         if do_remove:
@@ -1479,214 +1782,1579 @@ def handle_file(orig_filename, tags, do_remove, do_filter, dryrun):
                 print_item_transition(dirname, basename, new_basename, transition=transition)
 
             if not dryrun:
-                os.rename(filename, new_filename)
+                rename_file(filename, new_filename)
 
         logging.debug("handle_file(\"" + filename + "\") " + '#' * 10 + "  finished")
         return new_filename
 
 
-def add_tag_to_countdict(tag, tags):
+class RenameJournal(object):
     """
-    Takes a tag (string) and a dict. Returns the dict with count value increased by one
-
-    @param tag: a (unicode) string
-    @param tags: dict of tags
-    @param return: dict of tags with incremented counter of tag (or 0 if new)
+    Write-ahead journal of the renames and re-links of one run: an
+    interrupted run can be completed (--resume) or undone (--rollback).
+
+    The journal file holds one JSON list per line. The operations
+    ["rename", source, destination] and
+    ["relink", link, new link, link target, new link target] are
+    written and synced to disk before they are applied.
+    ["checkpoint", n] marks that the first n operations were applied so
+    that resuming does not have to check them again.
     """
 
-    assert(tag.__class__ == str)
-    assert(tags.__class__ == dict)
+    def __init__(self, filename):
+        """
+        @param filename: the journal file which must not exist yet
+        """
 
-    if tag in list(tags.keys()):
-        tags[tag] = tags[tag] + 1
-    else:
-        tags[tag] = 1
+        self.filename = filename
+        self.handle = open(filename, 'x', encoding='utf-8')
+        self.num_operations = 0
+        self.num_applied = 0  # number of operations up to the last checkpoint
 
-    return tags
+    def log(self, operations):
+        """
+        @param operations: list of operations which are about to be applied
+        """
 
+        for operation in operations:
+            self.handle.write(json.dumps(operation) + '\n')
+        self.num_operations += len(operations)
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
 
-def extract_iso_datestamp_from_filename(filename):
-    """
-    Returns array of year, month, day if filename starts with
-    YYYY-MM-DD datestamp. Returns empty array else.
-    """
+    def checkpoint(self):
+        "Marks all logged operations as applied. This is synced to disk with the next log()."
 
-    components = re.match(YYYY_MM_DD_PATTERN, filename)
-    if components:
-        return [components.group(1), components.group(2), components.group(3)]
-    else:
-        return []
+        self.handle.write(json.dumps(['checkpoint', self.num_operations]) + '\n')
+        self.handle.flush()
+        self.num_applied = self.num_operations
 
+    def close(self):
+        """
+        Removes the journal if all logged operations were applied. Otherwise,
+        the run got interrupted and the journal remains for --resume and
+        --rollback.
+        """
 
-def get_files_with_metadata(startdir=os.getcwd(), use_cache=True):
-    """
-    Traverses the file system starting with given directory,
-    returns list: filename and metadata-dict:
+        self.handle.close()
+        if self.num_applied == self.num_operations:
+            os.remove(self.filename)
+        else:
+            logging.warning('The journal "' + self.filename + '" remains since not all of its operations ' +
+                            'were applied. Please complete it with --resume or undo it with --rollback.')
 
-    The result is stored in the global dict as
-    cache_of_files_with_metadata[startdir] with dict elements like:
-      'filename': '2018-03-18 this is a file name -- tag1 tag2.txt',
-      'filetags': ['tag1', 'tag2'],
-      'path': '/this/is -- tag1/the -- tag3/path',
-      'alltags': ['tag1', 'tag2', 'tag3'],
-      'ctime': time.struct_time,
-      'datestamp': ['2018', '03', '18'],
 
-    @param use_cache: FOR FUTURE USE; default = True
-    @param return: list of filenames and metadata-dict
+def read_journal(filename):
+    """
+    @param filename: a journal file of RenameJournal
+    @param return: list of operations, number of operations known to be applied
     """
 
-    global cache_of_files_with_metadata
-
-    assert(os.path.isdir(startdir))
+    operations = []
+    num_applied = 0
+    with open(filename, encoding='utf-8') as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logging.debug('read_journal: ignoring incomplete line: ' + repr(line))
+                continue
+            if entry[0] == 'checkpoint':
+                num_applied = entry[1]
+            else:
+                operations.append(entry)
+    return operations, num_applied
 
-    logging.debug('get_files_with_metadata called with startdir [%s], cached startdirs [%s]' %
-                  (startdir, str(len(list(cache_of_files_with_metadata.keys())))))
 
-    if use_cache and len(cache_of_files_with_metadata) > 0:
-        logging.debug("found " + str(len(cache_of_files_with_metadata)) + " files in cache for files")
-        return cache_of_files_with_metadata
+def redo_journal_operation(operation):
+    """
+    Applies an operation of the journal unless it was already applied.
 
-    else:
+    @param operation: list of a RenameJournal operation
+    """
 
-        cache = []
-        for root, dirs, files in os.walk(startdir):
-
-            # logging.debug('get_files_with_metadata: root [%s]' % root)  # LOTS of debug output
-            for filename in files:
-
-                absfilename = os.path.abspath(os.path.join(root, filename))
-                # logging.debug('get_files_with_metadata: file [%s]' % absfilename)  # LOTS of debug output
-                path, basename = os.path.split(absfilename)
-                if os.path.islink(absfilename):
-                    # link files do not have ctime and must be dereferenced before. However, they can link to another link file or they can be broken.
-                    # Design decision: ignoring link files alltogether. Their source should speak for themselves.
-                    logging.debug('get_files_with_metadata: file [%s] is link to [%s] and gets ignored here' %
-                                  (absfilename,
-                                   os.path.join(os.path.dirname(absfilename), os.readlink(absfilename))))
-                    continue
-                else:
-                    ctime = time.localtime(os.path.getctime(absfilename))
-
-                cache.append({
-                    'filename': basename,
-                    'filetags': extract_tags_from_filename(basename),
-                    'path': path,
-                    'alltags': extract_tags_from_path(absfilename),
-                    'ctime': ctime,
-                    'datestamp': extract_iso_datestamp_from_filename(basename)
-                })
-
-            # Enable recursive directory traversal for specific options:
-            if not (options.recursive and (options.list_tags_by_alphabet or
-                                           options.list_tags_by_number or
-                                           options.list_unknown_tags or
-                                           options.tag_gardening)):
-                break  # do not loop
-
-        logging.debug("Writing " + str(len(cache)) + " files in cache for directory: " + startdir)
-        if use_cache:
-            cache_of_files_with_metadata[startdir] = cache
-        return cache
+    if operation[0] == 'rename':
+        source, destination = operation[1:]
+        if os.path.lexists(destination) and not os.path.lexists(source):
+            return
+        if os.path.lexists(destination):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), destination)
+        os.rename(source, destination)
+
+    elif operation[0] == 'relink':
+        link, new_link, target, new_target = operation[1:]
+        if os.path.lexists(get_link_filename(new_link)) and (new_link != link or
+                                                             get_link_source_file(link) == new_target):
+            if os.path.lexists(link) and new_link != link:
+                os.remove(link)
+            return
+        if os.path.lexists(link):
+            os.remove(link)
+        create_link(new_target, new_link)
 
 
-def get_tags_from_files_and_subfolders(startdir=os.getcwd(), use_cache=True):
+def undo_journal_operation(operation):
     """
-    Traverses the file system starting with given directory,
-    returns dict of all tags (including starttags) of all file.
-    Uses cache_of_files_with_metadata of use_cache is true and
-    cache is populated with same startdir.
+    Reverts an operation of the journal if it was applied.
 
-    @param use_cache: FOR FUTURE USE
-    @param return: dict of tags and their number of occurrence
+    @param operation: list of a RenameJournal operation
     """
 
-    # add ", starttags=False" to parameters to enable this feature in future
-    starttags = False
+    if operation[0] == 'rename':
+        source, destination = operation[1:]
+        if os.path.lexists(destination) and not os.path.lexists(source):
+            os.rename(destination, source)
 
-    assert(os.path.isdir(startdir))
+    elif operation[0] == 'relink':
+        link, new_link, target, new_target = operation[1:]
+        if os.path.lexists(link) and (new_link != link or get_link_source_file(link) == target):
+            return
+        if os.path.lexists(get_link_filename(new_link)):
+            os.remove(get_link_filename(new_link))
+        if os.path.lexists(link):
+            os.remove(link)
+        if IS_WINDOWS:
+            create_link(target, link)
+        else:
+            os.symlink(target, link)
 
-    if not starttags:
-        tags = {}
-    else:
-        assert(starttags.__class__ == dict)
-        tags = starttags
 
-    global cache_of_tags_by_folder
+def handle_option_journal(rollback):
+    """
+    Completes (--resume) or undoes (--rollback) the operations of the
+    journal of an interrupted run.
 
-    logging.debug('get_tags_from_files_and_subfolders called with startdir [%s], cached startdirs [%s]' %
-                  (startdir, str(len(list(cache_of_tags_by_folder.keys())))))
+    @param rollback: boolean which defines if the journal is undone (True) or completed (False)
+    """
 
-    if use_cache and startdir in list(cache_of_tags_by_folder.keys()):
-        logging.debug("get_tags_from_files_and_subfolders: found " + str(len(cache_of_tags_by_folder[startdir])) +
-                      " tags in cache for directory: " + startdir)
-        return cache_of_tags_by_folder[startdir]
+    if not os.path.isfile(JOURNAL_FILENAME):
+        error_exit(31, 'There is no journal of an interrupted run: "' + JOURNAL_FILENAME + '"')
+    operations, num_applied = read_journal(JOURNAL_FILENAME)
 
-    elif use_cache and startdir in cache_of_files_with_metadata.keys():
-        logging.debug('get_tags_from_files_and_subfolders: using cache_of_files_with_metadata instead of traversing file system again')
-        cachedata = cache_of_files_with_metadata[startdir]
+    if rollback:
+        logging.info('Undoing the ' + str(len(operations)) + ' operation(s) of the journal …')
+        operations = list(reversed(operations))
+        function = undo_journal_operation
+    else:
+        logging.info('Completing ' + str(len(operations) - num_applied) + ' of ' + str(len(operations)) +
+                     ' operation(s) of the journal …')
+        operations = operations[num_applied:]
+        function = redo_journal_operation
 
-        # FIXXME: check if tags are extracted from dirnames as in traversal algorithm below
+    num_errors = 0
+    for operation in operations:
+        try:
+            function(operation)
+        except OSError as error:
+            logging.error('Could not handle ' + repr(operation) + ' of the journal: ' + str(error))
+            num_errors += 1
 
-        for entry in cachedata:
-            for tag in entry['alltags']:
-                tags = add_tag_to_countdict(tag, tags)
+    if num_errors > 0:
+        error_exit(20, str(num_errors) + ' error(s) occurred. The journal "' + JOURNAL_FILENAME +
+                   '" is kept. Please check messages above.')
+    os.remove(JOURNAL_FILENAME)
 
-    else:
 
-        for root, dirs, files in os.walk(startdir):
+def rename_file(source, destination):
+    """
+    os.rename() which is written to the journal first if --journal is used.
 
-            # logging.debug('get_tags_from_files_and_subfolders: root [%s]' % root)  # LOTS of debug output
+    @param source: file name with absolute path
+    @param destination: new file name with absolute path
+    """
 
-            for filename in files:
-                for tag in extract_tags_from_filename(filename):
-                    tags = add_tag_to_countdict(tag, tags)
+    if rename_journal:
+        rename_journal.log([['rename', source, destination]])
+    os.rename(source, destination)
+    if rename_journal:
+        rename_journal.checkpoint()
 
-            for dirname in dirs:
-                for tag in extract_tags_from_filename(dirname):
-                    tags = add_tag_to_countdict(tag, tags)
 
-            # Enable recursive directory traversal for specific options:
-            if not (options.recursive and (options.list_tags_by_alphabet or
-                                           options.list_tags_by_number or
-                                           options.list_unknown_tags or
-                                           options.tag_gardening)):
-                break  # do not loop
+def read_filenames_from(filename, null_separated=False):
+    """
+    Returns the file names listed in a file or on standard input without
+    reading the whole list into memory. The names are decoded like
+    the operating system does so that any file name can be passed.
+    The file is opened right away so that a wrong file name is
+    reported before any file gets handled.
+
+    @param filename: the file containing the list or '-' for standard input
+    @param null_separated: if True, the names are separated by NUL characters instead of newlines
+    @param return: generator of file names
+    @param raise: OSError if the file can not be opened
+    """
 
-    logging.debug("get_tags_from_files_and_subfolders: Writing " + str(len(list(tags.keys()))) +
-                  " tags in cache for directory: " + startdir)
-    if use_cache:
-        cache_of_tags_by_folder[startdir] = tags
-    return tags
+    handle = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+    return read_filenames_from_handle(handle, null_separated)
 
 
-def find_similar_tags(tag, tags):
+def read_filenames_from_handle(handle, null_separated):
     """
-    Returns a list of entries of tags that are similar to tag (but not same as tag)
+    Yields the file names of read_filenames_from() and closes the handle
+    unless it is standard input.
 
-    @param tag: a (unicode) string that represents a tag
-    @param tags: a list of (unicode) strings
-    @param return: list of tags that are similar to tag
+    @param handle: binary file object of the list
+    @param null_separated: if True, the names are separated by NUL characters instead of newlines
+    @param return: generator of file names
     """
 
-    assert(tag.__class__ == str)
-    assert(tags.__class__ == list)
+    separator = b'\0' if null_separated else b'\n'
+    try:
+        rest = b''
+        while True:
+            data = handle.read(FILES_FROM_READ_SIZE)
+            if not data:
+                break
+            names = (rest + data).split(separator)
+            rest = names.pop()
+            for name in names:
+                if not null_separated:
+                    name = name.rstrip(b'\r')
+                if name:
+                    yield os.fsdecode(name)
+        if not null_separated:
+            rest = rest.rstrip(b'\r')
+        if rest:
+            yield os.fsdecode(rest)
+    finally:
+        if handle is not sys.stdin.buffer:
+            handle.close()
+
+
+def get_chunks(items, size):
+    """
+    @param items: iterable
+    @param size: maximum number of items per chunk
+    @param return: generator of lists with up to size items
+    """
 
-    similar_tags = difflib.get_close_matches(tag, tags, n=999, cutoff=0.7)
-    close_but_not_exact_matches = []
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
-    # omit exact matches   FIXXME: this can be done in one eloquent line -> refactor
-    for match in similar_tags:
-        if match != tag:
-            close_but_not_exact_matches.append(match)
 
-    return close_but_not_exact_matches
+def plan_batch_renames(files, tags, do_remove, unique_tags_groups=None):
+    """
+    Determines the renames for adding or removing tags for many files at
+    once: the files are grouped by their directory, each directory is
+    listed only once and the new basenames are derived in memory.
 
+    Only regular files are handled here. Links (whose originals might
+    have to be renamed as well), directories and items that could not
+    be found in the listing of their directory are returned as
+    remaining files so that they can be handled one by one with
+    handle_file_and_optional_link().
 
-def get_invalid_tags_for_vocabulary(tags, vocabulary):
-    """Return a list of tags not contained in the controlled vocabulary."""
+    A rename whose new basename already exists in the directory or is
+    the new basename of another file of the batch is a collision and
+    is not planned.
 
-    normalized_vocabulary = set()
+    @param files: list of file names
+    @param tags: list containing one or more tags
+    @param do_remove: boolean which defines if tags should be added (False) or removed (True)
+    @param unique_tags_groups: see get_new_basename()
+    @param return: dict of directory → list of (basename, new basename), list of remaining files, list of (filename, new filename) collisions
+    """
+
+    files_by_directory = collections.OrderedDict()
+    for filename in files:
+        files_by_directory.setdefault(os.path.dirname(os.path.abspath(filename)), []).append(filename)
+
+    renames = collections.OrderedDict()
+    remaining_files = []
+    collisions = []
+    for dirname, filenames in files_by_directory.items():
+        try:
+            with os.scandir(dirname) as entries:
+                listing = {entry.name: entry for entry in entries}
+        except OSError as error:
+            logging.debug('plan_batch_renames: can not list "' + dirname + '": ' + str(error))
+            remaining_files.extend(filenames)
+            continue
+
+        handled_basenames = set()
+        new_basenames = set()
+        for filename in filenames:
+            basename = os.path.basename(filename)
+            if basename in handled_basenames:
+                continue  # the same file was given twice
+            entry = listing.get(basename)
+            try:
+                is_regular_file = entry is not None and not entry.is_symlink() and entry.is_file()
+            except OSError:
+                is_regular_file = False
+            if not is_regular_file or is_lnk_file(basename):
+                remaining_files.append(filename)
+                continue
+            handled_basenames.add(basename)
+
+            new_basename = get_new_basename(basename, tags, do_remove, unique_tags_groups)
+            if new_basename == basename:
+                continue
+            if new_basename in listing or new_basename in new_basenames:
+                collisions.append((os.path.join(dirname, basename), os.path.join(dirname, new_basename)))
+                continue
+            new_basenames.add(new_basename)
+            renames.setdefault(dirname, []).append((basename, new_basename))
+
+    return renames, remaining_files, collisions
+
+
+class DirectoryHandle(object):
+    """
+    Renames files relative to an open directory file descriptor where
+    the platform supports it (os.supports_dir_fd): the path of the
+    directory is resolved once instead of once per file and renames
+    within the directory are not affected by a concurrent rename of
+    one of its parent directories. Elsewhere, absolute paths are used.
+    The working directory is never changed.
+    """
+
+    def __init__(self):
+        self.dirname = None
+        self.fd = None
+
+    def get_fd(self, dirname):
+        """
+        @param dirname: directory with absolute path
+        @param return: file descriptor of dirname or None if dir_fd is not supported
+        """
+
+        if os.rename not in os.supports_dir_fd:
+            return None
+        if dirname != self.dirname:
+            self.close()
+            self.fd = os.open(dirname, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+            self.dirname = dirname
+        return self.fd
+
+    def rename(self, dirname, basename, new_basename):
+        """
+        @param dirname: directory with absolute path
+        @param basename: file name within dirname
+        @param new_basename: new file name within dirname
+        """
+
+        fd = self.get_fd(dirname)
+        if fd is None:
+            os.rename(os.path.join(dirname, basename), os.path.join(dirname, new_basename))
+        else:
+            os.rename(basename, new_basename, src_dir_fd=fd, dst_dir_fd=fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.dirname = None
+        self.fd = None
+
+
+def apply_batch_renames(renames, dryrun=False, report=None, journal=None):
+    """
+    Renames the files of plan_batch_renames() relative to their
+    directories (see DirectoryHandle) without changing the working
+    directory.
+
+    @param renames: dict of directory → list of (basename, new basename)
+    @param dryrun: boolean which defines if files should be changed (False) or not (True)
+    @param report: optional function(dirname, basename, new_basename) which is called for each rename
+    @param journal: optional RenameJournal which gets the renames in chunks before they are applied
+    @param return: list of (filename, OSError) of failed renames
+    """
+
+    errors = []
+    items = ((dirname, basename, new_basename) for dirname in renames for basename, new_basename in renames[dirname])
+    directory = DirectoryHandle()
+    try:
+        for chunk in get_chunks(items, JOURNAL_CHECKPOINT_INTERVAL):
+            if journal and not dryrun:
+                journal.log([['rename', os.path.join(dirname, basename), os.path.join(dirname, new_basename)]
+                             for dirname, basename, new_basename in chunk])
+            for dirname, basename, new_basename in chunk:
+                if report:
+                    report(dirname, basename, new_basename)
+                if dryrun:
+                    continue
+                try:
+                    directory.rename(dirname, basename, new_basename)
+                except OSError as error:
+                    errors.append((os.path.join(dirname, basename), error))
+            if journal and not dryrun:
+                journal.checkpoint()
+    finally:
+        directory.close()
+    return errors
+
+
+def add_tag_to_countdict(tag, tags):
+    """
+    Takes a tag (string) and a dict. Returns the dict with count value increased by one
+
+    @param tag: a (unicode) string
+    @param tags: dict of tags
+    @param return: dict of tags with incremented counter of tag (or 0 if new)
+    """
+
+    assert(tag.__class__ == str)
+    assert(tags.__class__ == dict)
+
+    if tag in tags:
+        tags[tag] = tags[tag] + 1
+    else:
+        tags[tag] = 1
+
+    return tags
+
+
+def extract_iso_datestamp_from_filename(filename):
+    """
+    Returns array of year, month, day if filename starts with
+    YYYY-MM-DD datestamp. Returns empty array else.
+    """
+
+    components = re.match(YYYY_MM_DD_PATTERN, filename)
+    if components:
+        return [components.group(1), components.group(2), components.group(3)]
+    else:
+        return []
+
+
+class PersistentTagIndex(object):
+    """
+    An on-disk index (SQLite) of directory listings which speeds up
+    repeated traversals of large directory hierarchies.
+
+    For each directory, the index stores its modification time, its
+    path tags and the names of its sub-directories. For each file, it
+    stores the basename, the file tags, the ISO datestamp, the ctime
+    and whether or not the file is a link.
+
+    Adding, removing or renaming a file changes the modification time
+    of its directory. Since tags are part of the file names, a
+    directory whose modification time did not change since it got
+    indexed can be answered from the index without listing it again.
+    Changes of the ctime of single files are not detected that way.
+    """
+
+    def __init__(self, filename, readonly=False):
+        """
+        @param filename: file name of the index; gets created if it does not exist
+        @param readonly: if True, the index is never updated (e.g., for --dryrun)
+        """
+
+        safe_import('sqlite3')
+        self.filename = filename
+        self.readonly = readonly
+        self.connection = sqlite3.connect(filename)
+        # No journal file: creating and deleting one would modify the
+        # mtime of the directory that holds the index on each run.
+        self.connection.execute("PRAGMA journal_mode = MEMORY")
+
+        try:
+            version = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.DatabaseError:
+            version = None
+        if not version or version[0] != TAG_INDEX_SCHEMA_VERSION:
+            logging.debug('PersistentTagIndex: (re-)initializing index file "%s"' % filename)
+            self.connection.executescript("""
+                DROP TABLE IF EXISTS meta;
+                DROP TABLE IF EXISTS directories;
+                DROP TABLE IF EXISTS files;
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE directories (path TEXT PRIMARY KEY, mtime INTEGER, pathtags TEXT NOT NULL,
+                                          subdirs TEXT NOT NULL, linked_subdirs TEXT NOT NULL);
+                CREATE TABLE files (directory TEXT NOT NULL, basename TEXT NOT NULL,
+                                    filetags TEXT NOT NULL, datestamp TEXT NOT NULL,
+                                    ctime REAL, is_link INTEGER NOT NULL,
+                                    PRIMARY KEY (directory, basename));
+                """)
+            self.connection.execute("INSERT INTO meta VALUES ('version', ?)", (TAG_INDEX_SCHEMA_VERSION,))
+            self.connection.commit()
+
+    @staticmethod
+    def _split(value, separator):
+        return value.split(separator) if value else []
+
+    def get_directories_below(self, startdir):
+        """
+        Returns all indexed directories of the hierarchy starting with startdir.
+
+        @param startdir: absolute path of the traversal root
+        @param return: dict of path -> tuple of (mtime, pathtags, subdirs, linked_subdirs)
+        """
+
+        prefix = os.path.join(startdir, '')
+        return {path: (mtime, self._split(pathtags, BETWEEN_TAG_SEPARATOR),
+                       self._split(subdirs, '\0'), self._split(linked_subdirs, '\0'))
+                for path, mtime, pathtags, subdirs, linked_subdirs in
+                self.connection.execute("SELECT path, mtime, pathtags, subdirs, linked_subdirs FROM directories " +
+                                        "WHERE path = ? OR (path >= ? AND path < ?)",
+                                        (startdir, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))}
+
+    def get_files(self, path):
+        """
+        @param path: absolute path of an indexed directory
+        @param return: list of tuples (basename, filetags, datestamp, ctime, is_link) sorted by basename
+        """
+
+        return [(basename, self._split(filetags, BETWEEN_TAG_SEPARATOR), self._split(datestamp, '-'),
+                 ctime, bool(is_link))
+                for basename, filetags, datestamp, ctime, is_link in
+                self.connection.execute("SELECT basename, filetags, datestamp, ctime, is_link FROM files " +
+                                        "WHERE directory = ? ORDER BY basename", (path,))]
+
+    def put_directory(self, path, mtime, pathtags, subdirs, linked_subdirs, files):
+        """
+        Stores (or replaces) the content of a directory.
+
+        @param path: absolute path of the directory
+        @param mtime: st_mtime_ns of the directory when it was listed
+        @param pathtags: list of tags of path
+        @param subdirs: list of names of all sub-directories
+        @param linked_subdirs: list of names of sub-directories which are links
+        @param files: list of tuples (basename, filetags, datestamp, ctime, is_link)
+        """
+
+        if self.readonly:
+            return
+        if time.time() - mtime / 1e9 < TAG_INDEX_RACY_MTIME_SECONDS:
+            # The directory might be modified again within the
+            # granularity of its time-stamp. Force a re-scan next time:
+            mtime = None
+        self.forget_directories([path])
+        try:
+            self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                        [(path, basename, BETWEEN_TAG_SEPARATOR.join(filetags),
+                                          '-'.join(datestamp), ctime, int(is_link))
+                                         for basename, filetags, datestamp, ctime, is_link in files])
+            self.connection.execute("INSERT INTO directories VALUES (?, ?, ?, ?, ?)",
+                                    (path, mtime, BETWEEN_TAG_SEPARATOR.join(pathtags),
+                                     '\0'.join(subdirs), '\0'.join(linked_subdirs)))
+        except UnicodeEncodeError:
+            # file names which are no valid UTF-8 can not be stored; the directory remains un-indexed
+            logging.debug('PersistentTagIndex: could not index directory "%s" due to its file names' %
+                          path.encode('utf-8', 'replace').decode('utf-8'))
+            self.connection.execute("DELETE FROM files WHERE directory = ?", (path,))
+
+    def forget_directories(self, paths):
+        """
+        Removes directories (but not their sub-directories) from the index.
+
+        @param paths: list of absolute paths of directories
+        """
+
+        if self.readonly:
+            return
+        for path in paths:
+            self.connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+            self.connection.execute("DELETE FROM files WHERE directory = ?", (path,))
+
+    def commit(self):
+        if not self.readonly:
+            self.connection.commit()
+
+
+def get_persistent_tag_index(startdir):
+    """
+    Returns the PersistentTagIndex to use for startdir if the user
+    enabled it via --index. It is located next to the controlled
+    vocabulary or, if there is none, in startdir.
+
+    @param startdir: the directory that is about to be traversed
+    @param return: PersistentTagIndex or None
+    """
+
+    if not options.index:
+        return None
+
+    vocabulary_filename = locate_file_in_cwd_and_parent_directories(startdir, CONTROLLED_VOCABULARY_FILENAME)
+    if vocabulary_filename:
+        index_filename = os.path.join(os.path.dirname(os.path.abspath(vocabulary_filename)), TAG_INDEX_FILENAME)
+    else:
+        index_filename = os.path.join(os.path.abspath(startdir), TAG_INDEX_FILENAME)
+
+    if index_filename not in open_tag_indexes:
+        if options.dryrun and not os.path.isfile(index_filename):
+            logging.debug('get_persistent_tag_index: no index yet and dryrun → not creating "%s"' % index_filename)
+            return None
+        logging.debug('get_persistent_tag_index: using index file "%s"' % index_filename)
+        open_tag_indexes[index_filename] = PersistentTagIndex(index_filename, readonly=options.dryrun)
+    return open_tag_indexes[index_filename]
+
+
+def list_directory(directory):
+    """
+    Lists a single directory the same way os.walk() classifies its
+    entries, sorted by name. The information of the os.DirEntry objects
+    is re-used so that only non-link files require an additional stat().
+
+    @param directory: string of an existing directory
+    @param return: tuple of (subdirs, linked_subdirs, files) where files is a
+                   list of tuples (basename, filetags, datestamp, ctime, is_link)
+    """
+
+    subdirs = []
+    linked_subdirs = []
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in sorted(entries, key=lambda x: x.name):
+            if entry.name == TAG_INDEX_FILENAME:
+                continue  # the index of filetags is no file of the user
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                subdirs.append(entry.name)
+                if entry.is_symlink():
+                    linked_subdirs.append(entry.name)
+                continue
+
+            is_link = entry.is_symlink()
+            if is_link:
+                # link files do not have a ctime of their own, see get_files_with_metadata()
+                ctime = None
+            else:
+                try:
+                    ctime = entry.stat().st_ctime
+                except OSError:
+                    continue  # vanished in the meantime
+            files.append((entry.name,
+                          parse_basename(entry.name).tags,
+                          extract_iso_datestamp_from_filename(entry.name),
+                          ctime,
+                          is_link))
+    return subdirs, linked_subdirs, files
+
+
+def walk_directories(startdir, recursive, index=None, jobs=None, mtimes=None):
+    """
+    Traverses the file system starting with startdir similar to os.walk()
+    and yields one tuple per directory:
+      (absolute path, pathtags, subdirs, files)
+    with files as a list of tuples (basename, filetags, datestamp, ctime, is_link).
+
+    Directories are yielded top-down in the order of their sorted names,
+    no matter how many threads are used. Links to directories are listed
+    in subdirs but not followed.
+
+    For recursive traversals, a pool of jobs threads lists the
+    sub-directories ahead of the consumer: as soon as a directory is
+    listed, its sub-directories are queued for listing as well. This
+    hides the latency of the file system (e.g., NFS) per directory.
+
+    @param startdir: string of an existing directory
+    @param recursive: if False, only startdir itself is listed
+    @param index: optional PersistentTagIndex to read unchanged directories from
+    @param jobs: number of threads for listing directories; default from --jobs
+    @param mtimes: optional dict which gets the st_mtime_ns of each yielded directory as
+                   determined before listing it
+    """
+
+    startdir = os.path.abspath(startdir)
+    if jobs is None:
+        jobs = options.jobs[0] if options.jobs else DEFAULT_TRAVERSAL_JOBS
+
+    # The index is only accessed from this thread. The threads get a
+    # snapshot of the indexed directories to decide whether or not a
+    # directory has to be listed at all:
+    indexed = index.get_directories_below(startdir) if index else {}
+
+    def read_directory(directory):
+        "Returns (mtime, pathtags, subdirs, linked_subdirs, files); files is None if it is to be read from the index"
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        known = indexed.get(directory)
+        if known and known[0] is not None and known[0] == mtime:
+            return mtime, known[1], known[2], known[3], None
+        try:
+            subdirs, linked_subdirs, files = list_directory(directory)
+        except OSError as error:
+            logging.debug('walk_directories: skipping directory "%s": %s' % (directory, str(error)))
+            return None
+        return mtime, extract_tags_from_path(directory), subdirs, linked_subdirs, files
+
+    executor = None
+    if recursive and jobs > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    stop = threading.Event()
+
+    def queue_subdirectories(directory, result):
+        "Returns list of (path, future) of the sub-directories to traverse; future is None without threads"
+        if not recursive or not result:
+            return []
+        paths = [os.path.join(directory, x) for x in result[2] if x not in result[3]]
+        if executor and not stop.is_set():
+            return [(path, executor.submit(read_directory_and_queue_subdirectories, path)) for path in paths]
+        return [(path, None) for path in paths]
+
+    def read_directory_and_queue_subdirectories(directory):
+        if stop.is_set():
+            return None, []
+        result = read_directory(directory)
+        return result, queue_subdirectories(directory, result)
+
+    visited = set()
+    num_indexed = 0
+    pending = [(startdir, None)]
+    try:
+        while pending:
+            directory, future = pending.pop()
+            if future:
+                result, subdirectories = future.result()
+            else:
+                result = read_directory(directory)
+                subdirectories = queue_subdirectories(directory, result)
+            if not result:
+                continue
+
+            mtime, pathtags, subdirs, linked_subdirs, files = result
+            if files is None:
+                files = index.get_files(directory)
+                num_indexed += 1
+            elif index:
+                index.put_directory(directory, mtime, pathtags, subdirs, linked_subdirs, files)
+            visited.add(directory)
+            if mtimes is not None:
+                mtimes[directory] = mtime
+
+            yield directory, pathtags, subdirs, files
+
+            pending.extend(reversed(subdirectories))
+
+        if index and recursive:
+            index.forget_directories([x for x in indexed if x not in visited])
+    finally:
+        stop.set()
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if index:
+            logging.debug('walk_directories: %i of %i directories answered from index' %
+                          (num_indexed, len(visited)))
+            index.commit()
+
+
+def intern_tags(tags):
+    """
+    Tags re-occur in many file names. Interning them stores each
+    distinct tag string only once in memory.
+
+    @param tags: iterable of tag strings
+    @param return: tuple of the interned tags
+    """
+
+    return tuple(sys.intern(tag) for tag in tags)
+
+
+class DirectoryRecord(object):
+    """
+    One directory of a TagScan. Its path and its path tags are stored
+    only once and are shared by the FileRecord objects of its files.
+    """
+
+    __slots__ = ('path', 'pathtags', 'subdirs', 'files')
+
+    def __init__(self, path, pathtags, subdirs):
+        """
+        @param path: absolute path of the directory
+        @param pathtags: list of tags of the path
+        @param subdirs: list of names of the sub-directories
+        """
+
+        self.path = path
+        self.pathtags = intern_tags(pathtags)
+        self.subdirs = subdirs
+        self.files = []  # list of FileRecord objects
+
+
+class FileRecord(object):
+    """
+    Compact representation of one file of a TagScan. Files without
+    tags of their own share the pathtags tuple of their directory as
+    alltags.
+
+    Attributes:
+      filename: '2018-03-18 this is a file name -- tag1 tag2.txt'
+      filetags: ('tag1', 'tag2')
+      alltags: ('tag3', 'tag1', 'tag2'); path tags followed by the other file tags
+      directory: the DirectoryRecord of '/this/is -- tag3/the/path'
+      ctime: st_ctime in seconds since the epoch; None for links
+      datestamp: ['2018', '03', '18'] or []
+      is_link: True if the file is a symbolic link
+    """
+
+    __slots__ = ('filename', 'filetags', 'alltags', 'directory', 'ctime', 'datestamp', 'is_link')
+
+    def __init__(self, directory, filename, filetags, datestamp, ctime, is_link):
+        self.directory = directory
+        self.filename = filename
+        self.filetags = intern_tags(filetags)
+        if self.filetags:
+            self.alltags = directory.pathtags + tuple(x for x in self.filetags if x not in directory.pathtags)
+        else:
+            self.alltags = directory.pathtags
+        self.datestamp = datestamp
+        self.ctime = ctime
+        self.is_link = is_link
+
+    @property
+    def path(self):
+        return self.directory.path
+
+    def __repr__(self):
+        return 'FileRecord(%r)' % os.path.join(self.directory.path, self.filename)
+
+
+class InvertedTagIndex(object):
+    """
+    Maps each tag to the set of ids of the files having this tag. The
+    id of a file is its position within the list of files. Queries are
+    answered with set algebra whose costs depend on the number of
+    matching files instead of the number of all files:
+
+      index.get_filenames(index.matching_all(['car', 'red']))        # car AND red
+      index.get_filenames(index.matching_any(['car', 'bike']))       # car OR bike
+      index.get_filenames(index.excluding(index.matching_all(['car']), ['red']))  # car AND NOT red
+    """
+
+    def __init__(self, files, tags_of_files, pathtags_of_files=None, datestamps_of_files=None):
+        """
+        @param files: list of file names
+        @param tags_of_files: list of the tags of each file of files
+        @param pathtags_of_files: optional list of the path tags of each file of files
+        @param datestamps_of_files: optional list of the datestamps (['2018', '03', '18'] or []) of each file of files
+        """
+
+        assert(len(files) == len(tags_of_files))
+        self.files = files
+        self.all_ids = frozenset(range(len(files)))
+        self.tags_of_files = tags_of_files
+        self.ids_by_tag = self._invert(tags_of_files)
+        self.ids_by_pathtag = self._invert(pathtags_of_files or [])
+        # sorted list of ('YYYY-MM-DD', id) for range queries:
+        self.dates = sorted(('-'.join(datestamp), fileid) for fileid, datestamp in
+                            enumerate(datestamps_of_files or []) if datestamp)
+
+    @staticmethod
+    def _invert(tags_of_files):
+        ids_by_tag = {}
+        for fileid, tags in enumerate(tags_of_files):
+            for tag in tags:
+                ids_by_tag.setdefault(tag, set()).add(fileid)
+        return {tag: frozenset(ids) for tag, ids in ids_by_tag.items()}
+
+    def get_ids(self, tag):
+        """
+        @param tag: string of a tag
+        @param return: frozenset of the ids of the files having tag
+        """
+
+        return self.ids_by_tag.get(tag, frozenset())
+
+    def get_pathtag_ids(self, tag):
+        """
+        @param tag: string of a tag
+        @param return: frozenset of the ids of the files having tag within their path
+        """
+
+        return self.ids_by_pathtag.get(tag, frozenset())
+
+    def get_date_range(self, operator, date):
+        """
+        Partial dates compare on their precision: '<=2020-01' includes
+        all days of January 2020.
+
+        @param operator: one of '=', '<', '<=', '>', '>='
+        @param date: string of 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD'
+        @param return: tuple (start, stop) of the slice of self.dates matching the comparison
+        """
+
+        # all datestamps with the prefix date lie between date and date + '~' (sorts after digits and '-'):
+        first = bisect.bisect_left(self.dates, (date,))
+        behind = bisect.bisect_left(self.dates, (date + '~',))
+        return {'=': (first, behind),
+                '<': (0, first),
+                '<=': (0, behind),
+                '>': (behind, len(self.dates)),
+                '>=': (first, len(self.dates))}[operator]
+
+    def get_date_ids(self, operator, date):
+        """
+        @param operator: one of '=', '<', '<=', '>', '>='
+        @param date: string of 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD'
+        @param return: frozenset of the ids of the files whose datestamp matches
+        """
+
+        start, stop = self.get_date_range(operator, date)
+        return frozenset(x[1] for x in self.dates[start:stop])
+
+    def matching_all(self, tags):
+        """
+        @param tags: list of tags; an empty list matches all files
+        @param return: set of ids of the files having all tags
+        """
+
+        if not tags:
+            return self.all_ids
+        # intersecting the smallest sets first keeps the intermediate results small:
+        tagsets = sorted((self.get_ids(tag) for tag in set(tags)), key=len)
+        return tagsets[0].intersection(*tagsets[1:])
+
+    def matching_any(self, tags):
+        """
+        @param tags: list of tags
+        @param return: set of ids of the files having at least one of the tags
+        """
+
+        return frozenset().union(*[self.get_ids(tag) for tag in tags])
+
+    def excluding(self, ids, tags):
+        """
+        @param ids: set of file ids
+        @param tags: list of tags
+        @param return: set of those ids whose files have none of the tags
+        """
+
+        return ids.difference(*[self.get_ids(tag) for tag in tags])
+
+    def get_filenames(self, ids):
+        """
+        @param ids: set of file ids
+        @param return: list of the file names in the order of the index
+        """
+
+        return [self.files[x] for x in sorted(ids)]
+
+
+class TagScan(object):
+    """
+    The result of one single traversal of a directory (hierarchy).
+
+    All information needed by the different features (files with their
+    metadata, file tags, directory tags, tag counts, file names) is
+    derived from the same traversal so that one invocation of filetags
+    does not have to walk the same hierarchy several times.
+
+    A recursive scan also answers the non-recursive questions for its
+    startdir.
+    """
+
+    def __init__(self, startdir, recursive, index=None, jobs=None):
+        """
+        @param startdir: string of an existing directory
+        @param recursive: if True, the whole hierarchy below startdir is traversed
+        @param index: optional PersistentTagIndex, see walk_directories()
+        @param jobs: number of threads for listing directories, see walk_directories()
+        """
+
+        self.startdir = os.path.abspath(startdir)
+        self.recursive = recursive
+        self.mtimes = {}  # st_mtime_ns of each directory when it was listed
+        self.directories = []  # list of DirectoryRecord objects in the order of walk_directories()
+        self.num_files = 0
+        for path, pathtags, subdirs, files in walk_directories(self.startdir, recursive, index=index, jobs=jobs,
+                                                               mtimes=self.mtimes):
+            directory = DirectoryRecord(path, pathtags, subdirs)
+            directory.files = [FileRecord(directory, *x) for x in files]
+            self.directories.append(directory)
+            self.num_files += len(files)
+        self._derived = {}
+        self._derived_lock = threading.RLock()  # re-entrant: derived views use other derived views
+        logging.debug('TagScan: scanned %i directories of [%s] (recursive: %s)' %
+                      (len(self.directories), self.startdir, str(recursive)))
+
+    def is_up_to_date(self, recursive):
+        """
+        Any file or directory being added, renamed or removed changes the
+        mtime of its directory. Therefore, a scan is up to date as long as
+        the mtimes of its directories did not change.
+
+        @param recursive: if False, only startdir itself is checked
+        @param return: True if no directory of this scan was modified since it was listed
+        """
+
+        for directory in self._get_directories(recursive):
+            try:
+                if os.stat(directory.path).st_mtime_ns != self.mtimes[directory.path]:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _get_directories(self, recursive):
+        assert(self.recursive or not recursive)
+        if recursive:
+            return self.directories
+        else:
+            return self.directories[:1]
+
+    def _memoize(self, name, recursive, function):
+        key = (name, recursive)
+        with self._derived_lock:
+            if key not in self._derived:
+                self._derived[key] = function(self._get_directories(recursive))
+            return self._derived[key]
+
+    def get_files_with_metadata(self, recursive):
+        """
+        Link files do not have ctime and must be dereferenced before.
+        However, they can link to another link file or they can be broken.
+        Design decision: ignoring link files alltogether. Their source
+        should speak for themselves.
+
+        @param recursive: if False, only the files of startdir are returned
+        @param return: list of FileRecord objects of all files which are no links
+        """
+
+        def derive(directories):
+            return [x for directory in directories for x in directory.files if not x.is_link]
+
+        return self._memoize('files_with_metadata', recursive, derive)
+
+    def get_tag_counts(self, recursive):
+        """
+        Counts the tags of all file names (including links) and of all
+        directory names that were found in the traversed directories.
+
+        @param recursive: if False, only the files and sub-directories of startdir are counted
+        @param return: dict of tags and their number of occurrence
+        """
+
+        def derive(directories):
+            tags = {}
+            for directory in directories:
+                for currentfile in directory.files:
+                    for tag in currentfile.filetags:
+                        tags[tag] = tags.get(tag, 0) + 1
+                for dirname in directory.subdirs:
+                    for tag in parse_basename(dirname).tags:
+                        tags[tag] = tags.get(tag, 0) + 1
+            return tags
+
+        return self._memoize('tag_counts', recursive, derive)
+
+    def get_file_tag_counts(self, recursive):
+        """
+        Counts the number of files (no links) having each tag either as
+        file tag or as path tag.
+
+        @param recursive: if False, only the files of startdir are counted
+        @param return: dict of tags and their number of tagged files
+        """
+
+        def derive(directories):
+            tags = {}
+            for currentfile in self.get_files_with_metadata(recursive):
+                for tag in currentfile.alltags:
+                    tags[tag] = tags.get(tag, 0) + 1
+            return tags
+
+        return self._memoize('file_tag_counts', recursive, derive)
+
+    def get_filenames(self, recursive):
+        """
+        @param recursive: if False, the basenames of the files of startdir are returned
+        @param return: list of file names (including links); absolute paths if recursive
+        """
+
+        def derive(directories):
+            if recursive:
+                return [os.path.join(directory.path, x.filename) for directory in directories for x in directory.files]
+            else:
+                return [x.filename for directory in directories for x in directory.files]
+
+        return self._memoize('filenames', recursive, derive)
+
+    def get_inverted_tag_index(self, recursive):
+        """
+        @param recursive: if False, only the files of startdir are indexed
+        @param return: InvertedTagIndex of the file tags, path tags and datestamps of all files
+                       (including links) with the file names of get_filenames()
+        """
+
+        def derive(directories):
+            return InvertedTagIndex(self.get_filenames(recursive),
+                                    [x.filetags for directory in directories for x in directory.files],
+                                    [directory.pathtags for directory in directories for x in directory.files],
+                                    [x.datestamp for directory in directories for x in directory.files])
+
+        return self._memoize('inverted_tag_index', recursive, derive)
+
+
+class ScanCache(object):
+    """
+    Keeps TagScan objects for re-use within one invocation as well as
+    within long running processes which call filetags functions
+    repeatedly (e.g., integrations in image viewers).
+
+    Scans are keyed by their normalized absolute startdir and their
+    recursion flag. A recursive scan also serves non-recursive lookups
+    of its startdir. Scans of modified directories are dropped on
+    lookup; a non-recursive lookup only checks startdir itself. The
+    least recently used scans are evicted when more than max_scans
+    scans or more than max_files file records are cached.
+    """
+
+    def __init__(self, max_scans=SCAN_CACHE_MAX_SCANS, max_files=SCAN_CACHE_MAX_FILES):
+        """
+        @param max_scans: maximum number of cached scans
+        @param max_files: maximum number of file records of all cached scans
+        """
+
+        self.max_scans = max_scans
+        self.max_files = max_files
+        self.num_files = 0
+        self.scans = collections.OrderedDict()  # (startdir, recursive) -> TagScan; least recently used first
+
+    @staticmethod
+    def get_key(startdir, recursive):
+        return os.path.normcase(os.path.abspath(startdir)), bool(recursive)
+
+    def get(self, startdir, recursive):
+        """
+        @param startdir: string of a directory
+        @param recursive: if True, only recursive scans are returned
+        @param return: an up-to-date TagScan or None
+        """
+
+        for key in [self.get_key(startdir, True)] if recursive else \
+                [self.get_key(startdir, False), self.get_key(startdir, True)]:
+            scan = self.scans.get(key)
+            if not scan:
+                continue
+            if not scan.is_up_to_date(recursive):  # only the directories the lookup needs
+                logging.debug('ScanCache: dropping outdated scan of [%s]' % scan.startdir)
+                self.remove(key)
+                continue
+            self.scans.move_to_end(key)
+            return scan
+        return None
+
+    def put(self, scan):
+        """
+        @param scan: TagScan to add; replaces a previous scan with the same key
+        """
+
+        key = self.get_key(scan.startdir, scan.recursive)
+        self.remove(key)
+        self.scans[key] = scan
+        self.num_files += scan.num_files
+        while len(self.scans) > 1 and (len(self.scans) > self.max_scans or self.num_files > self.max_files):
+            self.remove(next(iter(self.scans)))
+        if scan.num_files > self.max_files:
+            logging.debug('ScanCache: scan of [%s] exceeds the cache with %i files' % (scan.startdir, scan.num_files))
+            self.remove(key)
+
+    def remove(self, key):
+        scan = self.scans.pop(key, None)
+        if scan:
+            self.num_files -= scan.num_files
+
+    def clear(self):
+        self.scans.clear()
+        self.num_files = 0
+
+
+def get_tag_scan(startdir, recursive, use_cache=True):
+    """
+    Returns the TagScan of startdir. Up-to-date scans are re-used from
+    the ScanCache. A non-recursive request is answered from a cached
+    recursive scan as well.
+
+    @param startdir: string of an existing directory
+    @param recursive: if True, the whole hierarchy below startdir is required
+    @param use_cache: if False, the file system is always traversed again
+    @param return: TagScan
+    """
+
+    global scan_cache
+    if not scan_cache:
+        scan_cache = ScanCache()
+
+    if use_cache:
+        scan = scan_cache.get(startdir, recursive)
+        if scan:
+            logging.debug('get_tag_scan: re-using scan of [%s]' % scan.startdir)
+            return scan
+
+    scan = TagScan(startdir, recursive, index=get_persistent_tag_index(startdir))
+    scan_cache.put(scan)
+    return scan
+
+
+def recursive_listing_requested():
+    "Returns True if the command line options require tag listings of the whole hierarchy"
+
+    # Enable recursive directory traversal for specific options:
+    return bool(options.recursive and (options.list_tags_by_alphabet or
+                                       options.list_tags_by_number or
+                                       options.list_unknown_tags or
+                                       options.tag_gardening))
+
+
+def get_files_with_metadata(startdir=os.getcwd(), use_cache=True):
+    """
+    Traverses the file system starting with given directory,
+    returns the files (no links) with their metadata as FileRecord
+    objects derived from the TagScan of startdir.
+
+    With --index, directories that did not change since the last run
+    are read from the PersistentTagIndex instead of the file system.
+
+    @param use_cache: if False, the file system is traversed again; default = True
+    @param return: list of FileRecord objects
+    """
+
+    assert(os.path.isdir(startdir))
+
+    recursive = recursive_listing_requested()
+    files = get_tag_scan(startdir, recursive, use_cache).get_files_with_metadata(recursive)
+    logging.debug('get_files_with_metadata: found %i files for directory: %s' % (len(files), startdir))
+    return files
+
+
+def get_tags_from_files_and_subfolders(startdir=os.getcwd(), use_cache=True):
+    """
+    Traverses the file system starting with given directory,
+    returns dict of all tags of all file names and directory names.
+    The result is derived from the TagScan of startdir.
+
+    @param use_cache: if False, the file system is traversed again; default = True
+    @param return: dict of tags and their number of occurrence
+    """
+
+    assert(os.path.isdir(startdir))
+
+    recursive = recursive_listing_requested()
+    tags = get_tag_scan(startdir, recursive, use_cache).get_tag_counts(recursive)
+    logging.debug('get_tags_from_files_and_subfolders: found %i tags for directory: %s' % (len(tags), startdir))
+    return tags
+
+
+def find_similar_tags(tag, tags):
+    """
+    Returns a list of entries of tags that are similar to tag (but not same as tag)
+
+    @param tag: a (unicode) string that represents a tag
+    @param tags: a list of (unicode) strings
+    @param return: list of tags that are similar to tag
+    """
+
+    assert(tag.__class__ == str)
+    assert(tags.__class__ == list)
+
+    safe_import('difflib')  # for good enough matching words
+    similar_tags = difflib.get_close_matches(tag, tags, n=SIMILAR_TAGS_MAX_MATCHES, cutoff=SIMILAR_TAGS_CUTOFF)
+    close_but_not_exact_matches = []
+
+    # omit exact matches   FIXXME: this can be done in one eloquent line -> refactor
+    for match in similar_tags:
+        if match != tag:
+            close_but_not_exact_matches.append(match)
+
+    return close_but_not_exact_matches
+
+
+class SimilarTagIndex(object):
+    """
+    Answers find_similar_tags() for many tags of the same list of tags
+    without comparing each tag to all others.
+
+    difflib only accepts a candidate whose quick_ratio() reaches the
+    cutoff, i.e., which shares enough characters with the tag no matter
+    in which order. Two such tags always share at least one of the
+    rarest characters of each of them (prefix filtering). Each tag is
+    therefore indexed by its rarest characters only and difflib checks
+    just the tags of a suitable length that share one of them with the
+    tag looked for. The results are identical to find_similar_tags().
+    """
+
+    def __init__(self, tags):
+        """
+        @param tags: a list of (unicode) strings which are searched for similar tags
+        """
+
+        safe_import('difflib')
+        self.tags = list(tags)
+        tokens_of_tags = [self.get_tokens(tag) for tag in self.tags]
+        self.frequency = collections.Counter(itertools.chain.from_iterable(tokens_of_tags))
+        self.bits = {token: 1 << bit for bit, token in enumerate(self.frequency)}
+        self.masks = [self.get_mask(tokens) for tokens in tokens_of_tags]  # the tokens of a tag as bits of an int
+        self.empty_tag_ids = [tag_id for tag_id, tag in enumerate(self.tags) if not tag]
+        # length → token → ids of the tags of this length having the token among their rarest; a tag
+        # needs less common characters with longer tags so fewer of its tokens are indexed for them:
+        self.index_for_shorter_tags = {}
+        self.index_for_longer_tags = {}
+        for tag_id, tokens in enumerate(tokens_of_tags):
+            length = len(tokens)
+            if length:
+                rarest_first = self.sort_by_rarity(tokens)
+                for index, other_length in ((self.index_for_shorter_tags, None), (self.index_for_longer_tags, length)):
+                    index = index.setdefault(length, {})
+                    for token in rarest_first[:length - self.get_min_common_characters(length, other_length) + 1]:
+                        index.setdefault(token, []).append(tag_id)
+
+    @staticmethod
+    def get_tokens(tag):
+        """
+        @param tag: a (unicode) string
+        @param return: list of (character, n) for the n-th occurrence of each character in tag
+        """
+
+        occurrences = {}
+        tokens = []
+        for character in tag:
+            occurrences[character] = occurrences.get(character, 0) + 1
+            tokens.append((character, occurrences[character]))
+        return tokens
+
+    def get_mask(self, tokens):
+        """
+        @param tokens: list of tokens of a tag, see get_tokens()
+        @param return: int with the bits of the tokens set; tokens no indexed tag has are left out
+        """
+
+        mask = 0
+        for token in tokens:
+            mask |= self.bits.get(token, 0)
+        return mask
+
+    @staticmethod
+    def get_min_common_characters(length, other_length=None):
+        """
+        @param length: length of a tag
+        @param other_length: length of the other tag; None for the shortest tag that can be similar
+        @param return: number of characters two similar tags have in common at least
+        """
+
+        if other_length is None:
+            other_length = SIMILAR_TAGS_CUTOFF * length / (2 - SIMILAR_TAGS_CUTOFF)
+        # rounding down (and the epsilon against float errors) only adds candidates:
+        return max(1, math.floor(SIMILAR_TAGS_CUTOFF * (length + other_length) / 2 - 1e-9))
+
+    def sort_by_rarity(self, tokens):
+        """
+        Two tags sharing at least n tokens have at least one token in
+        common among the first len(tokens)-n+1 tokens of this order.
+
+        @param tokens: list of tokens of a tag, see get_tokens()
+        @param return: list of the tokens, rarest first
+        """
+
+        return sorted(tokens, key=lambda token: (self.frequency.get(token, 0), token))
+
+    def get_scored_matches(self, tag):
+        """
+        @param tag: a (unicode) string that represents a tag
+        @param return: list of (ratio, similar tag) including exact matches, best matches first
+        """
+
+        if not tag:
+            return [(1.0, self.tags[tag_id]) for tag_id in self.empty_tag_ids]
+
+        tokens = self.get_tokens(tag)
+        mask = self.get_mask(tokens)
+        rarest_first = self.sort_by_rarity(tokens)
+        candidate_ids = []
+        # the checks of difflib.get_close_matches(): the number of common tokens is the number of
+        # matching characters of quick_ratio() and the ratios are calculated like in difflib:
+        for length in self.index_for_shorter_tags:
+            if 2.0 * min(length, len(tag)) / (length + len(tag)) < SIMILAR_TAGS_CUTOFF:
+                continue  # real_quick_ratio()
+            if length <= len(tag):
+                index = self.index_for_longer_tags[length]
+            else:
+                index = self.index_for_shorter_tags[length]
+            ids_of_length = set()
+            for token in rarest_first[:len(tag) - self.get_min_common_characters(len(tag), length) + 1]:
+                ids_of_length.update(index.get(token, ()))
+            min_common_tokens = 0
+            while 2.0 * min_common_tokens / (length + len(tag)) < SIMILAR_TAGS_CUTOFF:
+                min_common_tokens += 1  # quick_ratio()
+            masks = self.masks
+            candidate_ids.extend(x for x in ids_of_length if (mask & masks[x]).bit_count() >= min_common_tokens)
+        return self.compare(tag, candidate_ids)
+
+    def compare(self, tag, candidate_ids):
+        """
+        Compares tag with the candidates which passed quick_ratio().
+
+        The matching characters of ratio() form a common subsequence of
+        both tags. Candidates whose longest common subsequence is too
+        short are therefore skipped before difflib compares them. It is
+        computed bit-parallel: each bit of an int stands for one
+        character of tag (Hyyrö's variant of Allison and Dix).
+
+        @param tag: a (unicode) string that represents a tag
+        @param candidate_ids: list of ids of tags
+        @param return: list of (ratio, similar tag), best matches first
+        """
+
+        positions = {}  # character → int with the bits of its positions in tag
+        for position, character in enumerate(tag):
+            positions[character] = positions.get(character, 0) | (1 << position)
+        all_positions = (1 << len(tag)) - 1
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(tag)
+        matches = []
+        for tag_id in candidate_ids:
+            candidate = self.tags[tag_id]
+            unmatched = all_positions
+            for character in candidate:
+                matched = unmatched & positions.get(character, 0)
+                unmatched = ((unmatched + matched) | (unmatched - matched)) & all_positions
+            if 2.0 * (len(tag) - unmatched.bit_count()) / (len(candidate) + len(tag)) < SIMILAR_TAGS_CUTOFF:
+                continue
+            matcher.set_seq1(candidate)
+            ratio = matcher.ratio()
+            if ratio >= SIMILAR_TAGS_CUTOFF:
+                matches.append((ratio, candidate))
+        return sorted(matches, reverse=True)
+
+    def get_all_scored_matches(self, tags):
+        """
+        get_scored_matches() of many tags at once. If NumPy is installed
+        and there are enough pairs of tags, the common characters of all
+        pairs are counted by matrix products, chunk by chunk, instead of
+        looking up each tag in the index. Only the pairs passing
+        quick_ratio() are compared further in both cases.
+
+        @param tags: list of (unicode) strings that represent tags
+        @param return: dict of tag → list of (ratio, similar tag) including exact matches, best matches first
+        """
+
+        tags = list(dict.fromkeys(tags))
+        scored_matches = {tag: self.get_scored_matches(tag) for tag in tags if not tag}
+        tags = [tag for tag in tags if tag]
+        if len(tags) * len(self.tags) < SIMILAR_TAGS_BATCH_MIN_PAIRS or not import_numpy():
+            scored_matches.update((tag, self.get_scored_matches(tag)) for tag in tags)
+            return scored_matches
+
+        # rows of tags, columns of tokens; the products of the rows are the numbers of common tokens:
+        columns = {token: column for column, token in enumerate(self.bits)}
+        matrix = self.get_token_matrix(self.tags, columns)
+        lengths = numpy.array([len(tag) for tag in self.tags])
+        chunk_size = max(1, SIMILAR_TAGS_BATCH_CHUNK_PAIRS // max(1, len(self.tags)))
+        for chunk in get_chunks(tags, chunk_size):
+            common_tokens = (self.get_token_matrix(chunk, columns) @ matrix.T).astype(numpy.float64)
+            chunk_lengths = numpy.array([len(tag) for tag in chunk])[:, None]
+            # real_quick_ratio() and quick_ratio() calculated like in difflib; float32 counts small integers exactly:
+            candidates = (2.0 * numpy.minimum(chunk_lengths, lengths) / (chunk_lengths + lengths) >= SIMILAR_TAGS_CUTOFF) & \
+                (2.0 * common_tokens / (chunk_lengths + lengths) >= SIMILAR_TAGS_CUTOFF)
+            for row, tag in enumerate(chunk):
+                scored_matches[tag] = self.compare(tag, numpy.flatnonzero(candidates[row]).tolist())
+        return scored_matches
+
+    def get_token_matrix(self, tags, columns):
+        """
+        @param tags: list of (unicode) strings
+        @param columns: dict of token → column
+        @param return: NumPy matrix with one row per tag having 1 in the columns of its tokens
+        """
+
+        matrix = numpy.zeros((len(tags), len(columns)), dtype=numpy.float32)
+        for row, tag in enumerate(tags):
+            matrix[row, [columns[token] for token in self.get_tokens(tag) if token in columns]] = 1
+        return matrix
+
+    def find_similar_tags(self, tag):
+        """
+        @param tag: a (unicode) string that represents a tag
+        @param return: list of tags that are similar to tag (but not same as tag)
+        """
+
+        return [match for ratio, match in self.get_scored_matches(tag)[:SIMILAR_TAGS_MAX_MATCHES] if match != tag]
+
+
+class SimilarTagsCache(object):
+    """
+    The similar tags of one run of filetags. The reports compare tags
+    with different sets of tags (the corpora) which are mostly subsets
+    of the first one, e.g., a part of the found tags together with the
+    vocabulary. Each corpus gets a version number once; a subset of a
+    corpus re-uses its SimilarTagIndex and the matches computed for it
+    so that looking up a tag again costs a dict access.
+    """
+
+    def __init__(self):
+        self.versions = {}  # frozenset of the tags of a corpus → version
+        self.corpora = []  # version → frozenset of the tags
+        self.indices = []  # version → SimilarTagIndex of the corpus or of a superset of it
+        self.scored_matches = {}  # (tag, id() of a SimilarTagIndex) → list of (ratio, match)
+        self.similar_tags = {}  # (tag, version) → list of similar tags
+
+    def get_version(self, tags):
+        """
+        @param tags: collection of (unicode) strings which are compared with; duplicates do not count
+        @param return: version of the corpus for find_similar_tags()
+        """
+
+        corpus = frozenset(tags)
+        version = self.versions.get(corpus)
+        if version is None:
+            version = len(self.corpora)
+            superset_index = next((self.indices[x] for x in range(version) if corpus <= self.corpora[x]), None)
+            self.versions[corpus] = version
+            self.corpora.append(corpus)
+            self.indices.append(superset_index or SimilarTagIndex(corpus))
+        return version
+
+    def find_similar_tags(self, tag, version):
+        """
+        @param tag: a (unicode) string that represents a tag
+        @param version: version of the corpus from get_version()
+        @param return: list of tags of the corpus that are similar to tag (but not same as tag)
+        """
+
+        key = (tag, version)
+        if key not in self.similar_tags:
+            index = self.indices[version]
+            scored_matches = self.scored_matches.get((tag, id(index)))
+            if scored_matches is None:
+                scored_matches = self.scored_matches[(tag, id(index))] = index.get_scored_matches(tag)
+            if len(index.tags) != len(self.corpora[version]):
+                # the index belongs to a superset of the corpus:
+                scored_matches = [x for x in scored_matches if x[1] in self.corpora[version]]
+            self.similar_tags[key] = [match for ratio, match in scored_matches[:SIMILAR_TAGS_MAX_MATCHES]
+                                      if match != tag]
+        return self.similar_tags[key]
+
+
+    def add_similar_tags(self, tags, version):
+        """
+        Finds the similar tags of many tags in one batch so that
+        find_similar_tags() only looks them up.
+
+        @param tags: collection of (unicode) strings that represent tags
+        @param version: version of the corpus from get_version()
+        """
+
+        index = self.indices[version]
+        missing_tags = [tag for tag in tags if (tag, id(index)) not in self.scored_matches]
+        for tag, scored_matches in index.get_all_scored_matches(missing_tags).items():
+            self.scored_matches[(tag, id(index))] = scored_matches
+
+
+def get_similar_tags_cache():
+    """
+    @param return: the SimilarTagsCache of the current run
+    """
+
+    global similar_tags_cache
+    if not similar_tags_cache:
+        similar_tags_cache = SimilarTagsCache()
+    return similar_tags_cache
+
+
+def get_invalid_tags_for_vocabulary(tags, vocabulary):
+    """Return a list of tags not contained in the controlled vocabulary."""
+
+    normalized_vocabulary = set()
     for vocab_tag in vocabulary:
         if vocab_tag.startswith('-'):
             normalized_vocabulary.add(vocab_tag[1:])
@@ -1713,9 +3381,11 @@ def force_cv_validator(force_cv_enabled, tags_for_validation, vocabulary):
     return None
 
 def build_similar_to_invalid_tags_message(invalid_tags, vocabulary):
+    cache = get_similar_tags_cache()
+    version = cache.get_version(vocabulary)
     suggestions = []
     for tag in invalid_tags:
-        similar = find_similar_tags(tag, vocabulary)
+        similar = cache.find_similar_tags(tag, version)
         if similar:
             suggestions.append(tag + " -> " + BETWEEN_TAG_SEPARATOR.join(similar))
     if not suggestions:
@@ -1752,6 +3422,10 @@ def print_tag_dict(tag_dict_reference, vocabulary=False, sort_index=0,
     if vocabulary:
         print("\n  (Tags marked with \"" + HINT_FOR_BEING_IN_VOCABULARY_TEMPLATE.strip() +
               "\" appear in your vocabulary.)")
+    if vocabulary and print_similar_vocabulary_tags:
+        cache = get_similar_tags_cache()
+        version = cache.get_version(set(tag_dict.keys()).union(set(vocabulary)))  # unified elements of both lists
+        cache.add_similar_tags(tag_dict.keys(), version)
     print("\n {0:{1}} : {2:{3}}".format('count', maxlength_count, 'tag', maxlength_tags))
     print(" " + '-' * (maxlength_tags + maxlength_count + 7))
     for tuple in sorted(list(tag_dict.items()), key=operator.itemgetter(sort_index)):
@@ -1764,8 +3438,7 @@ def print_tag_dict(tag_dict_reference, vocabulary=False, sort_index=0,
 
         similar_tags_list = []
         if vocabulary and print_similar_vocabulary_tags:
-            tags_for_comparing = list(set(tag_dict.keys()).union(set(vocabulary)))  # unified elements of both lists
-            similar_tags_list = find_similar_tags(tuple[0], tags_for_comparing)
+            similar_tags_list = cache.find_similar_tags(tuple[0], version)
             if similar_tags_list:
                 similar_tags = '      (similar to:  ' + ', '.join(similar_tags_list) + ')'
             else:
@@ -1800,6 +3473,10 @@ def print_tag_set(tag_set, vocabulary=False, print_similar_vocabulary_tags=False
     if vocabulary:
         print("\n  (Tags marked with \"" + HINT_FOR_BEING_IN_VOCABULARY_TEMPLATE.strip() +
               "\" appear in your vocabulary.)\n")
+    if vocabulary and print_similar_vocabulary_tags:
+        cache = get_similar_tags_cache()
+        version = cache.get_version(tag_set.union(set(vocabulary)))  # unified elements of both lists
+        cache.add_similar_tags(tag_set, version)
 
     for tag in sorted(tag_set):
 
@@ -1809,8 +3486,7 @@ def print_tag_set(tag_set, vocabulary=False, print_similar_vocabulary_tags=False
             hint_for_being_in_vocabulary = ''
 
         if vocabulary and print_similar_vocabulary_tags:
-            tags_for_comparing = list(tag_set.union(set(vocabulary)))  # unified elements of both lists
-            similar_tags_list = find_similar_tags(tag, tags_for_comparing)
+            similar_tags_list = cache.find_similar_tags(tag, version)
             if similar_tags_list:
                 similar_tags = '      (similar to:  ' + ', '.join(similar_tags_list) + ')'
             else:
@@ -1858,8 +3534,11 @@ def handle_tag_gardening(vocabulary):
     @param return: -
     """
 
-    files_with_metadata = get_files_with_metadata(startdir=os.getcwd())  # = cache_of_files_with_metadata of current dir
-    tag_dict = get_tags_from_files_and_subfolders(startdir=os.getcwd())
+    # one single traversal for the files and the number of files per tag:
+    recursive = recursive_listing_requested()
+    scan = get_tag_scan(os.getcwd(), recursive)
+    files_with_metadata = scan.get_files_with_metadata(recursive)
+    tag_dict = scan.get_file_tag_counts(recursive)
     if not tag_dict:
         print("\nNo file containing tags found in this folder hierarchy.\n")
         return
@@ -1878,15 +3557,15 @@ def handle_tag_gardening(vocabulary):
         else:
             return str(round(100*fraction/total, 1)) + '%'
 
-    files_without_alltags = [x for x in files_with_metadata if not x['alltags']]
+    files_without_alltags = [x for x in files_with_metadata if not x.alltags]
     num_files_without_alltags = len(files_without_alltags)
 
-    files_without_filetags = [x for x in files_with_metadata if not x['filetags']]
+    files_without_filetags = [x for x in files_with_metadata if not x.filetags]
     num_files_without_filetags = len(files_without_filetags)
 
     num_files_with_alltags = number_of_files - len(files_without_alltags)
 
-    files_with_filetags = [x for x in files_with_metadata if x['filetags']]
+    files_with_filetags = [x for x in files_with_metadata if x.filetags]
     num_files_with_filetags = len(files_with_filetags)
 
     print("\nNumber of files without tags including pathtags: " + str(num_files_without_alltags) +
@@ -1934,7 +3613,7 @@ def handle_tag_gardening(vocabulary):
                 if len(set(tag_dict.keys()).intersection(set(taggroup))) > 0:
                     files_with_any_tag_from_taggroup = [x for x in
                                                         files_with_metadata if
-                                                        len(set(x['alltags']).intersection(set(taggroup))) > 0]
+                                                        not set(taggroup).isdisjoint(x.alltags)]
                     num_files_with_any_tag_from_taggroup = len(files_with_any_tag_from_taggroup)
                     print('\nTag group ' + str(taggroup) + ":\n   Number of files with tag from tag group: " +
                           str(num_files_with_any_tag_from_taggroup) +
@@ -1943,7 +3622,7 @@ def handle_tag_gardening(vocabulary):
 
                     longest_tagname = max(taggroup, key=len)
                     for tag in taggroup:
-                        files_with_tag_from_taggroup = [x for x in files_with_metadata if tag in x['alltags']]
+                        files_with_tag_from_taggroup = [x for x in files_with_metadata if tag in x.alltags]
                         num_files_with_tag_from_taggroup = len(files_with_tag_from_taggroup)
                         if num_files_with_tag_from_taggroup > 0:
                             print('   {:<{}}  •  {:>{}} tagged file(s)   = {:>5} of tag group'.format(
@@ -1964,17 +3643,21 @@ def handle_tag_gardening(vocabulary):
 
     if vocabulary:
         print("\nTags which have similar other tags are probably typos or plural/singular forms of others:\n  (first for tags not in vocabulary, second for vocbaulary tags)")
-        tags_for_comparing = list(set(tag_dict.keys()).union(set(vocabulary)))  # unified elements of both lists
+        cache = get_similar_tags_cache()
+        version = cache.get_version(set(tag_dict.keys()).union(set(vocabulary)))  # unified elements of both lists
+        cache.add_similar_tags(tag_dict.keys(), version)
         only_similar_tags_by_alphabet_dict = {key: value for key, value in list(tag_dict.items())
-                                              if find_similar_tags(key, tags_for_comparing)}
+                                              if cache.find_similar_tags(key, version)}
 
         print_tag_dict({key: value for key, value in only_similar_tags_by_alphabet_dict.items() if key not in vocabulary}, vocabulary, sort_index=0, print_similar_vocabulary_tags=True)
         print_tag_dict({key: value for key, value in only_similar_tags_by_alphabet_dict.items() if key in vocabulary}, vocabulary, sort_index=0, print_similar_vocabulary_tags=True)
     else:
         print("\nTags which have similar other tags are probably typos or plural/singular forms of others:")
-        tags_for_comparing = list(set(tag_dict.keys()))
+        cache = get_similar_tags_cache()
+        version = cache.get_version(tag_dict.keys())
+        cache.add_similar_tags(tag_dict.keys(), version)
         only_similar_tags_by_alphabet_dict = {key: value for key, value in list(tag_dict.items())
-                                              if find_similar_tags(key, tags_for_comparing)}
+                                              if cache.find_similar_tags(key, version)}
         print_tag_dict(only_similar_tags_by_alphabet_dict, vocabulary, sort_index=0, print_similar_vocabulary_tags=True)
 
     tags_only_used_once_set = set(tags_only_used_once_dict.keys())
@@ -2001,7 +3684,6 @@ def locate_file_in_cwd_and_parent_directories(startfile, filename):
     logging.debug('locate_file_in_cwd_and_parent_directories: called with startfile \"%s\" and filename \"%s\" ..' %
                   (startfile, filename))
 
-    original_dir = os.getcwd()
     filename_in_startfile_dir = os.path.join(os.path.dirname(os.path.abspath(startfile)), filename)
     filename_in_startdir = os.path.join(startfile, filename)
     if startfile and os.path.isfile(startfile) and os.path.isfile(filename_in_startfile_dir):
@@ -2036,17 +3718,19 @@ def locate_file_in_cwd_and_parent_directories(startfile, filename):
         logging.debug('locate_file_in_cwd_and_parent_directories: looking for \"%s\" in directory \"%s\" .......' %
                       (filename, parent_dir))
 
-        while parent_dir != os.getcwd():
-            os.chdir(parent_dir)
-            filename_to_look_for = os.path.abspath(os.path.join(os.getcwd(), filename))
+        # walking up the absolute path instead of changing the working
+        # directory keeps this usable from threads and other programs:
+        while True:
+            filename_to_look_for = os.path.join(parent_dir, filename)
             if os.path.isfile(filename_to_look_for):
                 logging.debug('locate_file_in_cwd_and_parent_directories: found \"%s\" in directory \"%s\" ........' %
                               (filename, parent_dir))
-                os.chdir(original_dir)
                 return filename_to_look_for
-            parent_dir = os.path.abspath(os.path.join(os.getcwd(), os.pardir))
+            next_parent_dir = os.path.dirname(parent_dir)
+            if next_parent_dir == parent_dir:
+                break
+            parent_dir = next_parent_dir
 
-        os.chdir(original_dir)
         logging.debug('locate_file_in_cwd_and_parent_directories: did NOT find \"%s\" in current directory or any parent directory' %
                       filename)
         return False
@@ -2121,69 +3805,213 @@ def locate_and_parse_controlled_vocabulary(startfile):
         logging.debug('locate_and_parse_controlled_vocabulary: could not derive filename for controlled vocabulary')
         return []
 
-def parse_controlled_vocabulary(filename):
-    """Parses a controlled vocabulary file."""
+def read_controlled_vocabulary(filename, included_files=None):
+    """
+    Reads a controlled vocabulary file and the files it includes
+    without changing the state of the module.
+
+    @param filename: file name of the controlled vocabulary
+    @param included_files: optional list of real paths of files which are not read again; the files of
+                           the include graph are appended including the missing ones
+    @param return: list of tags, list of lists of unique tags, list of do-not-suggest tags
+    """
+
+    if included_files is None:
+        included_files = []
+    tags = []
+    unique_tags_groups = []
+    do_not_suggest = []
     files_to_include = []
 
-    logging.debug('parse_controlled_vocabulary: .filetags found: ' + filename)
-    if os.path.isfile(filename):
-        logging.debug('parse_controlled_vocabulary: found controlled vocabulary')
+    logging.debug('read_controlled_vocabulary: .filetags found: ' + filename)
+    included_files.append(os.path.realpath(filename))  # missing files as well: they belong to the include graph
+    if not os.path.isfile(filename):
+        logging.debug('read_controlled_vocabulary: controlled vocabulary is a non-existing file')
+        return tags, unique_tags_groups, do_not_suggest
+
+    with open(filename, encoding='utf-8') as filehandle:
+        logging.debug('read_controlled_vocabulary: reading controlled vocabulary in [%s]' % filename)
+        for rawline in filehandle:
+            if rawline.strip().lower().startswith(INCLUDE_PREFIX):
+                file_to_include = rawline.strip().removeprefix(INCLUDE_PREFIX)
+                current_file_dir = os.path.dirname(filename)
+                file_path = os.path.realpath(os.path.join(current_file_dir, file_to_include))
+                logging.debug('read_controlled_vocabulary: found include statement for file [%s]' % file_path)
+                if file_path not in included_files:
+                    files_to_include.append(file_path)
+                    logging.debug('read_controlled_vocabulary: including file [%s]' % file_path)
+
+            elif rawline.strip().lower().startswith(DONOTSUGGEST_PREFIX):
+                # parse and save do not suggest tags:
+                line = rawline[len(DONOTSUGGEST_PREFIX):].strip().lower()
+                for tag in line.split(BETWEEN_TAG_SEPARATOR):
+                    do_not_suggest.append(tag)
+            else:
 
-        included_files.append(os.path.realpath(filename))
+                # remove everyting after the first hash character (which is a comment separator)
+                line = rawline.strip().split('#')[0].strip()  # split and take everything before the first '#' as new "line"
 
-        tags = []
-        with open(filename, encoding='utf-8') as filehandle:
-            logging.debug('parse_controlled_vocabulary: reading controlled vocabulary in [%s]' %
-                            filename)
-            global controlled_vocabulary_filename
-            controlled_vocabulary_filename = filename
-            for rawline in filehandle:
-                if rawline.strip().lower().startswith(INCLUDE_PREFIX):
-                    file_to_include = rawline.strip().removeprefix(INCLUDE_PREFIX)
-                    current_file_dir = os.path.dirname(filename)
-                    file_path = os.path.realpath(os.path.join(current_file_dir, file_to_include))
-                    logging.debug('parse_controlled_vocabulary: found include statement for file [%s]' % file_path)
-                    if file_path not in included_files:
-                        files_to_include.append(file_path)
-                        logging.debug('parse_controlled_vocabulary: including file [%s]' % file_path)
-
-                elif rawline.strip().lower().startswith(DONOTSUGGEST_PREFIX):
-                    # parse and save do not suggest tags:
-                    line = rawline[len(DONOTSUGGEST_PREFIX):].strip().lower()
+                if len(line) == 0:
+                    # nothing left, line consisted only of a comment or was empty
+                    continue
+
+                if BETWEEN_TAG_SEPARATOR in line:
+                    ## if multiple tags are in one line, they are mutually exclusive: only has can be set via filetags
+                    logging.debug('read_controlled_vocabulary: found unique tags: %s' % (line))
+                    unique_tags_groups.append(line.split(BETWEEN_TAG_SEPARATOR))
                     for tag in line.split(BETWEEN_TAG_SEPARATOR):
-                        do_not_suggest_tags.append(tag)
+                        # *also* append unique tags to general tag list:
+                        tags.append(tag)
                 else:
+                    tags.append(line)
 
-                    # remove everyting after the first hash character (which is a comment separator)
-                    line = rawline.strip().split('#')[0].strip()  # split and take everything before the first '#' as new "line"
+    for file in files_to_include:
+        included_tags, included_unique_tags_groups, included_do_not_suggest = \
+            read_controlled_vocabulary(file, included_files)
+        tags.extend(included_tags)
+        unique_tags_groups.extend(included_unique_tags_groups)
+        do_not_suggest.extend(included_do_not_suggest)
 
-                    if len(line) == 0:
-                        # nothing left, line consisted only of a comment or was empty
-                        continue
+    logging.debug('read_controlled_vocabulary: controlled vocabulary has %i tags' % len(tags))
+    logging.debug('read_controlled_vocabulary: controlled vocabulary has %i groups of unique tags' %
+                  len(unique_tags_groups))
+    return tags, unique_tags_groups, do_not_suggest
+
+
+def get_file_signatures(filenames):
+    """
+    @param filenames: list of file names
+    @param return: list of (file name, mtime in ns, size) with None for both values of missing files
+    """
+
+    signatures = []
+    for filename in filenames:
+        try:
+            status = os.stat(filename)
+            signatures.append((filename, status.st_mtime_ns, status.st_size))
+        except OSError:
+            signatures.append((filename, None, None))
+    return signatures
+
+
+def get_vocabulary_snapshot_filename(key):
+    """
+    @param key: key of the vocabulary_cache
+    @param return: file name of the snapshot of the vocabulary in VOCABULARY_CACHE_DIRECTORY
+    """
+
+    import hashlib  # only needed when large vocabularies are cached
+    return os.path.join(VOCABULARY_CACHE_DIRECTORY,
+                        hashlib.sha1(os.fsencode('\0'.join(key))).hexdigest() + '.marshal')
+
+
+def read_vocabulary_snapshot(key):
+    """
+    @param key: key of the vocabulary_cache
+    @param return: the snapshot tuple from the disk or None
+    """
+
+    try:
+        with open(get_vocabulary_snapshot_filename(key), 'rb') as inputhandle:
+            snapshot = marshal.loads(inputhandle.read())  # marshal.load() would read in small pieces
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(snapshot, tuple) or len(snapshot) != 6 or \
+       snapshot[0] != VOCABULARY_CACHE_VERSION or snapshot[1] != key:
+        return None
+    return snapshot
+
+
+def write_vocabulary_snapshot(snapshot):
+    """
+    Writes a snapshot to the disk. Errors are ignored since the
+    vocabulary can always be parsed again.
+
+    @param snapshot: the snapshot tuple
+    """
+
+    filename = get_vocabulary_snapshot_filename(snapshot[1])
+    temporary_filename = None
+    safe_import('tempfile')
+    try:
+        os.makedirs(VOCABULARY_CACHE_DIRECTORY, exist_ok=True)
+        # a temporary file of its own for each writer, threads of this process included:
+        handle, temporary_filename = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=VOCABULARY_CACHE_DIRECTORY)
+        with os.fdopen(handle, 'wb') as outputhandle:
+            marshal.dump(snapshot, outputhandle)
+        os.replace(temporary_filename, filename)
+    except OSError as error:
+        logging.debug('write_vocabulary_snapshot: could not write [%s]: %s' % (filename, str(error)))
+        if temporary_filename:
+            try:
+                os.remove(temporary_filename)
+            except OSError:
+                pass
+
+
+def read_controlled_vocabulary_cached(filename, write_snapshot=True):
+    """
+    read_controlled_vocabulary() with a cache of the parsed
+    vocabularies. A cached vocabulary is valid as long as modification
+    time and size of all files of its include graph are unchanged and
+    files which were missing are still missing. Vocabularies of at
+    least VOCABULARY_CACHE_MIN_BYTES are also kept as marshal snapshots
+    in VOCABULARY_CACHE_DIRECTORY for the next invocations.
+
+    @param filename: file name of the controlled vocabulary
+    @param write_snapshot: if False, nothing is written to VOCABULARY_CACHE_DIRECTORY (e.g., for --dryrun)
+    @param return: list of tags, list of lists of unique tags, list of do-not-suggest tags,
+                   list of real paths of the files of the include graph
+    """
+
+    # relative includes are relative to the directory of filename, not the one of its real path:
+    key = (os.path.realpath(filename), os.path.realpath(os.path.dirname(os.path.abspath(filename))))
+    snapshot = vocabulary_cache.get(key) or read_vocabulary_snapshot(key)
+    if snapshot and get_file_signatures([x[0] for x in snapshot[2]]) == list(snapshot[2]):
+        logging.debug('read_controlled_vocabulary_cached: re-using the parsed vocabulary of [%s]' % filename)
+        vocabulary_cache[key] = snapshot
+        return list(snapshot[3]), [list(x) for x in snapshot[4]], list(snapshot[5]), [x[0] for x in snapshot[2]]
+
+    files = []
+    tags, unique_tags_groups, do_not_suggest = read_controlled_vocabulary(filename, files)
+    signatures = get_file_signatures(files)
+    vocabulary_cache.pop(key, None)
+    # a file modified within the resolution of its mtime could change again unnoticed:
+    racy_mtime_ns = (time.time() - VOCABULARY_CACHE_RACY_MTIME_SECONDS) * 1e9
+    if all(mtime is None or mtime < racy_mtime_ns for filename, mtime, size in signatures):
+        snapshot = (VOCABULARY_CACHE_VERSION, key, tuple(signatures), tuple(tags),
+                    tuple(tuple(x) for x in unique_tags_groups), tuple(do_not_suggest))
+        vocabulary_cache[key] = snapshot
+        if write_snapshot and sum(size for filename, mtime, size in signatures if size) >= VOCABULARY_CACHE_MIN_BYTES:
+            write_vocabulary_snapshot(snapshot)
+    return tags, unique_tags_groups, do_not_suggest, files
+
+
+def parse_controlled_vocabulary(filename):
+    """
+    Parses a controlled vocabulary file and adds its unique tags and
+    do-not-suggest tags to the ones of the module unless they were
+    added before.
+
+    @param filename: file name of the controlled vocabulary
+    @param return: list of tags
+    """
+
+    if os.path.isfile(filename):
+        global controlled_vocabulary_filename
+        controlled_vocabulary_filename = filename
+    tags, unique_tags_groups, do_not_suggest, files = read_controlled_vocabulary_cached(
+        filename, write_snapshot=not options.dryrun)
+    known_groups = set(tuple(x) for x in unique_tags)
+    for group in unique_tags_groups:
+        if tuple(group) not in known_groups:
+            known_groups.add(tuple(group))
+            unique_tags.append(group)
+    known_tags = set(do_not_suggest_tags)
+    do_not_suggest_tags.extend(x for x in dict.fromkeys(do_not_suggest) if x not in known_tags)
+    included_files.extend(x for x in files if x not in included_files)
+    return tags
 
-                    if BETWEEN_TAG_SEPARATOR in line:
-                        ## if multiple tags are in one line, they are mutually exclusive: only has can be set via filetags
-                        logging.debug('parse_controlled_vocabulary: found unique tags: %s' %
-                                        (line))
-                        unique_tags.append(line.split(BETWEEN_TAG_SEPARATOR))
-                        for tag in line.split(BETWEEN_TAG_SEPARATOR):
-                            # *also* append unique tags to general tag list:
-                            tags.append(tag)
-                    else:
-                        tags.append(line)
-
-        for file in files_to_include:
-            tags.extend(parse_controlled_vocabulary(file))
-
-        logging.debug('parse_controlled_vocabulary: controlled vocabulary has %i tags' %
-                        len(tags))
-        logging.debug('parse_controlled_vocabulary: controlled vocabulary has %i groups of unique tags' %
-                        (len(unique_tags) - 1))
-
-        return tags
-    else:
-        logging.debug('parse_controlled_vocabulary: controlled vocabulary is a non-existing file')
-        return []
 
 def get_tag_shortcut_information(tag_list, tags_get_added=True, tags_get_linked=False):
     """A list of tags from the list are printed to stdout. Each tag
@@ -2358,13 +4186,16 @@ def ask_for_tags_text_version(vocabulary, upto9_tags_for_shortcuts, hint_str, ta
     @param return: list of up to top nine keys according to the rank of their values
     """
 
+    safe_import('readline')  # for line editing and completion of input()
+
     completionhint = ''
     if vocabulary and len(vocabulary) > 0:
 
         assert(vocabulary.__class__ == list)
 
         # Register our completer function
-        readline.set_completer(SimpleCompleter(vocabulary).complete)
+        readline.set_completer(SimpleCompleter(vocabulary, options.completion[0] if options.completion
+                                               else COMPLETION_MODES[0]).complete)
 
         # Use the tab key for completion
         readline.parse_and_bind('tab: complete')
@@ -2435,102 +4266,359 @@ def ask_for_tags_gui_version(vocabulary, upto9_tags_for_shortcuts, hint_str, tag
     logging.debug("len(files) [%s]" % number_of_files_str)
     logging.debug("files: %s" % str(options.files))
 
-    # Create the Tkinter window
-    root = tk.Tk()
+    # Create the Tkinter window
+    root = tk.Tk()
+
+    # Auto DPI scaling
+    dpi = root.winfo_fpixels("1i")
+    root.tk.call("tk", "scaling", dpi / 72)
+    # Font tweak (optional but helps)
+    font.nametofont("TkDefaultFont").configure(size=16)
+    
+    # Create an instance of the TagDialog with the vocabulary
+    guidialog = TagDialog(root, vocabulary, upto9_tags_for_shortcuts, tags_for_visual, number_of_files, hint_str, tag_list)
+
+    # Run the Tkinter main loop
+    root.mainloop()
+
+    if guidialog.cancelled:
+        return False
+    entered_tags = guidialog.entered_tags.strip()
+    logging.debug(f"interactive GUI mode: entered tags: {entered_tags}")
+    return extract_tags_from_argument(entered_tags)
+
+
+def ask_for_tags(vocabulary, controlled_vocabulary, upto9_tags_for_shortcuts, tags_for_visual=None, gui=None):
+    """
+    Wrapper-function for the text-based version and the GUI version:
+
+    Takes a vocabulary and optional up to nine tags for shortcuts and interactively asks
+    the user to enter tags. Aborts program if no tags were entered. Returns list of
+    entered tags.
+
+    @param vocabulary: array containing the controlled vocabulary
+    @param upto9_tags_for_shortcuts: array of tags which can be used to generate number-shortcuts
+    @param return: list of up to top nine keys according to the rank of their values
+    """
+
+    hint_str, tag_list = get_tag_shortcut_information(upto9_tags_for_shortcuts,
+                                                          tags_get_added=(not options.remove and not options.tagfilter),
+                                                          tags_get_linked=options.tagfilter)
+
+    force_cv_enabled = options.force_cv and not options.remove and not options.tagfilter and not options.tagtrees
+    if force_cv_enabled and not controlled_vocabulary:
+        print(colorama.Fore.RED + "No controlled vocabulary (.filetags) found; --force-cv disabled." + colorama.Style.RESET_ALL)
+        force_cv_enabled = False
+
+    previous_input = None
+    previous_error = None
+    while True:
+        if gui:
+            tags_from_userinput = ask_for_tags_gui_version(
+                vocabulary, upto9_tags_for_shortcuts, hint_str, tag_list, tags_for_visual)
+        else:
+            tags_from_userinput = ask_for_tags_text_version(
+                vocabulary, upto9_tags_for_shortcuts, hint_str, tag_list, tags_for_visual,
+                prompt_prefill=previous_input, invalid_tags=previous_error)
+            previous_input = BETWEEN_TAG_SEPARATOR.join(tags_from_userinput) if tags_from_userinput else previous_input
+
+        if not tags_from_userinput:
+            logging.info("no tags given, exiting.")
+            sys.stdout.flush()
+            sys.exit(0)
+
+        validation_error = force_cv_validator(force_cv_enabled, tags_from_userinput, controlled_vocabulary)
+        if validation_error:
+            if not gui:
+                previous_error = validation_error
+                continue
+            previous_error = None
+
+        if len(upto9_tags_for_shortcuts) > 0:
+            # check if user entered number shortcuts for tags to be removed:
+            tags_from_userinput = check_for_possible_shortcuts_in_entered_tags(
+                tags_from_userinput, upto9_tags_for_shortcuts)
+        return tags_from_userinput
+
+
+def get_files_of_directory(directory):
+    """
+    Lists the files of the given directory and returns a list of its files.
+
+    @param directory: string of an existing directory
+    @param return: list of file names of given directory
+    """
+
+    logging.debug('get_files_of_directory(' + directory + ') called ...')
+    files = get_tag_scan(directory, options.recursive).get_filenames(options.recursive)
+    logging.debug('get_files_of_directory(' + directory + ') finished with ' + str(len(files)) + ' items')
+
+    return files
+
+
+def get_files_of_directory_matching_tags(directory, tags):
+    """
+    Returns the files of the given directory that contain all given
+    tags. The files are looked up in the InvertedTagIndex of the
+    TagScan of the directory.
+
+    @param directory: string of an existing directory
+    @param tags: array of tags
+    @param return: list of file names like get_files_of_directory() that contain all tags
+    """
+
+    index = get_tag_scan(directory, options.recursive).get_inverted_tag_index(options.recursive)
+    files = index.get_filenames(index.matching_all(tags))
+    logging.debug('get_files_of_directory_matching_tags(' + directory + ') found ' + str(len(files)) + ' items')
+    return files
+
+
+class QueryNode(abc.ABC):
+    """
+    Base class of the nodes of a compiled query, see compile_query().
+    Each node can estimate the number of files it matches cheaply and
+    evaluates to the set of ids of the matching files of an
+    InvertedTagIndex.
+    """
+
+    @abc.abstractmethod
+    def estimate(self, index):
+        pass
+
+    @abc.abstractmethod
+    def evaluate(self, index):
+        pass
+
+
+class TagQueryNode(QueryNode):
+    "Matches files having a tag, either as file tag or with path:tag as path tag"
+
+    def __init__(self, tag, pathtag=False):
+        self.tag = tag
+        self.pathtag = pathtag
+
+    def evaluate(self, index):
+        if self.pathtag:
+            return index.get_pathtag_ids(self.tag)
+        return index.get_ids(self.tag)
+
+    def estimate(self, index):
+        return len(self.evaluate(index))
+
+    def __str__(self):
+        return (QUERY_PATHTAG_PREFIX if self.pathtag else '') + self.tag
+
+
+class DateQueryNode(QueryNode):
+    "Matches files whose ISO datestamp of the file name compares to a (partial) date"
+
+    def __init__(self, operator, date):
+        self.operator = operator
+        self.date = date
+
+    def evaluate(self, index):
+        return index.get_date_ids(self.operator, self.date)
+
+    def estimate(self, index):
+        start, stop = index.get_date_range(self.operator, self.date)
+        return stop - start
+
+    def __str__(self):
+        return 'date' + self.operator + self.date
+
+
+class NotQueryNode(QueryNode):
+
+    def __init__(self, child):
+        self.child = child
+
+    def evaluate(self, index):
+        return index.all_ids - self.child.evaluate(index)
+
+    def estimate(self, index):
+        return len(index.all_ids) - self.child.estimate(index)
+
+    def __str__(self):
+        return 'NOT ' + str(self.child)
+
+
+class AndQueryNode(QueryNode):
+    """
+    The planner of the query: the terms are evaluated in the order of
+    their estimated number of matching files so that the intermediate
+    results stay as small as possible. Negated terms are subtracted at
+    the end. The evaluation stops as soon as no file is left.
+    """
+
+    def __init__(self, children):
+        self.children = children
+
+    def get_plan(self, index):
+        "Returns the tuple (positive terms, negated terms) in the order of evaluation"
+        positives = sorted([x for x in self.children if not isinstance(x, NotQueryNode)],
+                           key=lambda x: x.estimate(index))
+        negatives = sorted([x.child for x in self.children if isinstance(x, NotQueryNode)],
+                           key=lambda x: x.estimate(index), reverse=True)
+        return positives, negatives
+
+    def evaluate(self, index):
+        positives, negatives = self.get_plan(index)
+        result = positives[0].evaluate(index) if positives else index.all_ids
+        for child in positives[1:]:
+            if not result:
+                return result
+            result = result.intersection(child.evaluate(index))
+        for child in negatives:
+            if not result:
+                return result
+            result = result.difference(child.evaluate(index))
+        return result
+
+    def estimate(self, index):
+        return min(x.estimate(index) for x in self.children)
+
+    def __str__(self):
+        return '(' + ' AND '.join(str(x) for x in self.children) + ')'
+
+
+class OrQueryNode(QueryNode):
 
-    # Auto DPI scaling
-    dpi = root.winfo_fpixels("1i")
-    root.tk.call("tk", "scaling", dpi / 72)
-    # Font tweak (optional but helps)
-    font.nametofont("TkDefaultFont").configure(size=16)
-    
-    # Create an instance of the TagDialog with the vocabulary
-    guidialog = TagDialog(root, vocabulary, upto9_tags_for_shortcuts, tags_for_visual, number_of_files, hint_str, tag_list)
+    def __init__(self, children):
+        self.children = children
 
-    # Run the Tkinter main loop
-    root.mainloop()
+    def evaluate(self, index):
+        return frozenset().union(*[x.evaluate(index) for x in self.children])
 
-    if guidialog.cancelled:
-        return False
-    entered_tags = guidialog.entered_tags.strip()
-    logging.debug(f"interactive GUI mode: entered tags: {entered_tags}")
-    return extract_tags_from_argument(entered_tags)
+    def estimate(self, index):
+        return min(len(index.all_ids), sum(x.estimate(index) for x in self.children))
 
+    def __str__(self):
+        return '(' + ' OR '.join(str(x) for x in self.children) + ')'
 
-def ask_for_tags(vocabulary, controlled_vocabulary, upto9_tags_for_shortcuts, tags_for_visual=None, gui=None):
+
+def get_query_tokens(query):
     """
-    Wrapper-function for the text-based version and the GUI version:
+    Splits a query string into its tokens. Quoted terms keep their
+    quotes so that they are never mistaken for operators. A term must
+    not touch a parenthesis on its outer side: "foo(bar)" is rejected
+    instead of being read as "foo AND bar".
 
-    Takes a vocabulary and optional up to nine tags for shortcuts and interactively asks
-    the user to enter tags. Aborts program if no tags were entered. Returns list of
-    entered tags.
+    @param query: string of the query
+    @param return: list of strings
+    """
 
-    @param vocabulary: array containing the controlled vocabulary
-    @param upto9_tags_for_shortcuts: array of tags which can be used to generate number-shortcuts
-    @param return: list of up to top nine keys according to the rank of their values
+    tokens = []
+    position = 0
+    while query[position:].strip():
+        match = QUERY_TOKEN_REGEX.match(query, position)
+        if not match:
+            raise ValueError('unbalanced quote in query "' + query + '"')
+        token = match.group(match.lastindex)
+        if tokens and match.start(match.lastindex) == position and tokens[-1] != '(' and token != ')':
+            raise ValueError('missing space between "' + tokens[-1] + '" and "' + token + '" in query "' +
+                             query + '"; quote tags containing parentheses like "foo(bar)"')
+        tokens.append(token)
+        position = match.end()
+    return tokens
+
+
+def compile_query(query):
     """
+    Compiles a query string into a tree of QueryNode objects.
 
-    hint_str, tag_list = get_tag_shortcut_information(upto9_tags_for_shortcuts,
-                                                          tags_get_added=(not options.remove and not options.tagfilter),
-                                                          tags_get_linked=options.tagfilter)
+    Grammar (AND binds stronger than OR; adjacent terms are joined by AND):
+      query := and ( "OR" and )*
+      and   := not ( ["AND"] not )*
+      not   := "NOT" not | "(" query ")" | term
+      term  := tag | '"'tag'"' | "path:"tag | 'path:"'tag'"' |
+               "date"("="|"<"|"<="|">"|">=")YYYY[-MM[-DD]]
 
-    force_cv_enabled = options.force_cv and not options.remove and not options.tagfilter and not options.tagtrees
-    if force_cv_enabled and not controlled_vocabulary:
-        print(colorama.Fore.RED + "No controlled vocabulary (.filetags) found; --force-cv disabled." + colorama.Style.RESET_ALL)
-        force_cv_enabled = False
+    Quoted tags are taken literally, e.g. '"foo(bar)" OR "AND"'.
 
-    previous_input = None
-    previous_error = None
-    while True:
-        if gui:
-            tags_from_userinput = ask_for_tags_gui_version(
-                vocabulary, upto9_tags_for_shortcuts, hint_str, tag_list, tags_for_visual)
-        else:
-            tags_from_userinput = ask_for_tags_text_version(
-                vocabulary, upto9_tags_for_shortcuts, hint_str, tag_list, tags_for_visual,
-                prompt_prefill=previous_input, invalid_tags=previous_error)
-            previous_input = BETWEEN_TAG_SEPARATOR.join(tags_from_userinput) if tags_from_userinput else previous_input
+    Example: 'car AND (red OR blue) AND NOT draft AND date>=2020-01'
 
-        if not tags_from_userinput:
-            logging.info("no tags given, exiting.")
-            sys.stdout.flush()
-            sys.exit(0)
+    @param query: string of the query
+    @param return: QueryNode
+    """
 
-        validation_error = force_cv_validator(force_cv_enabled, tags_from_userinput, controlled_vocabulary)
-        if validation_error:
-            if not gui:
-                previous_error = validation_error
-                continue
-            previous_error = None
+    tokens = get_query_tokens(query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def next_token():
+        nonlocal position
+        token = peek()
+        if token is None:
+            raise ValueError('unexpected end of query "' + query + '"')
+        position += 1
+        return token
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == 'OR':
+            next_token()
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else OrQueryNode(children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() not in [None, 'OR', ')']:
+            if peek() == 'AND':
+                next_token()
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else AndQueryNode(children)
+
+    def parse_not():
+        token = next_token()
+        if token == 'NOT':
+            return NotQueryNode(parse_not())
+        elif token == '(':
+            node = parse_or()
+            if next_token() != ')':
+                raise ValueError('missing ")" in query "' + query + '"')
+            return node
+        elif token.endswith('"'):
+            pathtag = token.startswith(QUERY_PATHTAG_PREFIX)
+            tag = token[len(QUERY_PATHTAG_PREFIX) + 1 if pathtag else 1:-1]
+            if not tag:
+                raise ValueError('empty quoted tag in query "' + query + '"')
+            return TagQueryNode(tag, pathtag)
+        elif token in ['AND', 'OR', ')']:
+            raise ValueError('unexpected "' + token + '" in query "' + query + '"')
+        elif token.startswith('date') and token[4:5] in ['<', '>', '=']:
+            components = QUERY_DATE_REGEX.match(token)
+            if not components:
+                raise ValueError('invalid date term "' + token + '"; use for example "date>=2020-01"')
+            return DateQueryNode(components.group(1), components.group(2))
+        elif token.startswith(QUERY_PATHTAG_PREFIX) and len(token) > len(QUERY_PATHTAG_PREFIX):
+            return TagQueryNode(token[len(QUERY_PATHTAG_PREFIX):], pathtag=True)
+        else:
+            return TagQueryNode(token)
 
-        if len(upto9_tags_for_shortcuts) > 0:
-            # check if user entered number shortcuts for tags to be removed:
-            tags_from_userinput = check_for_possible_shortcuts_in_entered_tags(
-                tags_from_userinput, upto9_tags_for_shortcuts)
-        return tags_from_userinput
+    if not tokens:
+        raise ValueError('empty query')
+    node = parse_or()
+    if peek() is not None:
+        raise ValueError('unexpected "' + peek() + '" in query "' + query + '"')
+    return node
 
 
-def get_files_of_directory(directory):
+def get_files_of_directory_matching_query(directory, query):
     """
-    Lists the files of the given directory and returns a list of its files.
+    Returns the files of the given directory matching the query.
 
     @param directory: string of an existing directory
-    @param return: list of file names of given directory
+    @param query: string of a query, see compile_query()
+    @param return: list of file names like get_files_of_directory() that match the query
     """
 
-    files = []
-    logging.debug('get_files_of_directory(' + directory + ') called and traversing file system ...')
-    for (dirpath, dirnames, filenames) in os.walk(directory):
-        if len(files) % 5000 == 0 and len(files) > 0:
-            # while debugging a large hierarchy scan, I'd like to print out some stuff in-between scanning
-            logging.info('found ' + str(len(files)) + ' files so far ... counting ...')
-        if options.recursive:
-            files.extend([os.path.join(dirpath, x) for x in filenames])
-        else:
-            files.extend(filenames)
-            break
-    logging.debug('get_files_of_directory(' + directory + ') finished with ' + str(len(files)) + ' items')
-
+    node = compile_query(query)
+    index = get_tag_scan(directory, options.recursive).get_inverted_tag_index(options.recursive)
+    files = index.get_filenames(node.evaluate(index))
+    logging.debug('get_files_of_directory_matching_query(' + directory + ', ' + str(node) + ') found ' +
+                  str(len(files)) + ' items')
     return files
 
 
@@ -2553,7 +4641,7 @@ def assert_empty_tagfilter_directory(directory):
     @param directory: the directory to use as starting directory
     """
 
-    id = os.path.join(directory, '.filetags_tagtrees')
+    id = os.path.join(directory, TAGTREES_MARKER_FILENAME)
 
     if not os.path.exists(id) and options.tagtrees_directory and os.path.exists(directory) and os.listdir(directory) and not options.overwrite:
         error_exit(13, 'The given tagtrees directory ' + directory +
@@ -2596,7 +4684,8 @@ def get_common_tags_from_files(files):
     return list(set.intersection(*list_of_tags_per_file))
 
 
-def generate_tagtrees(directory, maxdepth, ignore_nontagged, nontagged_subdir, link_missing_mutual_tagged_items, filtertags=None):
+def generate_tagtrees(directory, maxdepth, ignore_nontagged, nontagged_subdir, link_missing_mutual_tagged_items, filtertags=None, incremental=False,
+                      layout=TAGTREES_LAYOUTS[0], link_orderings=False):
     """
     This functions is somewhat sophisticated with regards to the background.
     If you're really interested in the whole story behind the
@@ -2667,26 +4756,37 @@ def generate_tagtrees(directory, maxdepth, ignore_nontagged, nontagged_subdir, l
     @param nontagged_subdir: (string) holds a string containing the sub-directory name to link non-tagged items to
     @param link_missing_mutual_tagged_items: (bool) if True, any item that has a missing tag of any unique_tags entry is linked to a separate directory which is auto-generated from the unique_tags set names
     @param filtertags: (list) if options.tagfilter is used, this list holds the tags to filter for (AND)
+    @param incremental: (bool) if True and directory holds tagtrees with a manifest, only the differences are applied
+    @param layout: (string) one of TAGTREES_LAYOUTS; see plan_tagtrees()
+    @param link_orderings: (bool) with the combinations layout, other orderings of tags are linked to the directories
     """
 
-    assert_empty_tagfilter_directory(directory)
-
     # The boolean ignore_nontagged must be "False" when nontagged_subdir holds a value:
     # valid combinations:
     assert((ignore_nontagged and not nontagged_subdir) or
            (not ignore_nontagged and (not nontagged_subdir or type(nontagged_subdir)==str)))
 
     # Extract the variables nontagged_item_dest_dir from the valid combinations
-    # of nontagged_subdir and ignore_nontagged:
-    nontagged_item_dest_dir = False  # ignore non-tagged items
+    # of nontagged_subdir and ignore_nontagged (relative to directory):
+    nontagged_item_dest_dir = None  # ignore non-tagged items
     if nontagged_subdir:
-        nontagged_item_dest_dir = os.path.join(directory, nontagged_subdir)
-        assert_empty_tagfilter_directory(nontagged_item_dest_dir)
+        nontagged_item_dest_dir = nontagged_subdir
     elif not ignore_nontagged:
-        nontagged_item_dest_dir = directory
+        nontagged_item_dest_dir = ''
+
+    # The tagtrees of a previous run are only updated if they can be
+    # trusted. Otherwise, the directory gets emptied before looking for
+    # files (see error message below):
+    manifest = read_tagtrees_manifest(directory) if incremental else None
+    if manifest is None and not options.tagtrees_plan:
+        assert_empty_tagfilter_directory(directory)
 
     try:
-        files = get_files_of_directory(os.getcwd())
+        if filtertags:
+            logging.debug('generate_tagtrees: filtering tags ...')
+            files = get_files_of_directory_matching_tags(os.getcwd(), filtertags)
+        else:
+            files = get_files_of_directory(os.getcwd())
     except FileNotFoundError:
         error_exit(11, 'When trying to look for files, I could not even find the current working directory. ' + \
                    'Could it be the case that you\'ve tried to generate tagtrees within the directory "' + directory + '"? ' + \
@@ -2695,10 +4795,6 @@ def generate_tagtrees(directory, maxdepth, ignore_nontagged, nontagged_subdir, l
                    'So it looks like we\'ve got a shot-yourself-in-the-foot situation here … You can imagine that this was not ' + \
                    'even simple to find and catch while testing for me either. Or was it? Make an educated guess. :-)')
 
-    if filtertags:
-        logging.debug('generate_tagtrees: filtering tags ...')
-        files = filter_files_matching_tags(files, filtertags)
-
     if len(files) == 0 and not options.recursive:
         error_exit(10, 'There is no single file in the current directory "' + os.getcwd() + '". I can\'t create ' + \
                 'tagtrees from nothing. You gotta give me at least something to work with here, dude.')
@@ -2713,149 +4809,755 @@ def generate_tagtrees(directory, maxdepth, ignore_nontagged, nontagged_subdir, l
         logging.debug('generate_tagtrees: I found controlled_vocabulary_filename "' +
                       controlled_vocabulary_filename +
                       '" which I\'m going to link to the tagtrees folder')
-        if not options.dryrun:
-            create_link(os.path.abspath(controlled_vocabulary_filename),
-                        os.path.join(directory,
-                                     CONTROLLED_VOCABULARY_FILENAME))
+    else:
+        logging.debug('generate_tagtrees: I did not find a controlled_vocabulary_filename')
+
+    # Before creating anything, count what is going to be created:
+    statistics = get_tagtrees_statistics(files, maxdepth, nontagged_item_dest_dir,
+                                         link_missing_mutual_tagged_items, layout, link_orderings)
+    if options.tagtrees_budget:
+        maxdepth = fit_tagtrees_into_budget(statistics, options.tagtrees_budget[0],
+                                            options.tagtrees_budget_abort)
+        statistics = statistics[:maxdepth + 1]
+    if options.tagtrees_plan:
+        print_tagtrees_statistics(statistics, len(files), layout,
+                                  calibrate_tagtrees_syscall_seconds(directory))
+        return
+
+    logging.info('Creating tagtrees and their links. It may take a while …  ' +
+                 '(exponentially with respect to number of tags)')
+
+    plan = plan_tagtrees(files, maxdepth, nontagged_item_dest_dir,
+                         link_missing_mutual_tagged_items, controlled_vocabulary_filename,
+                         layout=layout, link_orderings=link_orderings)
+
+    if options.dryrun:
+        logging.debug('generate_tagtrees: dryrun → not touching "' + directory + '"')
+    elif manifest is None:
+        apply_tagtrees_plan(directory, plan)
+    else:
+        update_tagtrees(directory, plan, manifest)
+    if not options.dryrun:
+        write_tagtrees_manifest(directory, plan)
+
+    # Brag about how brave I was. And: it also shows the user why the
+    # runtime was that long. The number of links grows exponentially
+    # with the number of tags. Keep this in mind when tempering with
+    # the maxdepth!
+    logging.info('Number of links in "' + directory + '" for the ' + str(len(files)) + ' files: ' +
+                 str(len(plan.links)) + '  (tagtrees depth is ' + str(maxdepth) + ')')
+
+
+class TagtreesPlan(object):
+    """
+    The directories and links of a tagtrees hierarchy. All paths are
+    relative to the root directory of the tagtrees so that the plan can
+    be compared with the manifest of a previous run.
+    """
+
+    def __init__(self):
+        self.directories = {}  # relative paths of the directories in the order of creation; dict as ordered set
+        self.directory_links = {}  # relative path of each link to a directory -> relative target of the link
+        self.links = {}  # relative path of each link -> absolute path of its source
+
+    def add_directory(self, path):
+        self.directories[path] = None
+
+    def add_directory_link(self, path, target):
+        self.directory_links[path] = target
+
+    def add_link(self, source, destination):
+        """
+        @param source: absolute path of the linked file
+        @param destination: relative path of the link
+        @param return: False if there already is a link with this destination; the first one is kept
+        """
+
+        if destination in self.links:
+            return False
+        self.links[destination] = source
+        return True
+
+
+def get_directory_with_parents(path):
+    """
+    @param path: relative path of a directory, e.g. "no/tags"
+    @param return: list of the relative paths of its parents and itself, e.g. ["no", "no/tags"]
+    """
+
+    paths = []
+    for component in os.path.normpath(path).split(os.sep):
+        paths.append(os.path.join(paths[-1], component) if paths else component)
+    return paths
+
+
+def plan_tagtrees(files, maxdepth, nontagged_item_dest_dir, link_missing_mutual_tagged_items,
+                  controlled_vocabulary_filename=None, layout=TAGTREES_LAYOUTS[0], link_orderings=False):
+    """
+    Determines all directories and links of the tagtrees of files
+    without touching the file system. See generate_tagtrees() for the
+    meaning of the hierarchy.
+
+    With the "permutations" layout, an item with k tags is linked to
+    k!/(k-d)! directories of depth d: one per ordering of its tags.
+    With the "combinations" layout, it is linked only to the C(k,d)
+    directories whose tags are in alphabetical order. With
+    link_orderings, the other orderings of a directory are symbolic
+    links to it. Only the orderings whose parent directory is in
+    alphabetical order need a link of their own: all others are
+    reached through the link of their parent.
+
+    @param files: list of file names
+    @param maxdepth: integer which holds the depth to which the tagtrees are generated
+    @param nontagged_item_dest_dir: relative directory for the items without tags ('' for the root); None ignores them
+    @param link_missing_mutual_tagged_items: (bool) if True, items without any tag of a unique_tags entry are linked to a no-… directory
+    @param controlled_vocabulary_filename: optional file name of a controlled vocabulary to link to the root
+    @param layout: one of TAGTREES_LAYOUTS
+    @param link_orderings: (bool) with the combinations layout, directory links are planned for other orderings
+    @param return: TagtreesPlan
+    """
+
+    assert(layout in TAGTREES_LAYOUTS)
+
+    plan = TagtreesPlan()
+
+    if controlled_vocabulary_filename:
+        plan.add_link(os.path.abspath(controlled_vocabulary_filename), CONTROLLED_VOCABULARY_FILENAME)
+    if nontagged_item_dest_dir:
+        for path in get_directory_with_parents(nontagged_item_dest_dir):
+            plan.add_directory(path)
+
+    # Firstly, let's iterate over the files, plan tagtree
+    # directories according to the set of tags from the current file
+    # to avoid empty tagtree directories. Then we're going to link the
+    # file to its tagtree directories. I'm confident that this is
+    # going to be great.
+
+    for currentfile in files:
+
+        filename = os.path.abspath(currentfile)
+        basename = os.path.basename(currentfile)
+        tags_of_currentfile = parse_basename(basename).tags
+
+        if len(tags_of_currentfile) == 0:
+            # current file has no tags. It gets linked to the
+            # nontagged_item_dest_dir folder (if set). This is somewhat handy to find files
+            # which are - you guessed right - not tagged yet ;-)
+
+            if nontagged_item_dest_dir is None:
+                logging.debug('generate_tagtrees: file "' + filename +
+                              '" has no tags and will be ignores because of command line switch.')
+            elif not plan.add_link(filename, os.path.join(nontagged_item_dest_dir, basename)):
+                logging.warning('Untagged file \"' + filename +
+                                '\" is already linked: \"' +
+                                os.path.join(nontagged_item_dest_dir, basename) +
+                                '\". You must have used the recursive ' +
+                                'option and the sub-tree you\'re generating a ' +
+                                'tagtree from has two times the ' +
+                                'same filename. I stick with the first one.')
+
+        else:
+
+            # Here we go: current file has at least one tag. Plan
+            # its tagtree directories and links:
+
+            for currentdepth in range(1, maxdepth+1):
+                if layout == 'combinations':
+                    tagpaths = itertools.combinations(sorted(set(tags_of_currentfile)), currentdepth)
+                else:
+                    tagpaths = itertools.permutations(tags_of_currentfile, currentdepth)
+                for tagpath in tagpaths:
+
+                    # We *have* to iterate over the depth as well
+                    # because when a file has only one tag and the
+                    # maxdepth is more than one, we are forgetting
+                    # to create all those tagtree directories for this
+                    # single tag.
+                    current_directory = os.path.join(*tagpath)
+                    if current_directory not in plan.directories:
+                        plan.add_directory(current_directory)
+                        if layout == 'combinations' and link_orderings:
+                            # "b/a" → "../a/b" and "a/c/b" → "../b/c";
+                            # "c/a/b" is reached via "c/a" → "../a/c" and "a/c/b":
+                            for lasttag in tagpath[:-1]:
+                                parent = os.path.join(*[x for x in tagpath if x != lasttag])
+                                plan.add_directory_link(os.path.join(parent, lasttag),
+                                                        os.path.relpath(current_directory, parent))
+                    if not plan.add_link(filename, os.path.join(current_directory, basename)):
+                        logging.warning('Tagged file \"' + filename +
+                                        '\" is already linked: \"' +
+                                        os.path.join(current_directory, basename) +
+                                        '\". You must have used the recursive ' +
+                                        'option and the sub-tree you\'re generating ' +
+                                        'a tagtree from has two times the same ' +
+                                        'filename. I stick with the first one.')
+
+            if link_missing_mutual_tagged_items:
+                for unique_tagset in unique_tags:
+
+                    # Oh yes, I do wish I had solved the default teststring issue in
+                    # a cleaner way. Ignore it here hard-coded.
+                    if unique_tagset == UNIQUE_TAG_TESTSTRINGS:
+                        continue
+
+                    # When there is no intersection between the item tags and the current unique_tagset ...
+                    if not set(tags_of_currentfile).intersection(set(unique_tagset)):
+
+                        # ... plan a no-$unique_tagset directory and link the item into it:
+                        no_uniqueset_tag_found_dir = 'no-' + ("-").join(unique_tagset)  # example: "no-draft-final"
+                        plan.add_directory(no_uniqueset_tag_found_dir)
+                        if not plan.add_link(filename, os.path.join(no_uniqueset_tag_found_dir, basename)):
+                            logging.warning('Tagged file \"' + filename + '\" is already linked: \"' +
+                                            os.path.join(no_uniqueset_tag_found_dir, basename) +
+                                            '\". I stick with the first one.')
+
+    return plan
+
+
+def get_tagtrees_statistics(files, maxdepth, nontagged_item_dest_dir, link_missing_mutual_tagged_items,
+                            layout=TAGTREES_LAYOUTS[0], link_orderings=False):
+    """
+    Counts the directories and links per depth that plan_tagtrees()
+    would plan, without holding all links in memory: the number of links
+    per item is calculated, only the distinct directories are collected.
+    Items with the same file name are counted for each occurrence.
+
+    @param files: list of file names
+    @param maxdepth, nontagged_item_dest_dir, link_missing_mutual_tagged_items, layout, link_orderings: see plan_tagtrees()
+    @param return: list of dicts with 'directories', 'links' and 'directory_links' for the depths 0 (root) to maxdepth
+    """
+
+    statistics = [{'directories': 0, 'links': 0, 'directory_links': 0} for depth in range(maxdepth + 1)]
+    directories = [set() for depth in range(maxdepth + 1)]
+
+    if nontagged_item_dest_dir:
+        directories[0].update(get_directory_with_parents(nontagged_item_dest_dir))
+
+    for currentfile in files:
+        tags = parse_basename(os.path.basename(currentfile)).tags
+        if not tags:
+            if nontagged_item_dest_dir is not None:
+                statistics[0]['links'] += 1
+            continue
+
+        if layout == 'combinations':
+            tags = sorted(set(tags))
+        for depth in range(1, maxdepth + 1):
+            if layout == 'combinations':
+                statistics[depth]['links'] += math.comb(len(tags), depth)
+                directories[depth].update(itertools.combinations(tags, depth))
+            else:
+                statistics[depth]['links'] += math.perm(len(tags), depth)
+                directories[depth].update(itertools.permutations(tags, depth))
+
+        if link_missing_mutual_tagged_items and maxdepth > 0:
+            for unique_tagset in unique_tags:
+                if unique_tagset != UNIQUE_TAG_TESTSTRINGS and not set(tags).intersection(set(unique_tagset)):
+                    directories[1].add('no-' + ("-").join(unique_tagset))
+                    statistics[1]['links'] += 1
+
+    for depth in range(maxdepth + 1):
+        statistics[depth]['directories'] = len(directories[depth])
+        if layout == 'combinations' and link_orderings and depth > 1:
+            statistics[depth]['directory_links'] = len(directories[depth]) * (depth - 1)
+    return statistics
+
+
+def get_tagtrees_inodes(depthstatistics):
+    "Returns the number of inodes of one depth of get_tagtrees_statistics(); hard links do not need an inode of their own"
+
+    return depthstatistics['directories'] + depthstatistics['directory_links'] + \
+        (0 if options.hardlinks and not IS_WINDOWS else depthstatistics['links'])
+
+
+def fit_tagtrees_into_budget(statistics, budget, abort):
+    """
+    @param statistics: list of get_tagtrees_statistics()
+    @param budget: maximum number of inodes
+    @param abort: if True, exceeding the budget is an error instead of lowering the depth
+    @param return: the largest depth whose tagtrees fit into the budget
+    """
+
+    total = 0
+    depth = 0
+    for currentdepth, depthstatistics in enumerate(statistics):
+        total += get_tagtrees_inodes(depthstatistics)
+        if total > budget:
+            break
+        depth = currentdepth
+    else:
+        return depth
+
+    maxdepth = len(statistics) - 1
+    if abort or depth == 0:
+        error_exit(27, 'The tagtrees of depth ' + str(maxdepth) + ' need more than the budget of ' + str(budget) +
+                   ' inodes' + ('.' if abort else ' even with a depth of 1.') +
+                   ' Use --plan to see the numbers per depth.')
+    logging.warning('The tagtrees of depth ' + str(maxdepth) + ' need more than the budget of ' + str(budget) +
+                    ' inodes. Lowering the depth to ' + str(depth) + '.')
+    return depth
+
+
+def calibrate_tagtrees_syscall_seconds(directory):
+    """
+    Measures the average duration of mkdir() and symlink() on the file
+    system of the tagtrees directory. The measurement takes place in a
+    temporary directory next to the tagtrees directory so that the
+    tagtrees directory itself is not touched. With --dryrun, nothing is
+    measured at all.
+
+    @param directory: the (possibly not yet existing) tagtrees directory
+    @param return: seconds per system call or None if nothing was measured
+    """
+
+    if options.dryrun:
+        return None
+    parent = os.path.dirname(os.path.abspath(directory))
+    while not os.path.isdir(parent) and os.path.dirname(parent) != parent:
+        parent = os.path.dirname(parent)
+    safe_import('tempfile')
+    try:
+        testdir = tempfile.mkdtemp(prefix='.filetags_calibration_', dir=parent)
+    except OSError as error:
+        logging.debug('calibrate_tagtrees_syscall_seconds: nothing measured due to: ' + str(error))
+        return None
+    safe_import('shutil')  # for removing directories with shutil.rmtree()
+    try:
+        start = time.perf_counter()
+        for number in range(TAGTREES_CALIBRATION_SYSCALLS):
+            os.mkdir(os.path.join(testdir, 'directory ' + str(number)))
+            os.symlink(testdir, os.path.join(testdir, 'link ' + str(number)))
+        return (time.perf_counter() - start) / (2 * TAGTREES_CALIBRATION_SYSCALLS)
+    except OSError as error:
+        logging.debug('calibrate_tagtrees_syscall_seconds: nothing measured due to: ' + str(error))
+        return None
+    finally:
+        shutil.rmtree(testdir, ignore_errors=True)
+
+
+def print_tagtrees_statistics(statistics, num_files, layout, seconds_per_syscall):
+    """
+    Prints the result of get_tagtrees_statistics() with the projected runtime.
+
+    @param statistics: list of get_tagtrees_statistics()
+    @param num_files: number of items of the tagtrees
+    @param layout: one of TAGTREES_LAYOUTS
+    @param seconds_per_syscall: float of the measured duration of one mkdir() or symlink();
+                                None uses TAGTREES_DEFAULT_SYSCALL_SECONDS
+    """
+
+    measured = seconds_per_syscall is not None
+    if not measured:
+        seconds_per_syscall = TAGTREES_DEFAULT_SYSCALL_SECONDS
+
+    print('\nTagtrees plan for ' + str(num_files) + ' items (layout: ' + layout + '):\n')
+    print(' depth  directories  dir. links       links       inodes   cumulative inodes')
+    cumulative = 0
+    syscalls = 0
+    for depth, depthstatistics in enumerate(statistics):
+        inodes = get_tagtrees_inodes(depthstatistics)
+        cumulative += inodes
+        syscalls += depthstatistics['directories'] + depthstatistics['directory_links'] + depthstatistics['links']
+        print(' {:>5}  {:>11}  {:>10}  {:>10}  {:>11}  {:>18}'.format(
+            depth, depthstatistics['directories'], depthstatistics['directory_links'],
+            depthstatistics['links'], inodes, cumulative))
+    print('\nProjected runtime: {:.1f} seconds ({:.0f} µs per system call {})\n'.format(
+        syscalls * seconds_per_syscall, seconds_per_syscall * 1000000,
+        'as measured on the target file system' if measured else 'as a default estimate'))
+
+
+def get_link_filename(destination):
+    "Returns the file name of the link that create_link() creates for destination"
+
+    if IS_WINDOWS and not is_lnk_file(destination):
+        return destination + '.lnk'
+    return destination
+
+
+def apply_tagtrees_plan(directory, plan):
+    """
+    Creates all directories and links of the plan within the (empty)
+    tagtrees directory.
+
+    @param directory: root directory of the tagtrees
+    @param plan: TagtreesPlan
+    """
+
+    # the plan lists parents before their sub-directories:
+    for current_directory in plan.directories:
+        try:
+            os.mkdir(os.path.join(directory, current_directory))
+        except FileExistsError:
+            pass
+    for destination, target in plan.directory_links.items():
+        create_directory_link(directory, destination, target)
+    create_tagtrees_links(directory, list(plan.links.items()))
+
+
+def create_planned_link(source, destination):
+    """
+    Creates a link of a TagtreesPlan whose destination is known not to
+    exist. Compared to create_link(), this saves a stat() per link.
+    Existing destinations and Windows lnk files are handled by
+    create_link().
+
+    @param source: a file name of the source, an existing file
+    @param destination: a file name for the link which is about to be created
+    """
+
+    if IS_WINDOWS:
+        create_link(source, destination)
+        return
+    try:
+        if options.hardlinks:
+            try:
+                os.link(source, destination)
+            except FileExistsError:
+                raise
+            except OSError:
+                logging.warning('Due to cross-device links, I had to use a symbolic link as a fall-back for: ' + source)
+                os.symlink(source, destination)
+        else:
+            os.symlink(source, destination)
+    except FileExistsError:
+        create_link(source, destination)
+
+
+def create_directory_link(directory, destination, target):
+    """
+    Creates a link to another directory of the tagtrees. On non-Windows
+    systems, this is a relative symbolic link so that the tagtrees can
+    be moved as a whole.
+
+    @param directory: root directory of the tagtrees
+    @param destination: relative path of the link
+    @param target: path of the linked directory relative to the directory of the link
+    """
+
+    link_filename = os.path.join(directory, destination)
+    if IS_WINDOWS:
+        create_link(os.path.normpath(os.path.join(os.path.dirname(link_filename), target)), link_filename)
+    else:
+        os.symlink(target, link_filename, target_is_directory=True)
+
+
+def create_tagtrees_links(directory, links, jobs=None):
+    """
+    Creates the links of a TagtreesPlan. With more than one job, a pool
+    of threads issues the link system calls in chunks of
+    TAGTREES_LINKS_PER_TASK links. The progress is reported
+    periodically.
+
+    @param directory: root directory of the tagtrees whose directories already exist
+    @param links: list of tuples (relative path of the link, absolute path of its source)
+    @param jobs: number of threads; default from --jobs
+    """
+
+    if jobs is None:
+        jobs = options.jobs[0] if options.jobs else DEFAULT_TRAVERSAL_JOBS
+    if IS_WINDOWS:
+        jobs = 1  # the COM objects for lnk files are not shared between threads
+
+    def create_chunk(chunk):
+        for destination, source in chunk:
+            create_planned_link(source, os.path.join(directory, destination))
+        return len(chunk)
+
+    chunks = [links[x:x + TAGTREES_LINKS_PER_TASK] for x in range(0, len(links), TAGTREES_LINKS_PER_TASK)]
+    if jobs > 1 and len(chunks) > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        results = executor.map(create_chunk, chunks)
+    else:
+        executor = None
+        results = map(create_chunk, chunks)
+
+    num_created = 0
+    last_report = time.time()
+    try:
+        for num_links in results:
+            num_created += num_links
+            if time.time() - last_report >= TAGTREES_PROGRESS_INTERVAL_SECONDS:
+                last_report = time.time()
+                logging.info('Created %i of %i links …' % (num_created, len(links)))
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+    logging.debug('create_tagtrees_links: created %i links with %i job(s)' % (num_created, jobs))
+
+
+def update_tagtrees(directory, plan, manifest):
+    """
+    Turns the tagtrees of a previous run as described by its manifest
+    into the tagtrees of the plan: only the links that vanished or got
+    a different source are removed, only the new or changed links are
+    created. Directories that are not part of the plan any more are
+    removed when they are empty.
+
+    @param directory: root directory of the tagtrees
+    @param plan: TagtreesPlan
+    @param manifest: dict as returned by read_tagtrees_manifest()
+    """
+
+    old_links = manifest['links']
+    old_directory_links = manifest['directory_links']
+    old_directories = set(manifest['directories'])
+
+    obsolete_links = [x for x in old_links if plan.links.get(x) != old_links[x]]
+    obsolete_directory_links = [x for x in old_directory_links if plan.directory_links.get(x) != old_directory_links[x]]
+    for destination in obsolete_links + obsolete_directory_links:
+        try:
+            os.remove(get_link_filename(os.path.join(directory, destination)))
+        except FileNotFoundError:
+            pass  # e.g., renamed by tagging the link
+
+    # sub-directories have longer paths and are removed before their parents:
+    for current_directory in sorted(old_directories.difference(plan.directories), key=len, reverse=True):
+        try:
+            os.rmdir(os.path.join(directory, current_directory))
+        except OSError:
+            logging.debug('update_tagtrees: keeping non-empty directory "' + current_directory + '"')
+
+    for current_directory in plan.directories:
+        if current_directory not in old_directories:
+            os.makedirs(os.path.join(directory, current_directory), exist_ok=True)
+
+    for destination, target in plan.directory_links.items():
+        if old_directory_links.get(destination) != target:
+            create_directory_link(directory, destination, target)
+
+    new_links = [x for x in plan.links if old_links.get(x) != plan.links[x]]
+    for destination in new_links:
+        link_filename = get_link_filename(os.path.join(directory, destination))
+        if os.path.lexists(link_filename):
+            os.remove(link_filename)  # e.g., a link which was tagged within the tagtrees
+    create_tagtrees_links(directory, [(x, plan.links[x]) for x in new_links])
+
+    logging.info('Updated tagtrees in "' + directory + '": removed ' + str(len(obsolete_links)) +
+                 ' and created ' + str(len(new_links)) + ' links')
 
-    else:
-        logging.debug('generate_tagtrees: I did not find a controlled_vocabulary_filename')
 
-    logging.info('Creating tagtrees and their links. It may take a while …  ' +
-                 '(exponentially with respect to number of tags)')
+def read_tagtrees_manifest(directory):
+    """
+    @param directory: root directory of tagtrees
+    @param return: dict with 'directories', 'directory_links' and 'links' of the previous run or None if there is no usable manifest
+    """
+
+    try:
+        with open(os.path.join(directory, TAGTREES_MARKER_FILENAME), encoding="utf-8") as manifestfile:
+            manifest = json.load(manifestfile)
+        if manifest.get('version') != TAGTREES_MANIFEST_VERSION or \
+           type(manifest.get('directories')) != list or type(manifest.get('links')) != dict or \
+           type(manifest.get('directory_links')) != dict:
+            raise ValueError('unknown format')
+    except (OSError, ValueError, AttributeError) as error:
+        logging.debug('read_tagtrees_manifest: no usable manifest in "' + directory + '": ' + str(error))
+        return None
+    return manifest
 
-    tags = get_tags_from_files_and_subfolders(startdir=os.getcwd(), use_cache=True)
 
-    # Here, we define a small helper function within a function. Cool,
-    # heh? Bet many folks are not aware of those nifty things I know of ;-P
-    def create_tagtrees_dir(basedirectory, tagpermutation):
-        "Creates (empty) directories of the tagtrees directory structure"
+def write_tagtrees_manifest(directory, plan):
+    """
+    Stores the plan as manifest within the marker file of the tagtrees.
 
-        current_directory = os.path.join(basedirectory, *[x for x in tagpermutation])  # flatten out list of permutations to elements
-        # logging.debug('generate_tagtrees: mkdir ' + current_directory)
-        if not options.dryrun and not os.path.exists(current_directory):
-            os.makedirs(current_directory)
+    @param directory: root directory of the tagtrees
+    @param plan: TagtreesPlan
+    """
 
-    # this generates a list whose elements (the tags) corresponds to
-    # the filenames in the files list:
-    tags_of_files = [extract_tags_from_filename(x) for x in files]
+    with open(os.path.join(directory, TAGTREES_MARKER_FILENAME), 'w', encoding="utf-8") as manifestfile:
+        json.dump({'version': TAGTREES_MANIFEST_VERSION,
+                   'directories': list(plan.directories),
+                   'directory_links': plan.directory_links,
+                   'links': plan.links}, manifestfile)
 
-    # Firstly, let's iterate over the files, create tagtree
-    # directories according to the set of tags from the current file
-    # to avoid empty tagtree directories. Then we're going to link the
-    # file to its tagtree directories. I'm confident that this is
-    # going to be great.
 
-    num_of_links = 0
-    for currentfile in enumerate(files):
+class TagtreesView(object):
+    """
+    A read-only view of the tagtrees of a directory which is computed
+    lazily from the InvertedTagIndex of its TagScan instead of being
+    materialized with directories and links (see generate_tagtrees()).
+    Listings reflect the current file names with a delay of at most
+    max_age seconds, and the depth of the hierarchy costs nothing up
+    front. The listings of a scan are cached until the scan changes.
+
+    Paths are relative to the root of the tagtrees and use "/" as
+    separator, e.g. "/car/red/My new car -- car red.jpg". A directory
+    lists the files having all tags of its path and a sub-directory
+    for every other tag of these files. The root lists the files
+    without tags and the controlled vocabulary, if any.
+
+    mount_tagtrees() serves this view as a FUSE file system. Without
+    FUSE, the view can be used (and tested) with listdir(), isdir()
+    and readlink().
+    """
 
-        tags_of_currentfile = tags_of_files[currentfile[0]]
-        filename, dirname, \
-            basename, basename_without_lnk = split_up_filename(currentfile[1])
+    def __init__(self, startdir, recursive, maxdepth=None, max_age=TAGTREES_VIEW_MAX_AGE_SECONDS):
+        """
+        @param startdir: directory whose files are shown in the tagtrees
+        @param recursive: if True, the files of all sub-directories are shown as well
+        @param maxdepth: maximum number of tags in a path; None for an unlimited depth
+        @param max_age: seconds a scan is used without checking the directories for changes
+        """
 
-        logging.debug('generate_tagtrees: handling file "' + filename + '" …')
+        self.startdir = os.path.abspath(startdir)
+        self.recursive = recursive
+        self.maxdepth = maxdepth
+        self.max_age = max_age
+        self.controlled_vocabulary_filename = locate_file_in_cwd_and_parent_directories(
+            self.startdir, CONTROLLED_VOCABULARY_FILENAME)
+        self.scan = None
+        self.scan_checked = None  # time.monotonic() of the last check of the scan
+        self.entries = {}  # tuple of tags -> result of get_entries() for self.scan
+
+    def get_index(self):
+        "Returns the InvertedTagIndex of the current (cached but up-to-date) scan"
+
+        now = time.monotonic()
+        if self.scan is None or now - self.scan_checked >= self.max_age:
+            scan = get_tag_scan(self.startdir, self.recursive)
+            if scan is not self.scan:
+                self.scan = scan
+                self.entries = {}
+            self.scan_checked = now
+        return self.scan.get_inverted_tag_index(self.recursive)
+
+    def get_entries(self, tags):
+        """
+        @param tags: list of tags of a directory path
+        @param return: tuple of (sorted list of sub-directory tags, dict of link names -> absolute path of the source)
+        """
 
-        if len(tags_of_currentfile) == 0:
-            # current file has no tags. It gets linked to the
-            # nontagged_item_dest_dir folder (if set). This is somewhat handy to find files
-            # which are - you guessed right - not tagged yet ;-)
+        index = self.get_index()
+        key = tuple(tags)
+        if key not in self.entries:
+            self.entries[key] = self.compute_entries(index, tags)
+        return self.entries[key]
 
-            if ignore_nontagged:
-                logging.debug('generate_tagtrees: file "' + filename +
-                              '" has no tags and will be ignores because of command line switch.')
-            else:
-                logging.debug('generate_tagtrees: file "' + filename +
-                              '" has no tags. Linking to "' +
-                              nontagged_item_dest_dir + '"')
-                if not options.dryrun:
-                    try:
-                        create_link(filename, os.path.join(nontagged_item_dest_dir, basename))
-                    except FileExistsError:
-                        logging.warning('Untagged file \"' + filename +
-                                        '\" is already linked: \"' +
-                                        os.path.join(nontagged_item_dest_dir, basename) +
-                                        '\". You must have used the recursive ' +
-                                        'option and the sub-tree you\'re generating a ' +
-                                        'tagtree from has two times the ' +
-                                        'same filename. I stick with the first one.')
-                num_of_links += 1
+    def compute_entries(self, index, tags):
+        "Returns get_entries() of tags without the cache"
 
+        links = {}
+        subdirs = set()
+        if tags:
+            ids = sorted(index.matching_all(tags))
         else:
+            ids = sorted(index.all_ids - index.matching_any(index.ids_by_tag.keys()))  # untagged files
+            subdirs.update(index.ids_by_tag.keys())
+            if self.controlled_vocabulary_filename:
+                links[CONTROLLED_VOCABULARY_FILENAME] = os.path.abspath(self.controlled_vocabulary_filename)
+        for fileid in ids:
+            if tags:
+                subdirs.update(index.tags_of_files[fileid])
+            basename = os.path.basename(index.files[fileid])
+            if basename not in links:  # same file names in different directories: the first one wins
+                links[basename] = os.path.join(self.startdir, index.files[fileid])
+        if self.maxdepth is not None and len(tags) >= self.maxdepth:
+            subdirs = set()
+        return sorted(subdirs.difference(tags)), links
+
+    def resolve(self, path):
+        """
+        @param path: path within the view
+        @param return: tuple of (list of tags of the directory, name of the link or None)
+        @param raise: FileNotFoundError if the path does not exist
+        """
 
-            # Here we go: current file has at least one tag. Create
-            # its tagtree directories and link the file:
+        components = [x for x in path.split('/') if x]
+        index = self.get_index()
+        tags = []
+        for position, component in enumerate(components):
+            # a tag is a sub-directory if at least one file has it together with the tags of the path:
+            if component not in tags and (self.maxdepth is None or len(tags) < self.maxdepth) and \
+               index.matching_all(tags + [component]):
+                tags.append(component)
+            elif position == len(components) - 1 and component in self.get_entries(tags)[1]:
+                return tags, component
+            else:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return tags, None
 
-            # logging.debug('generate_tagtrees: permutations for file: "' + filename + '"')
-            for currentdepth in range(1, maxdepth+1):
-                # logging.debug('generate_tagtrees: currentdepth: ' + str(currentdepth))
-                for tagpermutation in itertools.permutations(tags_of_currentfile, currentdepth):
-
-                    # WHAT I THOUGHT:
-                    # Creating the directories does not require to iterate
-                    # over the different level of depth because
-                    # "os.makedirs()" is able to create all parent folders
-                    # that are necessary. This spares us a loop.
-                    # WHAT I LEARNED:
-                    # We *have* to iterate over the depth as well
-                    # because when a file has only one tag and the
-                    # maxdepth is more than one, we are forgetting
-                    # to create all those tagtree directories for this
-                    # single tag. Therefore: we need to depth-loop for
-                    # creating the directories as well. Bummer.
-                    create_tagtrees_dir(directory, tagpermutation)
-
-                    current_directory = os.path.join(directory, *[x for x in tagpermutation])  ## flatten out list of permutations to elements
-                    # logging.debug('generate_tagtrees: linking file in ' + current_directory)
-                    if not options.dryrun:
-                        try:
-                            create_link(filename, os.path.join(current_directory, basename))
-                        except FileExistsError:
-                            logging.warning('Tagged file \"' + filename +
-                                            '\" is already linked: \"' +
-                                            os.path.join(current_directory, basename) +
-                                            '\". You must have used the recursive ' +
-                                            'option and the sub-tree you\'re generating ' +
-                                            'a tagtree from has two times the same ' +
-                                            'filename. I stick with the first one.')
-                    num_of_links += 1
+    def isdir(self, path):
+        try:
+            return self.resolve(path)[1] is None
+        except FileNotFoundError:
+            return False
 
-            if link_missing_mutual_tagged_items:
-                for unique_tagset in unique_tags:
+    def listdir(self, path):
+        """
+        @param path: path of a directory within the view
+        @param return: sorted list of the names of its sub-directories and links
+        """
 
-                    # Oh yes, I do wish I had solved the default teststring issue in
-                    # a cleaner way. Ignore it here hard-coded.
-                    if unique_tagset == ['teststring1', 'teststring2']:
-                        continue
+        tags, link = self.resolve(path)
+        if link:
+            raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        subdirs, links = self.get_entries(tags)
+        return sorted(subdirs + list(links.keys()))
 
-                    # When there is no intersection between the item tags and the current unique_tagset ...
-                    if not set(tags_of_currentfile).intersection(set(unique_tagset)):
+    def readlink(self, path):
+        """
+        @param path: path of a link within the view
+        @param return: absolute path of the linked file
+        """
 
-                        # ... generate a no-$unique_tagset directory ...
-                        no_uniqueset_tag_found_dir = os.path.join(directory,
-                                                                  'no-' + ("-").join(unique_tagset))  # example: "no-draft-final"
-                        if not os.path.isdir(no_uniqueset_tag_found_dir):
-                            logging.debug('generate_tagtrees: creating non-existent no_uniqueset_tag_found_dir "%s" ...' %
-                                          str(no_uniqueset_tag_found_dir))
-                            if not options.dryrun:
-                                os.makedirs(no_uniqueset_tag_found_dir)
-
-                        # ... and link the item into it:
-                        if not options.dryrun:
-                            try:
-                                create_link(filename, os.path.join(no_uniqueset_tag_found_dir, basename))
-                            except FileExistsError:
-                                logging.warning('Tagged file \"' + filename + '\" is already linked: \"' +
-                                                os.path.join(no_uniqueset_tag_found_dir, basename) +
-                                                '\". I stick with the first one.')
-                        num_of_links += 1
+        tags, link = self.resolve(path)
+        if not link:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), path)
+        return self.get_entries(tags)[1][link]
 
 
-    # Brag about how brave I was. And: it also shows the user why the
-    # runtime was that long. The number of links grows exponentially
-    # with the number of tags. Keep this in mind when tempering with
-    # the maxdepth!
-    logging.info('Number of links created in "' + directory + '" for the ' + str(len(files)) + ' files: ' +
-                 str(num_of_links) + '  (tagtrees depth is ' + str(maxdepth) + ')')
+def mount_tagtrees(view, mountpoint):
+    """
+    Serves the TagtreesView read-only at mountpoint until it gets
+    unmounted (e.g., with "fusermount -u"). This requires the Python
+    module "fuse" of the package fusepy.
+
+    @param view: TagtreesView
+    @param mountpoint: existing empty directory
+    """
+
+    try:
+        fuse = import_module('fuse')
+    except ImportError:
+        error_exit(25, 'Could not find Python module "fuse" for mounting tagtrees. ' +
+                   'Please install it, e.g., with "pip install fusepy".')
+    except OSError as error:
+        error_exit(25, 'Could not load FUSE for mounting tagtrees: ' + str(error))
+
+    root_stat = os.stat(view.startdir)
+
+    class TagtreesOperations(fuse.Operations):
+        "Translates the FUSE calls to the TagtreesView"
+
+        def __call__(self, operation, *args):
+            try:
+                return super().__call__(operation, *args)
+            except OSError as error:
+                if isinstance(error, fuse.FuseOSError):
+                    raise
+                raise fuse.FuseOSError(error.errno or errno.EIO)
+
+        def getattr(self, path, fh=None):
+            attributes = {'st_uid': root_stat.st_uid, 'st_gid': root_stat.st_gid,
+                          'st_atime': root_stat.st_atime, 'st_mtime': root_stat.st_mtime,
+                          'st_ctime': root_stat.st_ctime}
+            tags, link = view.resolve(path)
+            if link:
+                attributes.update(st_mode=stat.S_IFLNK | 0o777, st_nlink=1,
+                                  st_size=len(os.fsencode(view.get_entries(tags)[1][link])))
+            else:
+                attributes.update(st_mode=stat.S_IFDIR | 0o555, st_nlink=2, st_size=0)
+            return attributes
+
+        def readdir(self, path, fh):
+            return ['.', '..'] + view.listdir(path)
+
+        def readlink(self, path):
+            return view.readlink(path)
+
+    logging.info('Serving tagtrees of "' + view.startdir + '" at "' + mountpoint + '" until it gets unmounted …')
+    # single-threaded: the view, its caches and the ScanCache are not thread-safe
+    fuse.FUSE(TagtreesOperations(), mountpoint, foreground=True, ro=True, nothreads=True)
 
 
 def start_filebrowser(directory):
@@ -2991,23 +5693,337 @@ def handle_option_tagtrees(filtertags=None):
                       ignore_nontagged,
                       nontagged_subdir,
                       options.tagtrees_link_missing_mutual_tagged_items,
-                      filtertags)
+                      filtertags,
+                      incremental=options.tagtrees_incremental,
+                      layout=options.tagtrees_layout[0] if options.tagtrees_layout else TAGTREES_LAYOUTS[0],
+                      link_orderings=options.tagtrees_link_orderings)
     delta = time.time() - start  # it's a float
     if delta > 3:
         logging.info("Generated tagtrees in %.2f seconds" % delta)
-    if not options.quiet:
+    if not options.quiet and not options.tagtrees_plan:
         start_filebrowser(chosen_tagtrees_dir)
     successful_exit()
 
 
+def handle_option_query(query):
+    """
+    Links all files of the current directory matching the query to the
+    tagfilter directory and starts the filebrowser.
+
+    @param query: string of a query, see compile_query()
+    """
+
+    global chosen_tagtrees_dir
+
+    logging.debug("handling option for query")
+    try:
+        files = get_files_of_directory_matching_query(os.getcwd(), query)
+    except ValueError as error:
+        error_exit(23, 'Invalid query: ' + str(error))
+
+    chosen_tagtrees_dir = TAGFILTER_DIRECTORY
+    if options.tagtrees_directory:
+        chosen_tagtrees_dir = options.tagtrees_directory[0]
+        logging.debug('User overrides the default tagtrees directory to: ' +
+                      str(chosen_tagtrees_dir))
+
+    logging.info("filtering %i items matching the query \"%s\" and linking to directory \"%s\" ..." %
+                 (len(files), query, str(chosen_tagtrees_dir)))
+    assert_empty_tagfilter_directory(chosen_tagtrees_dir)
+    for filename in files:
+        handle_file(filename, [], do_remove=False, do_filter=True, dryrun=options.dryrun)
+
+    if not options.quiet:
+        logging.debug('Now openeing filebrowser for dir "' + chosen_tagtrees_dir + '"')
+        start_filebrowser(chosen_tagtrees_dir)
+
+
+def handle_files(files, tags_from_userinput):
+    """
+    Adds or removes tags of files or links them to the tagfilter
+    directory according to the command line options.
+
+    @param files: list of file names
+    @param tags_from_userinput: list of tags
+    @param return: number of errors
+    """
+
+    global max_file_length
+    global list_of_link_directories
+    for filename in files:
+        if len(filename) > max_file_length:
+            max_file_length = len(filename)
+    logging.debug('determined maximum file name length with %i' % max_file_length)
+
+    num_errors = 0
+    if not options.tagfilter:
+        # regular files are renamed in one batch per directory; links and
+        # everything else are handled one by one below:
+        renames, files, collisions = plan_batch_renames(files, tags_from_userinput, options.remove)
+        for filename, new_filename in collisions:
+            logging.error('Can not rename "' + filename + '" because "' + new_filename +
+                          '" exists or is the new name of another file. Skipping this one …')
+            num_errors += 1
+        transition = 'delete' if options.remove else 'add'
+        errors = apply_batch_renames(renames, options.dryrun,
+                                     None if options.quiet else
+                                     lambda dirname, basename, new_basename:
+                                     print_item_transition(dirname, basename, new_basename, transition=transition),
+                                     rename_journal)
+        for filename, error in errors:
+            logging.error('Could not rename "' + filename + '": ' + str(error))
+            num_errors += 1
+
+    for filename in files:
+
+        if not os.path.exists(filename):
+            logging.error('File "' + filename + '" does not exist. Skipping this one …')
+            logging.debug('problematic filename: ' + filename)
+            logging.debug('os.getcwd() = ' + os.getcwd())
+            num_errors += 1
+
+        elif is_broken_link(filename):
+            # skip broken links completely and write error message:
+            logging.error('File "' + filename + '" is a broken link. Skipping this one …')
+            num_errors += 1
+
+        else:
+
+            # if filename is a link, tag the source file as well:
+            handle_file_and_optional_link(filename,
+                                          tags_from_userinput,
+                                          options.remove,
+                                          options.tagfilter,
+                                          options.dryrun)
+            logging.debug('list_of_link_directories: ' + repr(list_of_link_directories))
+
+            if len(list_of_link_directories) > 1:
+                logging.debug('Seems like we\'ve found links and renamed their source ' +
+                              'as well. Print out the those directories as well:')
+                print('      This link has a link source with a matching basename. I renamed it there as well:')
+                for directory in list_of_link_directories[:-1]:
+                    print('      · ' + directory)
+            list_of_link_directories = []
+
+    return num_errors
+
+
+def reset_run_state():
+    """
+    Resets the module state that belongs to one invocation. The
+    daemon runs main() many times; the caches like the scan cache are
+    kept because they validate themselves.
+    """
+
+    global max_file_length, unique_tags, do_not_suggest_tags, included_files, controlled_vocabulary_filename, \
+        list_of_link_directories, chosen_tagtrees_dir, rename_journal, similar_tags_cache
+    max_file_length = 0
+    unique_tags = [UNIQUE_TAG_TESTSTRINGS]
+    do_not_suggest_tags = []
+    included_files = []
+    controlled_vocabulary_filename = ''
+    list_of_link_directories = []
+    chosen_tagtrees_dir = False
+    rename_journal = None
+    similar_tags_cache = None
+
+
+def daemon_can_handle_options():
+    """
+    The daemon only handles invocations which neither need the
+    terminal nor the standard input of the client.
+
+    @param return: boolean
+    """
+
+    if options.interactive or options.gui or options.daemon or options.resume or options.rollback:
+        return False
+    if options.files_from and options.files_from[0] == '-':
+        return False
+    return bool(options.tags or options.list_tags_by_alphabet or options.list_tags_by_number or
+                options.list_unknown_tags or options.tag_gardening)
+
+
+def receive_all(connection):
+    """
+    @param connection: socket whose peer shuts down writing after its message
+    @param return: bytes of the message
+    """
+
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def forward_to_daemon(argv):
+    """
+    Lets a running daemon handle the command line and prints its output.
+
+    @param argv: list of command line arguments without the program name
+    @param return: the exit code or None if no daemon is running
+    """
+
+    if not os.path.exists(DAEMON_SOCKET_FILENAME):
+        return None
+    safe_import('socket')  # for the daemon
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(DAEMON_SOCKET_FILENAME)
+    except OSError as error:
+        logging.debug('forward_to_daemon: no daemon listening: ' + str(error))
+        connection.close()
+        return None
+
+    # From now on, the daemon might have changed files: falling back to
+    # handling the command line in this process could do it twice.
+    try:
+        with connection:
+            connection.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd(),
+                                           'tty_width': TTY_WIDTH}).encode('utf-8'))
+            connection.shutdown(socket.SHUT_WR)
+            response = json.loads(receive_all(connection).decode('utf-8'))
+    except (OSError, ValueError) as error:
+        error_exit(36, 'Lost the connection to the filetags daemon: ' + str(error))
+
+    sys.stdout.write(response['stdout'])
+    sys.stdout.flush()
+    sys.stderr.write(response['stderr'])
+    return response['code']
+
+
+def run_daemon_request(request):
+    """
+    Runs main() for a command line that was forwarded to the daemon.
+
+    @param request: dict with 'argv', 'cwd' and 'tty_width' of the client
+    @param return: dict with the 'stdout', 'stderr' and exit 'code' of the run
+    """
+
+    global options, TTY_WIDTH
+    daemon_options = options
+    daemon_tty_width = TTY_WIDTH
+    original_dir = os.getcwd()
+    rootlogger = logging.getLogger()
+    daemon_handlers, daemon_level = rootlogger.handlers[:], rootlogger.level
+    safe_import('contextlib')  # for capturing the output
+    stdout, stderr = io.StringIO(), io.StringIO()
+    code = 0
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        # handle_logging() of main() creates the logging handlers of this run on the captured stderr:
+        rootlogger.handlers = []
+        try:
+            reset_run_state()
+            os.chdir(request['cwd'])
+            TTY_WIDTH = request['tty_width']
+            main(request['argv'])
+        except SystemExit as exit:
+            if exit.code is None or isinstance(exit.code, int):
+                code = exit.code or 0
+            else:
+                print(exit.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            logging.exception('The filetags daemon failed to handle ' + repr(request['argv']))
+            code = 1
+        finally:
+            for handler in rootlogger.handlers:
+                handler.close()
+            rootlogger.handlers = daemon_handlers
+            rootlogger.setLevel(daemon_level)
+            options = daemon_options
+            TTY_WIDTH = daemon_tty_width
+            os.chdir(original_dir)
+
+    return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'code': code}
+
+
+def serve_daemon():
+    """
+    Handles the command lines forwarded by forward_to_daemon() one
+    after another until the daemon is interrupted.
+    """
+
+    safe_import('signal')  # for stopping the daemon
+    safe_import('socket')
+    if not hasattr(socket, 'AF_UNIX'):
+        error_exit(34, 'The daemon requires Unix domain sockets which are not available on this system.')
+
+    if os.path.exists(DAEMON_SOCKET_FILENAME):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            try:
+                connection.connect(DAEMON_SOCKET_FILENAME)
+                error_exit(35, 'A filetags daemon is already listening on "' + DAEMON_SOCKET_FILENAME + '".')
+            except OSError:
+                logging.debug('serve_daemon: removing the socket of a previous daemon')
+                os.remove(DAEMON_SOCKET_FILENAME)
+
+    global daemon_is_serving
+    daemon_is_serving = True
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    previous_umask = os.umask(0o177)  # only the user may connect
+    try:
+        server.bind(DAEMON_SOCKET_FILENAME)
+    finally:
+        os.umask(previous_umask)
+    server.listen()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # stop like with Ctrl-C
+    logging.info('The filetags daemon is listening on "' + DAEMON_SOCKET_FILENAME + '" …')
+
+    try:
+        while True:
+            connection, address = server.accept()
+            with connection:
+                try:
+                    data = receive_all(connection)
+                    if not data:
+                        continue  # only checking whether a daemon is listening
+                    request = json.loads(data.decode('utf-8'))
+                except (OSError, ValueError) as error:
+                    logging.warning('Ignoring an invalid request: ' + str(error))
+                    continue
+                logging.debug('serve_daemon: handling ' + repr(request['argv']) + ' in ' + request['cwd'])
+                response = run_daemon_request(request)
+                try:
+                    connection.sendall(json.dumps(response).encode('utf-8'))
+                except OSError as error:
+                    logging.warning('Could not answer a request: ' + str(error))
+    except KeyboardInterrupt:
+        logging.info('The filetags daemon stops.')
+    finally:
+        server.close()
+        os.remove(DAEMON_SOCKET_FILENAME)
+        daemon_is_serving = False
+
+
 def successful_exit():
     logging.debug("successfully finished.")
     sys.stdout.flush()
     sys.exit(0)
 
 
-def main():
-    """Main function"""
+def main(argv=None):
+    """
+    Main function
+
+    @param argv: optional list of command line arguments without the program name; default: sys.argv[1:]
+    """
+
+    global options, TTY_HEIGHT, TTY_WIDTH
+    if argv is None:
+        argv = sys.argv[1:]
+    options = parser.parse_args(argv)
+
+    if not daemon_is_serving:
+        # the daemon uses the terminal width of its client instead
+        safe_import('shutil')
+        TTY_WIDTH, TTY_HEIGHT = shutil.get_terminal_size((80, 80))
 
     if options.version:
         print(os.path.basename(sys.argv[0]) + " version " + PROG_VERSION_DATE)
@@ -3026,7 +6042,7 @@ def main():
         error_exit(3, "I found option \"--tag\" and option \"--interactive\". \n" +
                    "Please choose either tag option OR interactive mode.")
 
-    if options.gui and not have_tkinter:
+    if options.gui and not import_tkinter():
         error_exit(4, "Could not find Python module \"tkinter\", which is required for --gui option. \n"+
         "Please install it (e.g., \"apt install python3-tk\") or don't use this option.")
 
@@ -3044,6 +6060,32 @@ def main():
                               options.tags or options.tag_gardening):
         error_exit(14, "Please don't use that filter option together with any other option.")
 
+    if options.query and (options.tagfilter or options.list_tags_by_number or options.list_tags_by_alphabet or
+                          options.tags or options.tagtrees or options.tag_gardening or options.interactive):
+        error_exit(24, "Please don't use the query option together with any other option.")
+
+    if (options.resume or options.rollback) and (options.resume == options.rollback or options.files or
+                                                 options.files_from or options.tags or options.interactive or
+                                                 options.tagfilter or options.tagtrees or options.query or
+                                                 options.tagtrees_mount or options.tag_gardening or
+                                                 options.list_tags_by_number or options.list_tags_by_alphabet or
+                                                 options.list_unknown_tags):
+        error_exit(32, "Please don't use the resume or rollback option together with any other option.")
+
+    if options.daemon and (options.files or options.files_from or options.tags or options.interactive or
+                           options.tagfilter or options.tagtrees or options.query or options.tagtrees_mount or
+                           options.tag_gardening or options.list_tags_by_number or
+                           options.list_tags_by_alphabet or options.list_unknown_tags or
+                           options.resume or options.rollback):
+        error_exit(33, "Please don't use the daemon option together with any other option.")
+
+    if options.tagtrees_plan and not options.tagtrees:
+        error_exit(28, "The plan option requires the tagtrees option.")
+
+    if options.tagtrees_mount and (options.tagfilter or options.list_tags_by_number or options.list_tags_by_alphabet or
+                                   options.tags or options.tagtrees or options.tag_gardening or options.query):
+        error_exit(26, "Please don't use the tagtrees mount option together with any other option.")
+
     if options.list_tags_by_number and (options.tagfilter or options.list_tags_by_alphabet or
                                         options.tags or options.tagtrees or options.tag_gardening):
         error_exit(15, "Please don't use that list option together with any other option.")
@@ -3066,6 +6108,19 @@ def main():
     logging.debug("extracting list of files ...")
     logging.debug("len(options.files) [%s]" % str(len(options.files)))
 
+    if options.daemon:
+        serve_daemon()
+        successful_exit()
+
+    if not daemon_is_serving and daemon_can_handle_options():
+        code = forward_to_daemon(argv)
+        if code is not None:
+            sys.exit(code)
+
+    if options.resume or options.rollback:
+        handle_option_journal(options.rollback)
+        successful_exit()
+
     files = extract_filenames_from_argument(options.files)
 
     if platform.system() == 'Windows' and len(files)==1:
@@ -3074,6 +6129,7 @@ def main():
         # does: converting file globs to lists of files:
 
         #logging.debug("WINDOWS: files[0] RAW [%s]" % str(files[0]))
+        safe_import('pathlib')
         path = pathlib.Path(files[0]).expanduser()
         parts = path.parts[1:] if path.is_absolute() else path.parts
         expandedfiles = pathlib.Path(path.root).glob(str(pathlib.Path("").joinpath(*parts)))
@@ -3097,8 +6153,19 @@ def main():
         controlled_vocabulary = sorted(locate_and_parse_controlled_vocabulary(False))
     vocabulary = list(controlled_vocabulary)
 
-    if len(options.files) < 1 and not (options.tagtrees or
+    if options.files_from and (not options.tags or options.interactive or options.tagfilter or
+                               options.tagtrees or options.query or options.tagtrees_mount or
+                               options.list_tags_by_alphabet or options.list_tags_by_number or
+                               options.list_unknown_tags or options.tag_gardening):
+        error_exit(29, "The files-from option can only be used for adding or removing the tags of the --tags option.")
+    if options.null_separated and not options.files_from:
+        error_exit(29, "The null option requires the files-from option.")
+
+    if len(options.files) < 1 and not (options.files_from or
+                                       options.tagtrees or
                                        options.tagfilter or
+                                       options.query or
+                                       options.tagtrees_mount or
                                        options.list_tags_by_alphabet or
                                        options.list_tags_by_number or
                                        options.list_unknown_tags or
@@ -3139,6 +6206,16 @@ def main():
     elif options.tagtrees and not options.tagfilter:
         handle_option_tagtrees()
 
+    elif options.query:
+        handle_option_query(options.query[0])
+        successful_exit()
+
+    elif options.tagtrees_mount:
+        mount_tagtrees(TagtreesView(os.getcwd(), options.recursive,
+                                    options.tagtrees_depth[0] if options.tagtrees_depth else None),
+                       options.tagtrees_mount[0])
+        successful_exit()
+
     elif options.interactive or not options.tags:
 
         tags_for_visual = None
@@ -3173,6 +6250,8 @@ def main():
                 logging.debug('User overrides the default tagtrees directory to: ' +
                               str(chosen_tagtrees_dir))
 
+            # the vocabulary and the files to filter are derived from one single traversal:
+            get_tag_scan(os.getcwd(), options.recursive)
             for tag in get_tags_from_files_and_subfolders(startdir=os.getcwd()):
                 add_tag_to_countdict(tag, tags_for_vocabulary)
 
@@ -3283,50 +6362,40 @@ def main():
 
     if options.tagfilter and not files and not options.tagtrees:
         assert_empty_tagfilter_directory(chosen_tagtrees_dir)
-        files = filter_files_matching_tags(get_files_of_directory(os.getcwd()), tags_from_userinput)
+        files = get_files_of_directory_matching_tags(os.getcwd(), tags_from_userinput)
     elif options.tagfilter and not files and options.tagtrees:
         # the combination of tagtrees and tagfilter requires user input of tags which was done above
         handle_option_tagtrees(tags_from_userinput)
 
     logging.debug("iterate over files ...")
 
-    global max_file_length
-    for filename in files:
-        if len(filename) > max_file_length:
-            max_file_length = len(filename)
-    logging.debug('determined maximum file name length with %i' % max_file_length)
-
-    num_errors = 0
-    for filename in files:
-
-        if not os.path.exists(filename):
-            logging.error('File "' + filename + '" does not exist. Skipping this one …')
-            logging.debug('problematic filename: ' + filename)
-            logging.debug('os.getcwd() = ' + os.getcwd())
-            num_errors += 1
+    if options.files_from:
+        try:
+            listed_filenames = read_filenames_from(options.files_from[0], options.null_separated)
+        except OSError as error:
+            error_exit(37, 'Could not read the list of files of --files-from: ' + str(error))
 
-        elif is_broken_link(filename):
-            # skip broken links completely and write error message:
-            logging.error('File "' + filename + '" is a broken link. Skipping this one …')
-            num_errors += 1
+    global rename_journal
+    if options.journal and not options.dryrun:
+        try:
+            rename_journal = RenameJournal(JOURNAL_FILENAME)
+        except FileExistsError:
+            error_exit(30, 'Found the journal "' + JOURNAL_FILENAME + '" of an interrupted run. ' +
+                       'Please complete it with --resume or undo it with --rollback first.')
 
+    try:
+        if options.files_from:
+            num_errors = 0
+            filenames = itertools.chain(files, listed_filenames)
+            for chunk in get_chunks(filenames, FILES_FROM_CHUNK_SIZE):
+                num_errors += handle_files(chunk, tags_from_userinput)
         else:
-
-            # if filename is a link, tag the source file as well:
-            handle_file_and_optional_link(filename,
-                                          tags_from_userinput,
-                                          options.remove,
-                                          options.tagfilter,
-                                          options.dryrun)
-            logging.debug('list_of_link_directories: ' + repr(list_of_link_directories))
-
-            if len(list_of_link_directories) > 1:
-                logging.debug('Seems like we\'ve found links and renamed their source ' +
-                              'as well. Print out the those directories as well:')
-                print('      This link has a link source with a matching basename. I renamed it there as well:')
-                for directory in list_of_link_directories[:-1]:
-                    print('      · ' + directory)
-            list_of_link_directories = []
+            num_errors = handle_files(files, tags_from_userinput)
+    finally:
+        # also on errors and error_exit(): a journal without pending operations would block later runs
+        if rename_journal:
+            rename_journal.close()
+            rename_journal = None
 
     if num_errors > 0:
         error_exit(20, str(num_errors) + ' error(s) occurred. Please check messages above.')
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Library interface of filetags: adding and removing tags, scanning and
+# filtering without the command line options and without the module
+# state of the command line tool. This allows to use filetags within
+# other processes, in threads and in loops:
+#
+#     from filetags.api import TagStore
+#     store = TagStore('~/archive')
+#     result = store.add_tags(['2024-05-01 beach.jpg'], ['vacation'])
+#     print(result.renamed)
+#     print(store.filter(query='vacation AND NOT draft'))
+
+import os
+import threading
+
+import filetags
+
+
+class Vocabulary(object):
+    """
+    A controlled vocabulary: its tags, the groups of mutually exclusive
+    tags (see "unique tags") and the tags which are not suggested.
+    """
+
+    def __init__(self, tags=(), unique_tags=(), do_not_suggest_tags=(), filename=None):
+        """
+        @param tags: list of tags
+        @param unique_tags: list of lists of mutually exclusive tags
+        @param do_not_suggest_tags: list of lower-case tags which are not suggested
+        @param filename: optional file name the vocabulary was read from
+        """
+
+        self.tags = list(tags)
+        self.unique_tags = [list(x) for x in unique_tags]
+        self.do_not_suggest_tags = list(do_not_suggest_tags)
+        self.filename = filename
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        @param filename: file name of a controlled vocabulary including its #include files
+        @param return: Vocabulary
+        """
+
+        tags, unique_tags, do_not_suggest_tags, files = filetags.read_controlled_vocabulary_cached(filename)
+        return cls(tags, unique_tags, do_not_suggest_tags, filename)
+
+    @classmethod
+    def locate(cls, startdir):
+        """
+        @param startdir: directory whose controlled vocabulary is looked for in it and its parent directories
+        @param return: Vocabulary which is empty if none was found
+        """
+
+        filename = filetags.locate_file_in_cwd_and_parent_directories(startdir, filetags.CONTROLLED_VOCABULARY_FILENAME)
+        if filename:
+            return cls.from_file(filename)
+        return cls()
+
+    def get_invalid_tags(self, tags):
+        """
+        @param tags: list of tags; tags starting with '-' get removed and are always valid if known
+        @param return: list of tags which are not part of the vocabulary
+        """
+
+        return filetags.get_invalid_tags_for_vocabulary(tags, self.tags)
+
+
+class RenameResult(object):
+    """
+    The outcome of TagStore.add_tags() and TagStore.remove_tags().
+    """
+
+    def __init__(self):
+        self.renamed = []  # list of (file name, new file name)
+        self.collisions = []  # list of (file name, new file name) which already existed and were not renamed
+        self.skipped = []  # list of file names which are no regular files: links, directories, missing files
+        self.errors = []  # list of (file name, OSError) of failed renames
+
+    def __repr__(self):
+        return 'RenameResult(renamed=%i, collisions=%i, skipped=%i, errors=%i)' % \
+            (len(self.renamed), len(self.collisions), len(self.skipped), len(self.errors))
+
+
+class TagStore(object):
+    """
+    The tagged files below a root directory.
+
+    All configuration is passed explicitly; neither the command line
+    options nor the module state of filetags are used or changed.
+    Relative paths are relative to the root directory. A TagStore can
+    be shared between threads.
+    """
+
+    def __init__(self, root, vocabulary=None, recursive=True, force_vocabulary=False, jobs=1):
+        """
+        @param root: the directory of the store
+        @param vocabulary: Vocabulary, file name of a controlled vocabulary or list of tags;
+                           default: the controlled vocabulary of root or its parent directories
+        @param recursive: if True, scan() and filter() include the sub-directories of root
+        @param force_vocabulary: if True, only tags of the vocabulary can be added
+        @param jobs: number of threads for listing directories
+        """
+
+        self.root = os.path.abspath(os.path.expanduser(root))
+        if vocabulary is None:
+            vocabulary = Vocabulary.locate(self.root)
+        elif isinstance(vocabulary, str):
+            vocabulary = Vocabulary.from_file(vocabulary)
+        elif not isinstance(vocabulary, Vocabulary):
+            vocabulary = Vocabulary(vocabulary)
+        self.vocabulary = vocabulary
+        self.recursive = recursive
+        self.force_vocabulary = force_vocabulary
+        self.jobs = jobs
+        self._scan = None
+        self._lock = threading.Lock()
+
+    def get_path(self, path):
+        """
+        @param path: file name, absolute or relative to the root
+        @param return: absolute file name
+        """
+
+        return os.path.normpath(os.path.join(self.root, os.path.expanduser(path)))
+
+    def add_tags(self, paths, tags, dryrun=False):
+        """
+        @param paths: list of file names
+        @param tags: list of tags to add; tags starting with '-' get removed
+        @param dryrun: if True, the renames are determined but not applied
+        @param return: RenameResult
+        """
+
+        if self.force_vocabulary:
+            invalid_tags = self.vocabulary.get_invalid_tags(tags)
+            if invalid_tags:
+                raise ValueError('Tags not part of the controlled vocabulary: ' + ' '.join(invalid_tags))
+        return self._rename(paths, tags, False, dryrun)
+
+    def remove_tags(self, paths, tags, dryrun=False):
+        """
+        @param paths: list of file names
+        @param tags: list of tags to remove
+        @param dryrun: if True, the renames are determined but not applied
+        @param return: RenameResult
+        """
+
+        return self._rename(paths, tags, True, dryrun)
+
+    def _rename(self, paths, tags, do_remove, dryrun):
+
+        result = RenameResult()
+        renames, result.skipped, result.collisions = filetags.plan_batch_renames(
+            [self.get_path(x) for x in paths], list(tags), do_remove, self.vocabulary.unique_tags)
+        result.errors = filetags.apply_batch_renames(renames, dryrun)
+        failed = set(filename for filename, error in result.errors)
+        for dirname, items in renames.items():
+            for basename, new_basename in items:
+                if os.path.join(dirname, basename) not in failed:
+                    result.renamed.append((os.path.join(dirname, basename), os.path.join(dirname, new_basename)))
+        return result
+
+    def _get_scan(self):
+        "Returns an up-to-date TagScan of the root"
+
+        with self._lock:
+            if not self._scan or not self._scan.is_up_to_date(self.recursive):
+                self._scan = filetags.TagScan(self.root, self.recursive, jobs=self.jobs)
+            return self._scan
+
+    def scan(self):
+        """
+        @param return: list of FileRecord objects of the files (no links) below the root
+        """
+
+        return self._get_scan().get_files_with_metadata(self.recursive)
+
+    def get_tag_counts(self):
+        """
+        @param return: dict of tag → number of files and directories having it
+        """
+
+        return self._get_scan().get_tag_counts(self.recursive)
+
+    def filter(self, tags=(), query=None):
+        """
+        @param tags: list of tags which all have to match
+        @param query: optional query string like for --query, e.g. "(a OR b) AND NOT c"
+        @param return: list of absolute file names (including links) matching tags and query
+        """
+
+        index = self._get_scan().get_inverted_tag_index(self.recursive)
+        ids = index.matching_all(list(tags))
+        if query:
+            ids = ids.intersection(filetags.compile_query(query).evaluate(index))
+        return [os.path.join(self.root, x) for x in index.get_filenames(ids)]
+
+# END OF FILE #################################################################
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures the time of "import filetags" in fresh interpreters and lists
+# the modules that take the most time to import.
+#
+# invoke the benchmark using following command line:
+# ~/src/filetags % PYTHONPATH=".:" tests/benchmark_import_time.py [RUNS]
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+NUM_SLOWEST_MODULES = 10
+
+
+def run_interpreter(code, *arguments):
+    environment = dict(os.environ)
+    environment.pop('PYTHONDONTWRITEBYTECODE', None)  # compiling filetags each time would dominate
+    return subprocess.run([sys.executable, *arguments, '-c', code], env=environment,
+                          capture_output=True, text=True, check=True)
+
+
+def measure_seconds(code):
+    start = time.perf_counter()
+    run_interpreter(code)
+    return time.perf_counter() - start
+
+
+def get_slowest_modules():
+    "Returns list of (cumulative microseconds, module) of 'python -X importtime'"
+
+    modules = []
+    for line in run_interpreter('import filetags', '-X', 'importtime').stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, module = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), module.rstrip()))
+    return sorted(modules, reverse=True)[:NUM_SLOWEST_MODULES]
+
+
+if __name__ == '__main__':
+    run_interpreter('import filetags')  # compile and cache the byte code
+    baseline = statistics.median(measure_seconds('pass') for run in range(RUNS))
+    importing = statistics.median(measure_seconds('import filetags') for run in range(RUNS))
+
+    print('median of %i runs:' % RUNS)
+    print('  python -c "pass"             %6.1f ms' % (baseline * 1000))
+    print('  python -c "import filetags"  %6.1f ms' % (importing * 1000))
+    print('  import filetags              %6.1f ms' % ((importing - baseline) * 1000))
+    print('\nslowest modules (cumulative import time):')
+    for microseconds, module in get_slowest_modules():
+        print('  %6.1f ms  %s' % (microseconds / 1000, module))
+
+    heavy_modules = ['tkinter', 'difflib', 'clint', 'readline', 'win32com', 'socket', 'concurrent.futures']
+    imported = run_interpreter('import sys, filetags; print(" ".join(sorted(sys.modules)))').stdout.split()
+    print('\nfeature modules imported by "import filetags": ' +
+          (', '.join(x for x in heavy_modules if x in imported) or 'none'))
+
+# END OF FILE #################################################################
@@ -6,15 +6,18 @@
 # invoke tests using following command line:
 # ~/src/vktag % PYTHONPATH="~/src/filetags:" tests/unit_tests.py --verbose
 
+import itertools
 import logging
 import os
 import os.path
 import platform
+import subprocess
 import sys
 import tempfile
 import time  # for sleep()
 import unittest
 from shutil import rmtree
+from unittest.mock import patch
 
 import filetags
 
@@ -35,6 +38,14 @@ class TestMethods(unittest.TestCase):
     def setUp(self):
         pass
 
+    def test_import_does_not_load_feature_modules(self):
+
+        environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(filetags.__file__)))
+        output = subprocess.run([sys.executable, '-c', 'import sys, filetags; print(" ".join(sys.modules))'],
+                                env=environment, capture_output=True, text=True, check=True).stdout.split()
+        for module in ['tkinter', 'difflib', 'clint', 'readline', 'win32com', 'socket', 'concurrent.futures']:
+            self.assertNotIn(module, output)
+
     def test_contains_tag(self):
 
         self.assertEqual(filetags.contains_tag('Some file name -- foo.jpeg', 'foo'), True)
@@ -152,6 +163,31 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(filetags.extract_tags_from_filename('Some file name -- foo bar baz.jpeg.lnk'),
                          ['foo', 'bar', 'baz'])
 
+    def test_parse_filename(self):
+
+        parsed = filetags.parse_filename('/does/not/exist/2018-03-18 foo -- bar baz.txt.lnk')
+        self.assertEqual(parsed.basename, '2018-03-18 foo -- bar baz.txt.lnk')
+        self.assertEqual(parsed.basename_without_lnk, '2018-03-18 foo -- bar baz.txt')
+        self.assertTrue(parsed.is_lnk)
+        self.assertEqual(parsed.tags, ('bar', 'baz'))
+        self.assertEqual(parsed.name, '2018-03-18 foo')
+        self.assertEqual(parsed.extension, 'txt')
+        self.assertEqual(parsed.name_without_extension, '2018-03-18 foo -- bar baz')
+
+        parsed = filetags.parse_filename('Some file name')
+        self.assertEqual((parsed.tags, parsed.name, parsed.extension, parsed.raw_extension), ((), None, None, None))
+
+        # parsed names are memoized by their basename:
+        self.assertIs(filetags.parse_filename('a/foo -- bar.txt'), filetags.parse_filename('b/foo -- bar.txt'))
+
+        # parsing never accesses the file system:
+        with patch('os.path.exists') as exists, patch('os.stat') as stat:
+            self.assertEqual(filetags.adding_tag_to_filename('x/foo -- bar.txt', 'baz'), 'x/foo -- bar baz.txt')
+            self.assertEqual(filetags.removing_tag_from_filename('foo -- bar.txt', 'bar'), 'foo.txt')
+            self.assertEqual(filetags.extract_tags_from_filename('foo -- qux.txt'), ['qux'])
+        exists.assert_not_called()
+        stat.assert_not_called()
+
     def test_add_tag_to_countdict(self):
         self.assertEqual(filetags.add_tag_to_countdict('tag', {}), {'tag': 1})
         self.assertEqual(filetags.add_tag_to_countdict('tag', {'tag': 0}), {'tag': 1})
@@ -171,6 +207,70 @@ class TestMethods(unittest.TestCase):
                                                                 'Schneewittchen']),
                          ['impson', 'Simson', 'Simpso', 'simpson', 'mpson', 'sumpson'])
 
+    def test_similar_tag_index(self):
+
+        tags = ['foobar', 'Simson', 'simpson', 'Frankenstein', 'sumpson', 'Simpso', 'impson', 'mpson',
+                'Schneewittchen', 'Simpson', 'Simpson', '', 'ab', 'ba', 'aab', 'Bildung', 'Bildungen', 'xü' * 120]
+        tags += [''.join(x) for x in itertools.product('abc', repeat=4)]
+        index = filetags.SimilarTagIndex(tags)
+        for tag in tags + ['xxx', 'Simpsonn', 'xü' * 119 + 'x', 'b']:
+            self.assertEqual(index.find_similar_tags(tag), filetags.find_similar_tags(tag, tags))
+
+        # like difflib, the maximum number of matches includes exact matches:
+        tags = ['tagname'] * 990 + ['tagnames'] * 20
+        self.assertEqual(filetags.SimilarTagIndex(tags).find_similar_tags('tagname'), ['tagnames'] * 9)
+        self.assertEqual(filetags.find_similar_tags('tagname', tags), ['tagnames'] * 9)
+
+    def test_similar_tag_index_batch(self):
+
+        tags = ['Simpson', 'Simson', 'simpson', 'sumpson', 'impson', 'Frankenstein', 'Frankensteins', '', 'xü' * 40]
+        tags += [''.join(x) for x in itertools.product('abc', repeat=4)]
+        index = filetags.SimilarTagIndex(tags)
+        expected = {tag: index.get_scored_matches(tag) for tag in tags + ['Simpsons', 'zzz']}
+        with patch('filetags.import_numpy', return_value=False):
+            self.assertEqual(index.get_all_scored_matches(tags + ['Simpsons', 'zzz']), expected)
+        if filetags.import_numpy():
+            with patch('filetags.SIMILAR_TAGS_BATCH_MIN_PAIRS', 0), patch('filetags.SIMILAR_TAGS_BATCH_CHUNK_PAIRS', 500):
+                self.assertEqual(index.get_all_scored_matches(tags + ['Simpsons', 'zzz']), expected)
+
+    def test_similar_tags_cache(self):
+
+        cache = filetags.SimilarTagsCache()
+        tags = ['Simpson', 'Simson', 'simpson', 'sumpson', 'impson', 'Frankenstein', 'Frankensteins', 'foobar']
+        version = cache.get_version(tags)
+        subset_version = cache.get_version(set(tags[3:]))
+        self.assertEqual(cache.get_version(reversed(tags)), version)
+        self.assertNotEqual(subset_version, version)
+        self.assertIs(cache.indices[subset_version], cache.indices[version])
+
+        for tag in tags + ['Simpsons']:
+            self.assertEqual(cache.find_similar_tags(tag, version), filetags.find_similar_tags(tag, tags))
+            self.assertEqual(cache.find_similar_tags(tag, subset_version), filetags.find_similar_tags(tag, tags[3:]))
+        self.assertIs(cache.find_similar_tags('Simpson', version), cache.find_similar_tags('Simpson', version))
+
+        self.assertIs(filetags.get_similar_tags_cache(), filetags.get_similar_tags_cache())
+        filetags.reset_run_state()
+        self.assertIsNone(filetags.similar_tags_cache)
+
+    def test_simple_completer(self):
+
+        tags = ['Foto', 'foo', 'food', 'bar', 'barfoo', '-foo', 'Straße', 'fo\U0010ffff', 'fo\U0010ffffx', '', 'foo']
+
+        def complete_all(completer, text):
+            return list(iter(lambda state=itertools.count(): completer.complete(text, next(state)), None))
+
+        completer = filetags.SimpleCompleter(tags)
+        for text in ['', 'f', 'fo', 'foo', 'food', 'x', '-', 'fo\U0010ffff', 'Fo']:
+            self.assertEqual(complete_all(completer, text), sorted(set(x for x in tags if x and x.startswith(text))))
+        self.assertIs(completer.get_matches('fo'), completer.get_matches('fo'))
+
+        completer = filetags.SimpleCompleter(tags, 'ignorecase')
+        self.assertEqual(complete_all(completer, 'FO'), ['foo', 'food', 'Foto', 'fo\U0010ffff', 'fo\U0010ffffx'])
+        self.assertEqual(complete_all(completer, 'strass'), ['Straße'])
+
+        completer = filetags.SimpleCompleter(tags, 'substring')
+        self.assertEqual(complete_all(completer, 'foo'), ['foo', 'food', '-foo', 'barfoo'])
+
     def test_check_for_possible_shortcuts_in_entered_tags(self):
 
         self.assertEqual(filetags.check_for_possible_shortcuts_in_entered_tags(['bar'],
@@ -415,6 +515,15 @@ class TestLocateAndParseControlledVocabulary(unittest.TestCase):
         self.assertEqual(filetags.locate_and_parse_controlled_vocabulary(self.subdir1_test_file),
                          [self.subdir2_cv])
 
+    def test_find_cv_in_parent_directories_keeps_working_directory(self):
+
+        deep_dir = os.path.join(self.subdir3, 'a', 'b')
+        os.makedirs(deep_dir)
+        self.assertEqual(filetags.locate_file_in_cwd_and_parent_directories(deep_dir, '.filetags'),
+                         self.tempdir_file)
+        self.assertEqual(os.getcwd(), self.subdir3)
+        self.assertFalse(filetags.locate_file_in_cwd_and_parent_directories(deep_dir, 'no such file'))
+
     def test_find_cv_as_file_in_tempdir_when_startfile_dir_has_nothing(self):
 
         # Note: cwd = subdir3
@@ -631,6 +740,53 @@ class TestLocateAndParseControlledVocabulary(unittest.TestCase):
         cv = filetags.locate_and_parse_controlled_vocabulary(circular1_file)
         self.assertEqual(set(cv), set(["tag_from_first_before_CV", "tag_from_first_after_CV", "tag_from_second_before_CV", "tag_from_second_after_CV"]))
 
+    def test_cached_controlled_vocabulary(self):
+
+        included_file = os.path.join(self.subdir2, 'included.filetags')
+        self.create_file(self.tempdir_file, 'first\nsecond third\n#include subdir2/included.filetags\n')
+        self.create_file(included_file, 'included\n')
+        for filename in [self.tempdir_file, included_file]:
+            os.utime(filename, (time.time() - 60, time.time() - 60))
+        cachedir = os.path.join(self.tempdir, 'cache')
+
+        with patch('filetags.VOCABULARY_CACHE_DIRECTORY', cachedir), \
+             patch('filetags.VOCABULARY_CACHE_MIN_BYTES', 0), \
+             patch('filetags.vocabulary_cache', {}):
+            expected = (['first', 'second', 'third', 'included'], [['second', 'third']], [],
+                        [os.path.realpath(self.tempdir_file), os.path.realpath(included_file)])
+            self.assertEqual(filetags.read_controlled_vocabulary_cached(self.tempdir_file), expected)
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+
+            # the snapshot on the disk is used without parsing the files again:
+            filetags.vocabulary_cache.clear()
+            with patch('filetags.read_controlled_vocabulary') as read_controlled_vocabulary:
+                self.assertEqual(filetags.read_controlled_vocabulary_cached(self.tempdir_file), expected)
+                self.assertFalse(read_controlled_vocabulary.called)
+
+            # changing an included file invalidates the snapshot:
+            self.create_file(included_file, 'included\nanother\n')
+            self.assertEqual(filetags.read_controlled_vocabulary_cached(self.tempdir_file)[0],
+                             ['first', 'second', 'third', 'included', 'another'])
+
+            # --dryrun writes no snapshot:
+            rmtree(cachedir)
+            for filename in [self.tempdir_file, included_file]:
+                os.utime(filename, (time.time() - 60, time.time() - 60))
+            with patch.object(filetags.options, 'dryrun', True), patch('filetags.unique_tags', []), \
+                 patch('filetags.included_files', []):
+                self.assertEqual(len(filetags.parse_controlled_vocabulary(self.tempdir_file)), 5)
+            self.assertFalse(os.path.exists(cachedir))
+
+    def test_parse_controlled_vocabulary_twice(self):
+
+        self.create_file(self.tempdir_file, 'first\nsecond third\n')
+        with patch('filetags.unique_tags', [filetags.unique_tags[0]]), \
+             patch('filetags.included_files', []):
+            for run in range(2):
+                self.assertEqual(filetags.parse_controlled_vocabulary(self.tempdir_file), ['first', 'second', 'third'])
+            self.assertEqual(filetags.unique_tags[1:], [['second', 'third']])
+            self.assertEqual(filetags.included_files, [os.path.realpath(self.tempdir_file)])
+
 class TestFileWithoutTags(unittest.TestCase):
 
     tempdir = None
@@ -668,6 +824,149 @@ class TestFileWithoutTags(unittest.TestCase):
                                   ['bar'],
                                   do_remove=False, do_filter=False, dryrun=False)
 
+    def test_batch_renames(self):
+
+        self.create_tmp_file('second.txt')
+        self.create_tmp_file('second -- bar.txt')
+        os.mkdir(os.path.join(self.tempdir, 'directory'))
+        files = [self.testfilename, 'second.txt', 'directory', 'missing.txt', self.testfilename]
+        if platform.system() != 'Windows':
+            os.symlink(self.testfilename, os.path.join(self.tempdir, 'link.txt'))
+            files.append('link.txt')
+
+        renames, remaining_files, collisions = filetags.plan_batch_renames(files, ['bar'], do_remove=False)
+        self.assertEqual(renames, {self.tempdir: [(self.testfilename, 'a test file . for you -- bar.txt')]})
+        self.assertEqual(remaining_files, ['directory', 'missing.txt'] + files[5:])
+        self.assertEqual(collisions, [(os.path.join(self.tempdir, 'second.txt'),
+                                       os.path.join(self.tempdir, 'second -- bar.txt'))])
+
+        reported = []
+        self.assertEqual(filetags.apply_batch_renames(renames, report=lambda *args: reported.append(args)), [])
+        self.assertEqual(reported, [(self.tempdir, self.testfilename, 'a test file . for you -- bar.txt')])
+        self.assertTrue(self.file_exists('a test file . for you -- bar.txt'))
+        self.assertFalse(self.file_exists(self.testfilename))
+
+    def test_read_filenames_from(self):
+
+        listfile = os.path.join(self.tempdir, 'list')
+        with open(listfile, 'wb') as outputhandle:
+            outputhandle.write(b'one.txt\r\n\ntwo words.txt\nlast')
+        self.assertEqual(list(filetags.read_filenames_from(listfile)), ['one.txt', 'two words.txt', 'last'])
+
+        with open(listfile, 'wb') as outputhandle:
+            outputhandle.write(b'new\nline.txt\0' + 'ümlaut.txt'.encode('utf-8') + b'\0')
+        with patch('filetags.FILES_FROM_READ_SIZE', 3):
+            self.assertEqual(list(filetags.read_filenames_from(listfile, null_separated=True)),
+                             ['new\nline.txt', 'ümlaut.txt'])
+
+        self.assertEqual(list(filetags.get_chunks(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_files_from_missing_list(self):
+
+        with patch.object(filetags, 'options', filetags.options), self.assertRaises(SystemExit) as context:
+            filetags.main(['-t', 'foo', '--files-from', os.path.join(self.tempdir, 'missing list')])
+        self.assertEqual(context.exception.code, 37)
+
+    def test_rename_journal(self):
+
+        journalfile = os.path.join(self.tempdir, 'journal')
+        self.create_tmp_file('second.txt')
+        operations = [['rename', os.path.join(self.tempdir, self.testfilename),
+                       os.path.join(self.tempdir, 'a test file . for you -- bar.txt')],
+                      ['rename', os.path.join(self.tempdir, 'second.txt'),
+                       os.path.join(self.tempdir, 'second -- bar.txt')]]
+
+        # a run that got interrupted before the second rename:
+        journal = filetags.RenameJournal(journalfile)
+        journal.log(operations[:1])
+        os.rename(*operations[0][1:])
+        journal.checkpoint()
+        journal.log(operations[1:])
+        with self.assertRaises(FileExistsError):
+            filetags.RenameJournal(journalfile)
+        journal.handle.close()
+        self.assertEqual(filetags.read_journal(journalfile), (operations, 1))
+
+        with patch('filetags.JOURNAL_FILENAME', journalfile):
+            filetags.handle_option_journal(rollback=False)
+            self.assertFalse(os.path.exists(journalfile))
+            self.assertTrue(self.file_exists('second -- bar.txt'))
+
+            journal = filetags.RenameJournal(journalfile)
+            journal.log(operations)
+            journal.handle.close()
+            filetags.handle_option_journal(rollback=True)
+            self.assertTrue(self.file_exists(self.testfilename))
+            self.assertTrue(self.file_exists('second.txt'))
+            self.assertFalse(os.path.exists(journalfile))
+
+            # a run that ends with an error_exit() leaves no journal without pending operations behind:
+            with patch.object(filetags, 'options', filetags.options), \
+                 patch('filetags.handle_files', side_effect=SystemExit(21)), self.assertRaises(SystemExit):
+                filetags.main(['-t', 'foo', '--journal', os.path.join(self.tempdir, self.testfilename)])
+            self.assertFalse(os.path.exists(journalfile))
+
+            # a journal with logged operations which may not have been applied remains:
+            journal = filetags.RenameJournal(journalfile)
+            journal.log(operations[:1])
+            journal.close()
+            self.assertTrue(os.path.exists(journalfile))
+
+    def test_daemon_request(self):
+
+        options = filetags.options
+        with patch('filetags.daemon_is_serving', True):
+            response = filetags.run_daemon_request({'argv': ['-t', 'bar', self.testfilename],
+                                                    'cwd': self.tempdir, 'tty_width': 80})
+        self.assertEqual(response['code'], 0)
+        self.assertIn('a test file . for you -- bar.txt', response['stdout'])
+        self.assertTrue(self.file_exists('a test file . for you -- bar.txt'))
+        self.assertIs(filetags.options, options)
+
+        with patch('filetags.daemon_is_serving', True):
+            response = filetags.run_daemon_request({'argv': ['-t', 'bar', 'missing.txt'],
+                                                    'cwd': self.tempdir, 'tty_width': 80})
+        self.assertEqual(response['code'], 20)
+        self.assertIn('missing.txt', response['stderr'])
+
+        with patch('filetags.DAEMON_SOCKET_FILENAME', os.path.join(self.tempdir, 'no daemon')):
+            self.assertIsNone(filetags.forward_to_daemon(['--la']))
+
+    def test_api_tag_store(self):
+
+        import filetags.api
+
+        self.create_tmp_file('second -- draft.txt')
+        unique_tags = list(filetags.unique_tags)
+        store = filetags.api.TagStore(self.tempdir, filetags.api.Vocabulary(
+            ['bar', 'draft', 'final'], unique_tags=[['draft', 'final']]), force_vocabulary=True)
+
+        result = store.add_tags([self.testfilename, 'second -- draft.txt'], ['bar', 'final'])
+        self.assertEqual(result.renamed, [
+            (os.path.join(self.tempdir, self.testfilename),
+             os.path.join(self.tempdir, 'a test file . for you -- bar final.txt')),
+            (os.path.join(self.tempdir, 'second -- draft.txt'), os.path.join(self.tempdir, 'second -- bar final.txt'))])
+        self.assertEqual(filetags.unique_tags, unique_tags)
+        with self.assertRaises(ValueError):
+            store.add_tags(['second -- bar final.txt'], ['unknown'])
+
+        self.assertEqual(len(store.scan()), 2)
+        self.assertEqual(store.filter(['bar', 'final']), [os.path.join(self.tempdir, x) for x in
+                         ['a test file . for you -- bar final.txt', 'second -- bar final.txt']])
+
+        result = store.remove_tags([os.path.join(self.tempdir, 'second -- bar final.txt')], ['final'])
+        self.assertEqual(len(result.renamed), 1)
+        self.assertEqual(store.filter(query='bar AND NOT final'), [os.path.join(self.tempdir, 'second -- bar.txt')])
+
+        # the memoized views of a shared TagStore are computed once, even by concurrent threads:
+        import concurrent.futures
+        with patch('filetags.InvertedTagIndex', wraps=filetags.InvertedTagIndex) as inverted_tag_index:
+            store = filetags.api.TagStore(self.tempdir, [])
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(lambda function: function(), [store.filter, store.get_tag_counts] * 16))
+            self.assertEqual(inverted_tag_index.call_count, 1)
+        self.assertEqual(len(set(len(x) for x in results[::2])), 1)
+
     def test_add_and_remove_tags(self):
 
         # adding a tag to a file without any tags:
@@ -882,7 +1181,178 @@ class TestHierarchyWithFilesAndFolders(unittest.TestCase):
         self.assertEqual(filetags.get_tags_from_files_and_subfolders(self.tempdir, use_cache=False),
                          {'baz': 2, 'bar': 2, 'teststring1': 1})
 
-        # FIXXME: write test which tests the cache
+    def test_tag_scan_is_shared(self):
+
+        scan = filetags.get_tag_scan(self.tempdir, recursive=True, use_cache=False)
+
+        # all views of the same directory re-use the one scan without traversing again:
+        self.assertIs(filetags.get_tag_scan(self.tempdir, True), scan)
+        self.assertIs(filetags.get_tag_scan(self.tempdir, False), scan)
+        self.assertEqual(scan.get_tag_counts(False), {'baz': 2, 'bar': 2, 'teststring1': 1})
+        self.assertEqual(scan.get_tag_counts(True), {'baz': 5, 'bar': 4, 'teststring1': 3})
+        self.assertEqual(scan.get_filenames(False), ['foo1 -- bar.txt', 'foo2 -- bar baz.txt',
+                                                     'foo3 -- baz teststring1.txt'])
+        self.assertEqual(len(scan.get_filenames(True)), 9)
+        self.assertEqual(scan.get_file_tag_counts(True), {'baz': 5, 'bar': 4, 'teststring1': 3})
+        self.assertIs(scan.get_files_with_metadata(True), scan.get_files_with_metadata(True))
+
+        # use_cache=False always scans again:
+        self.assertIsNot(filetags.get_tag_scan(self.tempdir, True, use_cache=False), scan)
+
+    def test_file_records(self):
+
+        os.rename(self.subdir1, os.path.join(self.tempdir, 'sub dir 1 -- baz'))
+        scan = filetags.TagScan(self.tempdir, recursive=True)
+        records = scan.directories[1].files
+        self.assertEqual([x.filename for x in records][:2], ['foo4 -- bar.txt', 'foo5.txt'])
+
+        # directory information is shared instead of being copied into each record:
+        self.assertIs(records[0].directory, records[1].directory)
+        self.assertTrue(records[0].path.endswith('sub dir 1 -- baz'))
+        self.assertEqual(records[0].filetags, ('bar',))
+        self.assertEqual(records[0].alltags, ('baz', 'bar'))
+        self.assertIs(records[1].alltags, records[1].directory.pathtags)
+        self.assertEqual(records[5].alltags, ('baz', 'bar'))
+        self.assertRaises(AttributeError, setattr, records[0], 'unknown', 42)
+
+    def test_inverted_tag_index(self):
+
+        index = filetags.TagScan(self.tempdir, recursive=True).get_inverted_tag_index(True)
+        names = lambda ids: [os.path.basename(x) for x in index.get_filenames(ids)]
+
+        self.assertEqual(names(index.matching_all(['baz', 'bar'])), ['foo2 -- bar baz.txt', 'foo9 -- baz bar.txt'])
+        self.assertEqual(names(index.matching_all(['baz', 'unknown'])), [])
+        self.assertEqual(len(index.matching_all([])), 9)
+        self.assertEqual(names(index.matching_any(['bar', 'teststring1']))[:3],
+                         ['foo1 -- bar.txt', 'foo2 -- bar baz.txt', 'foo3 -- baz teststring1.txt'])
+        self.assertEqual(names(index.excluding(index.matching_all(['baz']), ['bar', 'teststring1'])),
+                         ['foo8 -- baz.txt'])
+
+        # the index gives the same results as filtering the file names one by one:
+        recursive, filetags.options.recursive = filetags.options.recursive, True
+        try:
+            self.assertEqual(filetags.get_files_of_directory_matching_tags(self.tempdir, ['baz']),
+                             filetags.filter_files_matching_tags(
+                                 filetags.get_files_of_directory(self.tempdir), ['baz']))
+        finally:
+            filetags.options.recursive = recursive
+
+    def test_query(self):
+
+        os.rename(self.subdir1, os.path.join(self.tempdir, 'sub dir 1 -- project'))
+        self.create_tmp_file(self.tempdir, '2020-01-31 report -- bar.txt')
+        self.create_tmp_file(self.tempdir, '2020-02-01 report -- bar draft.txt')
+        self.create_tmp_file(self.tempdir, '2021-06-15T12.00 photo.jpg')
+
+        index = filetags.TagScan(self.tempdir, recursive=True).get_inverted_tag_index(True)
+
+        def query(query):
+            return [os.path.basename(x) for x in index.get_filenames(filetags.compile_query(query).evaluate(index))]
+
+        self.assertEqual(query('bar AND baz'), ['foo2 -- bar baz.txt', 'foo9 -- baz bar.txt'])
+        self.assertEqual(query('bar baz'), query('bar AND baz'))
+        self.assertEqual(query('baz AND NOT path:project'), ['foo2 -- bar baz.txt', 'foo3 -- baz teststring1.txt'])
+        self.assertEqual(query('path:project AND (bar OR teststring1) AND NOT baz'),
+                         ['foo4 -- bar.txt', 'foo7 -- teststring1.txt'])
+        self.assertEqual(query('NOT (bar OR baz OR teststring1)'), ['2021-06-15T12.00 photo.jpg', 'foo5.txt'])
+        self.assertEqual(query('date>=2020-02'), ['2020-02-01 report -- bar draft.txt', '2021-06-15T12.00 photo.jpg'])
+        self.assertEqual(query('date<=2020-01'), ['2020-01-31 report -- bar.txt'])
+        self.assertEqual(query('date=2020 AND bar AND NOT draft'), ['2020-01-31 report -- bar.txt'])
+        self.assertEqual(query('date>2020'), ['2021-06-15T12.00 photo.jpg'])
+        self.assertEqual(query('unknown OR date<2000'), [])
+
+        # the planner evaluates the most selective term first:
+        positives, negatives = filetags.compile_query('baz AND NOT teststring1 AND draft').get_plan(index)
+        self.assertEqual([str(x) for x in positives], ['draft', 'baz'])
+
+        for invalid in ['', 'bar AND', '(bar', 'bar)', 'date>=20', 'OR bar',
+                        'foo(bar)', '(bar)baz', '"bar', '""', 'bar"baz"']:
+            self.assertRaises(ValueError, filetags.compile_query, invalid)
+
+        # quoted tags are taken literally:
+        self.create_tmp_file(self.tempdir, 'foo10 -- foo(bar) AND date<x.txt')
+        index = filetags.TagScan(self.tempdir, recursive=True).get_inverted_tag_index(True)
+        self.assertEqual(str(filetags.compile_query('("foo(bar)") OR path:"AND"')), '(foo(bar) OR path:AND)')
+        self.assertEqual(query('"foo(bar)" "AND" AND "date<x"'), ['foo10 -- foo(bar) AND date<x.txt'])
+        self.assertRaises(TypeError, filetags.QueryNode)
+
+    def test_scan_cache(self):
+
+        cache = filetags.ScanCache(max_scans=2)
+        top = filetags.TagScan(self.tempdir, recursive=False)
+        sub = filetags.TagScan(self.subdir1, recursive=False)
+        cache.put(top)
+        cache.put(sub)
+
+        # scans are keyed by their startdir:
+        self.assertIs(cache.get(self.tempdir, False), top)
+        self.assertIs(cache.get(os.path.join(self.subdir1, '..', 'sub dir 1'), False), sub)
+        self.assertIsNone(cache.get(self.tempdir, True))
+        self.assertEqual(len(filetags.get_files_with_metadata(self.subdir1, use_cache=False)), 6)
+        self.assertEqual(len(filetags.get_files_with_metadata(self.tempdir)), 3)
+
+        # least recently used scans are evicted:
+        cache.put(filetags.TagScan(self.subdir2, recursive=False))
+        self.assertIsNone(cache.get(self.tempdir, False))
+        self.assertEqual(cache.num_files, 6)
+
+        # scans of modified directories are dropped:
+        self.create_tmp_file(self.subdir1, 'foo10 -- new.txt')
+        os.utime(self.subdir1, ns=(0, 0))
+        self.assertIsNone(cache.get(self.subdir1, False))
+        self.assertEqual(cache.num_files, 0)
+
+        # a non-recursive lookup of a recursive scan only checks its startdir:
+        cache.put(filetags.TagScan(self.tempdir, recursive=True))
+        self.create_tmp_file(self.subdir2, 'foo11 -- new.txt')
+        os.utime(self.subdir2, ns=(0, 0))
+        self.assertIsNotNone(cache.get(self.tempdir, False))
+        self.assertIsNone(cache.get(self.tempdir, True))
+
+        # the memory cap is respected:
+        cache = filetags.ScanCache(max_files=5)
+        cache.put(top)
+        cache.put(filetags.TagScan(self.subdir1, recursive=False))
+        self.assertEqual(list(cache.scans.values()), [])
+
+    def test_walk_directories_in_parallel(self):
+
+        sequential = list(filetags.walk_directories(self.tempdir, recursive=True, jobs=1))
+        self.assertEqual([os.path.basename(x[0]) for x in sequential],
+                         [os.path.basename(self.tempdir), 'sub dir 1', 'sub dir 2'])
+        self.assertEqual([x[0] for x in sequential[1][3]],
+                         ['foo4 -- bar.txt', 'foo5.txt', 'foo6 -- baz teststring1.txt',
+                          'foo7 -- teststring1.txt', 'foo8 -- baz.txt', 'foo9 -- baz bar.txt'])
+        for jobs in [2, 8]:
+            self.assertEqual(list(filetags.walk_directories(self.tempdir, recursive=True, jobs=jobs)), sequential)
+
+    def test_walk_directories_with_persistent_index(self):
+
+        indexdir = tempfile.mkdtemp(prefix='TestPersistentTagIndex_')
+        index = filetags.PersistentTagIndex(os.path.join(indexdir, filetags.TAG_INDEX_FILENAME))
+
+        # pretend that nothing changed recently so that the index trusts the mtimes:
+        past = time.time() - 3600
+        for directory in [self.tempdir, self.subdir1, self.subdir2]:
+            os.utime(directory, (past, past))
+
+        def walk_summary(index):
+            return sorted((os.path.basename(path), sorted(dirs), sorted(x[0] for x in files))
+                          for path, pathtags, dirs, files in
+                          filetags.walk_directories(self.tempdir, recursive=True, index=index))
+
+        without_index = walk_summary(None)
+        self.assertEqual(walk_summary(index), without_index)
+        self.assertEqual(index.get_directories_below(self.subdir1)[self.subdir1][0], os.stat(self.subdir1).st_mtime_ns)
+        self.assertEqual(walk_summary(index), without_index)
+
+        # renaming a file changes the mtime of its directory and invalidates the index entry:
+        os.rename(os.path.join(self.subdir1, 'foo5.txt'), os.path.join(self.subdir1, 'foo5 -- new.txt'))
+        self.assertNotEqual(index.get_directories_below(self.subdir1)[self.subdir1][0], os.stat(self.subdir1).st_mtime_ns)
+        self.assertIn('foo5 -- new.txt', dict((x[0], x[2]) for x in walk_summary(index))['sub dir 1'])
+
+        index.connection.close()
+        rmtree(indexdir)
 
     def test_list_unknown_tags(self):
 
@@ -947,6 +1417,18 @@ class TestHierarchyWithFilesAndFolders(unittest.TestCase):
         self.assertTrue(os.path.isdir(os.path.join(self.subdir2, 'nontagged_items')))
 
 
+    def test_tagtrees_with_nested_nontagged_subdir(self):
+
+        self.create_tmp_file(self.tempdir, 'foo10.txt')
+        filetags.generate_tagtrees(directory=self.subdir2,
+                                   maxdepth=2,
+                                   ignore_nontagged=False,
+                                   nontagged_subdir=os.path.join('no', 'tags'),
+                                   link_missing_mutual_tagged_items=False)
+
+        self.assertEqual(os.listdir(os.path.join(self.subdir2, 'no')), ['tags'])
+        self.assertEqual([x.split('.')[0] for x in os.listdir(os.path.join(self.subdir2, 'no', 'tags'))], ['foo10'])
+
     def test_tagtrees_with_tagfilter_and_one_filtertag(self):
 
         filetags.generate_tagtrees(directory=self.subdir2,
@@ -1010,6 +1492,174 @@ class TestHierarchyWithFilesAndFolders(unittest.TestCase):
         self.assertTrue(os.path.isdir(os.path.join(self.subdir2, 'nontagged_items')))
 
 
+    def test_tagtrees_incremental(self):
+
+        def generate(incremental):
+            filetags.generate_tagtrees(directory=self.subdir2,
+                                       maxdepth=2,
+                                       ignore_nontagged=False,
+                                       nontagged_subdir='nontagged_items',
+                                       link_missing_mutual_tagged_items=False,
+                                       filtertags=None,
+                                       incremental=incremental)
+
+        def snapshot():
+            result = {}
+            for path, dirs, files in os.walk(self.subdir2):
+                for name in dirs + files:
+                    fullname = os.path.join(path, name)
+                    result[os.path.relpath(fullname, self.subdir2)] = os.lstat(fullname).st_ino
+            return result
+
+        generate(incremental=True)  # no manifest yet: full generation
+        manifest = filetags.read_tagtrees_manifest(self.subdir2)
+        self.assertIn(os.path.join('bar', 'baz', 'foo2 -- bar baz.txt'), manifest['links'])
+        before = snapshot()
+
+        os.rename(os.path.join(self.tempdir, 'foo1 -- bar.txt'), os.path.join(self.tempdir, 'foo1 -- new.txt'))
+        generate(incremental=True)
+        after = snapshot()
+
+        if sys.platform != "win32":
+            self.assertNotIn(os.path.join('bar', 'foo1 -- bar.txt'), after)
+            self.assertIn(os.path.join('new', 'foo1 -- new.txt'), after)
+            self.assertTrue(os.path.exists(os.path.join(self.subdir2, 'new', 'foo1 -- new.txt')))
+            # unchanged links were not re-created:
+            unchanged = os.path.join('baz', 'bar', 'foo2 -- bar baz.txt')
+            self.assertEqual(before[unchanged], after[unchanged])
+
+        # the result is the same as the one of a complete re-generation:
+        generate(incremental=False)
+        self.assertEqual(set(snapshot()), set(after))
+
+    def test_create_tagtrees_links_in_parallel(self):
+
+        files = [os.path.join(self.subdir1, '%03i %s' % (i, x)) for i in range(100) for x in os.listdir(self.subdir1)]
+        plan = filetags.plan_tagtrees(files, 2, '', False)
+        self.assertEqual(len(plan.links), 1200)
+        self.assertEqual(len(plan.directories), 7)
+
+        for jobs in [1, 4]:
+            directory = tempfile.mkdtemp(dir=self.tempdir)
+            for current_directory in plan.directories:
+                os.makedirs(os.path.join(directory, current_directory))
+            filetags.create_tagtrees_links(directory, list(plan.links.items()), jobs=jobs)
+            if sys.platform != "win32":
+                self.assertEqual(len(os.listdir(os.path.join(directory, 'baz', 'bar'))), 100)
+                self.assertEqual(os.readlink(os.path.join(directory, '042 foo5.txt')),
+                                 os.path.join(self.subdir1, '042 foo5.txt'))
+
+    def test_tagtrees_layout_combinations(self):
+
+        self.create_tmp_file(self.tempdir, 'foo10 -- c a b.txt')
+        for currentfile in os.listdir(self.tempdir):
+            if currentfile.startswith('foo') and currentfile != 'foo10 -- c a b.txt':
+                os.remove(os.path.join(self.tempdir, currentfile))
+
+        permutations = filetags.plan_tagtrees(['foo10 -- c a b.txt'], 3, '', False)
+        combinations = filetags.plan_tagtrees(['foo10 -- c a b.txt'], 3, '', False, layout='combinations')
+        self.assertEqual(len(permutations.links), 3 + 6 + 6)
+        self.assertEqual(len(combinations.links), 3 + 3 + 1)
+        self.assertIn(os.path.join('a', 'b', 'c', 'foo10 -- c a b.txt'), combinations.links)
+        self.assertEqual(combinations.directory_links, {})
+
+        filetags.generate_tagtrees(directory=self.subdir2, maxdepth=3, ignore_nontagged=False,
+                                   nontagged_subdir=False, link_missing_mutual_tagged_items=False,
+                                   incremental=True, layout='combinations', link_orderings=True)
+        self.assertEqual(filetags.read_tagtrees_manifest(self.subdir2)['directory_links'],
+                         {os.path.join('b', 'a'): os.path.join('..', 'a', 'b'),
+                          os.path.join('c', 'a'): os.path.join('..', 'a', 'c'),
+                          os.path.join('c', 'b'): os.path.join('..', 'b', 'c'),
+                          os.path.join('b', 'c', 'a'): os.path.join('..', '..', 'a', 'b', 'c'),
+                          os.path.join('a', 'c', 'b'): os.path.join('..', 'b', 'c')})
+
+        # all orderings are reachable:
+        if sys.platform != "win32":
+            for ordering in itertools.permutations(['a', 'b', 'c']):
+                self.assertTrue(os.path.isfile(os.path.join(self.subdir2, *ordering, 'foo10 -- c a b.txt')))
+            self.assertTrue(os.path.islink(os.path.join(self.subdir2, 'c', 'a')))
+
+        # switching back to permutations incrementally replaces the directory links with directories:
+        filetags.generate_tagtrees(directory=self.subdir2, maxdepth=3, ignore_nontagged=False,
+                                   nontagged_subdir=False, link_missing_mutual_tagged_items=False,
+                                   incremental=True)
+        self.assertFalse(os.path.islink(os.path.join(self.subdir2, 'c', 'a')))
+        self.assertTrue(os.path.exists(filetags.get_link_filename(os.path.join(self.subdir2, 'c', 'a', 'b',
+                                                                                'foo10 -- c a b.txt'))))
+
+    def test_tagtrees_statistics(self):
+
+        files = ['foo1 -- a b c.txt', 'foo2 -- a d.txt', 'foo3.txt']
+        for layout in filetags.TAGTREES_LAYOUTS:
+            plan = filetags.plan_tagtrees(files, 3, 'nontagged', False, layout=layout, link_orderings=True)
+            statistics = filetags.get_tagtrees_statistics(files, 3, 'nontagged', False,
+                                                          layout=layout, link_orderings=True)
+            self.assertEqual(sum(x['links'] for x in statistics), len(plan.links))
+            self.assertEqual(sum(x['directories'] for x in statistics), len(plan.directories))
+            self.assertEqual(sum(x['directory_links'] for x in statistics), len(plan.directory_links))
+
+    def test_tagtrees_calibration_keeps_tagtrees_directory(self):
+
+        with patch('tempfile.mkdtemp', wraps=tempfile.mkdtemp) as mkdtemp:
+            self.assertGreater(filetags.calibrate_tagtrees_syscall_seconds(self.subdir2), 0)
+            self.assertEqual(mkdtemp.call_args[1]['dir'], self.tempdir)
+            with patch.object(filetags.options, 'dryrun', True):
+                mkdtemp.reset_mock()
+                self.assertIsNone(filetags.calibrate_tagtrees_syscall_seconds(self.subdir2))
+                self.assertFalse(mkdtemp.called)
+
+    def test_tagtrees_budget(self):
+
+        statistics = filetags.get_tagtrees_statistics(['foo1 -- a b c.txt'], 3, '', False)
+        self.assertEqual([filetags.get_tagtrees_inodes(x) for x in statistics], [0, 6, 12, 12])
+        self.assertEqual(filetags.fit_tagtrees_into_budget(statistics, 30, False), 3)
+        self.assertEqual(filetags.fit_tagtrees_into_budget(statistics, 29, False), 2)
+        with self.assertRaises(SystemExit):
+            filetags.fit_tagtrees_into_budget(statistics, 29, True)
+        with self.assertRaises(SystemExit):
+            filetags.fit_tagtrees_into_budget(statistics, 5, False)
+
+    def test_virtual_tagtrees_view(self):
+
+        def walk_view(view, path=''):
+            result = set()
+            for name in view.listdir(path):
+                result.add(path + '/' + name)
+                if view.isdir(path + '/' + name):
+                    result.update(walk_view(view, path + '/' + name))
+            return result
+
+        # the view looks like the generated tagtrees:
+        filetags.generate_tagtrees(directory=self.subdir2, maxdepth=2, ignore_nontagged=False,
+                                   nontagged_subdir=False, link_missing_mutual_tagged_items=False)
+        generated = set()
+        for path, dirs, files in os.walk(self.subdir2):
+            for name in dirs + files:
+                if name != filetags.TAGTREES_MARKER_FILENAME:
+                    if sys.platform == "win32" and name.endswith('.lnk'):
+                        name = name[:-len('.lnk')]  # the view names links like their sources
+                    generated.add('/' + os.path.relpath(os.path.join(path, name), self.subdir2).replace(os.sep, '/'))
+        view = filetags.TagtreesView(self.tempdir, recursive=False, maxdepth=2)
+        self.assertEqual(walk_view(view), generated)
+        self.assertEqual(view.listdir('/baz'), ['bar', 'foo2 -- bar baz.txt', 'foo3 -- baz teststring1.txt', 'teststring1'])
+        self.assertEqual(view.readlink('/baz/bar/foo2 -- bar baz.txt'), os.path.join(self.tempdir, 'foo2 -- bar baz.txt'))
+        self.assertRaises(FileNotFoundError, view.listdir, '/bar/teststring1')
+        self.assertRaises(NotADirectoryError, view.listdir, '/bar/foo1 -- bar.txt')
+
+        # the view always reflects the current file names and has no depth limit by default:
+        os.rename(os.path.join(self.tempdir, 'foo1 -- bar.txt'), os.path.join(self.tempdir, 'foo1 -- bar baz teststring1.txt'))
+        view = filetags.TagtreesView(self.tempdir, recursive=False, max_age=0)
+        self.assertEqual(view.listdir('/bar/baz/teststring1'), ['foo1 -- bar baz teststring1.txt'])
+
+        # the listings are cached until the scan changes:
+        with patch.object(view, 'compute_entries', wraps=view.compute_entries) as compute_entries:
+            for name in view.listdir('/bar'):
+                view.isdir('/bar/' + name)
+            self.assertEqual(compute_entries.call_count, 1)
+            os.rename(os.path.join(self.tempdir, 'foo1 -- bar baz teststring1.txt'),
+                      os.path.join(self.tempdir, 'foo1 -- bar.txt'))
+            self.assertRaises(FileNotFoundError, view.listdir, '/bar/baz/teststring1')
+
     def test_tagtrees_overwrites_old_default_directory(self):
 
         with open(os.path.join(self.subdir2, 'boring tagtrees data.txt'), 'w', encoding="utf-8"):
@@ -1227,5 +1877,23 @@ class TestReplacingLinkSourceAndTarget(unittest.TestCase):
         self.assertEqual(self.link_file_exists('link and source same name -- bar.txt'), True)
         self.assertEqual(self.source_file_exists('link and source same name -- bar.txt'), True)
 
+    @unittest.skipIf(platform.system() == 'Windows', 'relative symbolic links only')
+    def test_tagging_relative_link_keeps_working_directory(self):
+
+        # the relative link target has to be resolved against the link directory, not the working directory:
+        os.symlink(os.path.join(os.pardir, os.path.basename(self.sourcedir), self.SOURCEFILE4),
+                   os.path.join(self.linkdir, 'relative link.txt'))
+        os.rename(os.path.join(self.linkdir, 'relative link.txt'), os.path.join(self.linkdir, self.SOURCEFILE4))
+        os.chdir(tempfile.gettempdir())
+
+        errors, new_filename = filetags.handle_file_and_optional_link(os.path.join(self.linkdir, self.LINKFILE4),
+                                                                      ['foo'], do_remove=False, do_filter=False,
+                                                                      dryrun=False)
+        self.assertEqual(errors, 0)
+        self.assertEqual(os.getcwd(), os.path.realpath(tempfile.gettempdir()))
+        self.assertTrue(self.source_file_exists('link and source same name -- foo.txt'))
+        self.assertTrue(self.link_file_exists('link and source same name -- foo.txt'))
+        self.assertFalse(self.is_broken_link('link and source same name -- foo.txt'))
+
 if __name__ == '__main__':
     unittest.main()